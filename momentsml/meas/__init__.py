@@ -5,6 +5,7 @@ Subpackage for feature measurement
 __all__ = []
 
 from . import utils
+from . import pipeline
 from . import galsim_adamom
 from . import fit
 from . import adamom_calc
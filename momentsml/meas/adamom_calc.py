@@ -4,7 +4,8 @@ Compute derived quantities from adamom measurements.
 
 import astropy.table
 import numpy as np
-import copy
+
+from . import pipeline
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,6 +16,8 @@ def measfct(catalog, prefix="", **kwargs):
 	- adamom_logflux
 	- adamom_g
 	- adamom_theta
+	
+	catalog can also be a meas.pipeline.Pipeline.
 	"""
 	
 	cols = ["adamom_flux"]
@@ -22,14 +25,15 @@ def measfct(catalog, prefix="", **kwargs):
 		if col not in catalog.colnames:
 			raise RuntimeError("I need column {}".format(col))
 			
-	output = astropy.table.Table(copy.deepcopy(catalog), masked=True)
-	
-	output["adamom_logflux"] = np.ma.log10(output["adamom_flux"]) # Negative values get masked.
-	
-	output["adamom_g"] = np.ma.hypot(output["adamom_g1"], output["adamom_g2"])
-	output["adamom_theta"] = 0.5 * np.arctan2(output["adamom_g2"], output["adamom_g1"])
-	
-	return output
+	flux = np.ma.array(catalog["adamom_flux"])
+	g1 = np.ma.array(catalog["adamom_g1"])
+	g2 = np.ma.array(catalog["adamom_g2"])
+	
+	return pipeline.addcolumns(catalog, [
+		astropy.table.MaskedColumn(name="adamom_logflux", data=np.ma.log10(flux)), # Negative values get masked.
+		astropy.table.MaskedColumn(name="adamom_g", data=np.ma.hypot(g1, g2)),
+		astropy.table.MaskedColumn(name="adamom_theta", data=0.5 * np.ma.arctan2(g2, g1)),
+	])
 	
 	
 	
@@ -15,17 +15,28 @@ from . import utils
 import logging
 logger = logging.getLogger(__name__)
 
-def onsims(measdir, simparams, task="groupstats", **kwargs):
+def onsims(measdir, simparams, task="groupstats", stream=False, memmapdir=None, simdir=None, **kwargs):
 	"""
 	Top-level function to group measurements as obtained from :func:`momentsml.meas.run.onsims`.
 	
-	This function first explores the files in your measdir using :func:`simmeasdict`,
+	This function first explores the files in your measdir using :func:`simmeasdict` (which reads the manifest of the measdir if there is one),
 	then uses :func:`groupstats` or :func:`group` to "hstack" the different realizations catalog by catalog (and maybe compute some statistics),
 	and finally it "vstacks" all your catalogs to return a single output table.
 
 	:param measdir: See :func:`momentsml.meas.run.onsims`
 	:param simparams: idem
 	:param task: either "groupstats" or "group", depending on what you want to do.
+	:param stream: if True, the measurements are streamed from disk instead of being all loaded. For the task "groupstats",
+		the realizations of each catalog get read one after the other, and the statistics accumulated (to bound the memory
+		used by the medians, also give a mediansize, see :func:`momentsml.tools.table.groupstats`).
+		For the task "group", the output columns get preallocated and filled catalog by catalog,
+		using :func:`momentsml.tools.table.groupstream`, so that only the realizations of one catalog are in memory at a time.
+		This requires the number of rows of each catalog, taken from the manifest of the simdir if possible (see simdir),
+		and otherwise from a first pass reading the first realization of each catalog.
+	:param memmapdir: with stream and the task "group", an optional directory (that must not exist) in which the output columns get memory-mapped.
+		The output is then a columnar catalog (see :func:`momentsml.tools.io.writecolumns`), that does not have to be saved again.
+	:param simdir: optionally, the simdir of :func:`momentsml.meas.run.onsims`, whose manifest (written by :func:`momentsml.sim.run.multi`)
+		gives the number of rows of each catalog for stream=True and the task "group".
 	:param kwargs: any further keyword arguments are passed to :func:`momentsml.tools.table.groupstats` or :func:`momentsml.tools.table.group`
 	
 	To learn about the output, see the latter.
@@ -36,19 +47,30 @@ def onsims(measdir, simparams, task="groupstats", **kwargs):
 	# We use the above function to find what we have:
 	catdict = utils.simmeasdict(measdir, simparams)
 	
+	if memmapdir is not None and not (stream and task == "group"):
+		raise RuntimeError("A memmapdir can only be used with stream=True and task='group'")
+	
+	if stream and task == "group":
+		logger.info("Counting the rows of the %i catalogs..." % (len(catdict)))
+		nrows = _countrows(measdir, simparams, catdict, simdir)
+		incatlists = (list(_itermeascats(measdir, simparams, catname, meascatfilepaths)) for (catname, meascatfilepaths) in catdict.items())
+		outputcat = tools.table.groupstream(incatlists, nrows, memmapdir=memmapdir, **kwargs)
+		if len(catdict) > 1: # Same meta as below
+			outputcat.meta.pop("catname", None)
+			outputcat.meta.pop("psf", None)
+			outputcat.meta.pop("imgreas", None)
+			if memmapdir is not None:
+				tools.io.writecolumnsinfo(outputcat, memmapdir)
+		logger.info("Done with collecting results for %i simulated galaxies" % (len(outputcat)))
+		return outputcat
+	
 	# We iterate over one simulated catalog after the other.
 	outputcats = []
 	for (catname, meascatfilepaths) in catdict.items():
 		
-		# So this are the measurements for a single catalog:
-		logger.info("Reading all measurements for catalog '%s' (%i realizations)..." % (catname, len(meascatfilepaths)))
-		meascats = [tools.io.readpickle(os.path.join(measdir, simparams.name, meascatfilepath)) for meascatfilepath in meascatfilepaths]
-		
-		# To avoid meta conflicts, we remove the meta from all but the first realization:
-		for meascat in meascats[1:]:
-			meascat.meta = {}
-		# We also remove meta["img"] from the first realization, as it does no longer apply after the groupstats.
-		meascats[0].meta.pop("img")
+		meascats = _itermeascats(measdir, simparams, catname, meascatfilepaths)
+		if not stream:
+			meascats = list(meascats)
 		
 		if task == "groupstats":
 			# And we call groupstats
@@ -99,3 +121,38 @@ def onsims(measdir, simparams, task="groupstats", **kwargs):
 	return outputcat
 
 
+def _countrows(measdir, simparams, catdict, simdir=None):
+	"""
+	Returns the total number of rows of the catalogs of catdict (see :func:`momentsml.meas.utils.simmeasdict`).
+	The numbers of rows are read from the manifest of the simdir, if there is one. Only the catalogs missing from it
+	(e.g., drawn before manifests existed) get the measurements on their first realization read.
+	"""
+	simmanifest = {}
+	if simdir is not None:
+		simmanifestfilepath = tools.manifest.getpath(os.path.join(simdir, simparams.name))
+		if os.path.exists(simmanifestfilepath):
+			simmanifest = tools.manifest.read(simmanifestfilepath)
+	nrows = 0
+	for (catname, meascatfilepaths) in catdict.items():
+		if "nrows" in simmanifest.get(catname, {}):
+			nrows += simmanifest[catname]["nrows"]
+		else:
+			nrows += len(tools.io.readpickle(os.path.join(measdir, simparams.name, meascatfilepaths[0])))
+	return nrows
+
+
+def _itermeascats(measdir, simparams, catname, meascatfilepaths):
+	"""
+	Yields the measurements on the realizations of a catalog, one after the other, with their meta cleaned for the grouping.
+	"""
+	# So this are the measurements for a single catalog:
+	logger.info("Reading all measurements for catalog '%s' (%i realizations)..." % (catname, len(meascatfilepaths)))
+	for (i, meascatfilepath) in enumerate(meascatfilepaths):
+		meascat = tools.io.readpickle(os.path.join(measdir, simparams.name, meascatfilepath))
+		if i == 0:
+			# We remove meta["img"] from the first realization, as it does no longer apply after the groupstats.
+			meascat.meta.pop("img")
+		else:
+			# To avoid meta conflicts, we remove the meta from all but the first realization:
+			meascat.meta = {}
+		yield meascat
@@ -4,7 +4,6 @@ Shape measurement with GalSim's adaptive moments (from its "hsm" module).
 
 import numpy as np
 import sys, os
-import copy
 from datetime import datetime
 
 import logging
@@ -16,14 +15,18 @@ import galsim
 from astropy.modeling import models, fitting
 from astropy.stats import sigma_clip
 from astropy.modeling import Fittable2DModel, Parameter
-from scipy.special import gamma, gammaincinv
+from scipy.special import gamma, gammaln, gammaincinv
 
 from . import utils
+from . import pipeline
 from .. import tools
 
 
 
 def measfct(catalog, runon="img", stampsize=None, **kwargs):
+	"""
+	The MomentsML-conform measfct. Use backend="fast" for the fast fitter, see measure().
+	"""
 		
 	# We get the stamp size to use:
 	stampsize = catalog.meta[runon].get_stampsize(stampsize)
@@ -77,9 +80,27 @@ class EllipSersic2D(Fittable2DModel):
 		return amplitude * np.exp(-bn * (z ** (1 / n) - 1))
 
 
-def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="fit_"):
+def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="fit_", backend="astropy", seedprefix="auto", chunksize=500):
 	"""
-	
+	Fits an EllipSersic2D to each source of the catalog.
+
+	:param backend: "astropy" uses astropy's LevMarLSQFitter on the EllipSersic2D model, with a finite-difference Jacobian.
+		"fast" fits the same model with a Levenberg-Marquardt algorithm vectorized over chunks of stamps (see _fastfits),
+		using the analytic Jacobian of fastsersic(). With its default seeds, it is about 10 times faster than the astropy
+		backend on a hundred sources, and more on larger catalogs, but only 5 to 10 times faster on a handful of sources,
+		as the time spent on the stamps and on the output table is the same for both backends.
+	:param seedprefix: if set (typically to "adamom_", after galsim_adamom) and if the columns seedprefix+"flux", "x", "y", "sigma",
+		"g1" and "g2" exist, the fits start from these measurements, for each source on which they are not masked.
+		Otherwise, the fits start from flux=1000, r_eff=10, centered in the stamp, without ellipticity.
+		In both cases, the fits start from n=2.
+		The default "auto" means "adamom_" for the fast backend, and None for the astropy backend (which so keeps its traditional
+		starting point).
+
+	:param chunksize: number of sources whose stamps get extracted (and, for the fast backend, fitted) together.
+		Large chunks spread the iterations of the few slowly converging fits of each chunk over more sources.
+
+	The flag is 1 if the stamp is not fully within the image, and 3 if the fit returned non-finite values.
+	The coordinate grids of the stamps are computed only once per stampsize.
 	"""
 	
 	if type(img) is str:
@@ -88,114 +109,424 @@ def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="fit_"):
 	
 	if int(stampsize)%2 != 0:
 		raise RuntimeError("The stampsize should be even!")
+	stampsize = int(stampsize)
+	
+	if backend not in ["astropy", "fast"]:
+		raise RuntimeError("Unknown backend '%s'" % (backend))
 
 	starttime = datetime.now()
-	logger.info("Starting fit on %ix%i stamps" % (stampsize, stampsize))
+	logger.info("Starting fit on %ix%i stamps with the %s backend" % (stampsize, stampsize, backend))
 	
-	# We prepare an output table with all the required columns
-	output = astropy.table.Table(copy.deepcopy(catalog), masked=True) # Convert the table to a masked table
-	# A bit strange: reading the doc I feel that this conversion is not needed.
-	# But without it, it just doesn't result in a masked table once the masked columns are appended.
-
-	output.add_columns([
-		astropy.table.Column(name=prefix+"flag", data=np.zeros(len(output), dtype=int)), # We will always have a flag
-		astropy.table.MaskedColumn(name=prefix+"flux", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"x", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"y", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"g1", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"g2", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"r_eff", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"n", dtype=float, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"info_nfev", dtype=int, length=len(output)),
-		astropy.table.MaskedColumn(name=prefix+"info_ier", dtype=int, length=len(output))
-	])
+	n = len(catalog)
+	xs = np.asarray(catalog[xname], dtype=float)
+	ys = np.asarray(catalog[yname], dtype=float)
+	if seedprefix == "auto":
+		seedprefix = "adamom_" if backend == "fast" else None
+	seeds = _getseeds(catalog, seedprefix)
+	(x_array, y_array) = _getgrids(stampsize)
 	
-	# We want to mask all these entries. They will get unmasked when values will be attributed.
-	for col in ["flux", "x", "y", "g1", "g2", "r_eff", "n", "info_nfev", "info_ier"]:
-		output[prefix+col].mask = [True] * len(output) # "True" means masked !
-		
-	n = len(output)
+	# Ugly copy of the code from getstamp to get the "offset" right:
+	offsets = np.stack([np.round(xs - 0.5).astype(int) - stampsize//2, np.round(ys - 0.5).astype(int) - stampsize//2], axis=1)
+	
+	# The results, that we will turn into columns at the end
+	paramnames = ["flux", "r_eff", "n", "x_0", "y_0", "g1", "g2"]
+	flags = np.zeros(n, dtype=int)
+	results = np.zeros((n, len(paramnames)))
+	infos = np.zeros((n, 2), dtype=int) # nfev, ier
+	mask = np.ones(n, dtype=bool) # True means masked, entries get unmasked when values are attributed
 	
-	# And loop
-	for gal in output:
+	# We loop over chunks of sources, as the fast backend fits all the stamps of a chunk together
+	for start in range(0, n, chunksize):
 		
 		# Some simplistic progress indication:
-		if gal.index%5000 == 0:
-			logger.info("%6.2f%% done (%i/%i) " % (100.0*float(gal.index)/float(n), gal.index, n))
-		
-		(x, y) = (gal[xname], gal[yname])
-		(gps, flag) = tools.image.getstamp(x, y, img, stampsize)
+		if start%5000 < chunksize:
+			logger.info("%6.2f%% done (%i/%i) " % (100.0*float(start)/float(n), start, n))
 		
-		# Ugly copy of the code from getstamp to get the "offset" right:
-		x_offset = int(np.round(x - 0.5)) - int(stampsize)/2
-		y_offset = int(np.round(y - 0.5)) - int(stampsize)/2
+		(todo, stamps, inis) = ([], [], [])
+		for i in range(start, min(start + chunksize, n)):
 		
+			(x, y) = (xs[i], ys[i])
+			(gps, flag) = tools.image.getstamp(x, y, img, stampsize)
+			
+			if flag != 0:
+				logger.debug("Galaxy %i at (%.2f, %.2f) not fully within image" % (i, x, y))
+				flags[i] = flag
+				# We can't do anything, and we just skip this galaxy.
+				continue
+			
+			# The initial parameters, in stamp coordinates
+			ini = [1000.0, 10.0, 2.0, stampsize/2.0, stampsize/2.0, 0.0, 0.0]
+			if seeds is not None and np.all(np.isfinite(seeds[i])):
+				(flux, sx, sy, sigma, g1, g2) = seeds[i]
+				g = min(np.hypot(g1, g2), 0.9)
+				q = (1.0 - g) / (1.0 + g) # The axis ratio b/a
+				ini = [flux, min(max(1.1774 * sigma / np.sqrt(q), 0.1), 100.0), 2.0, sx - 1.0 - offsets[i, 0], sy - 1.0 - offsets[i, 1], g1, g2]
+				# 1.1774 x sigma = r half light, and the adamom positions are 1-based.
+			
+			todo.append(i)
+			stamps.append(gps.array)
+			inis.append(ini)
 		
-		if flag != 0:
-			logger.debug("Galaxy not fully within image:\n %s" % (str(gal)))
-			gal[prefix+"flag"] = flag
-			# We can't do anything, and we just skip this galaxy.
+		if len(todo) == 0:
 			continue
-				
-		# Do the fit
 		
-		stamp = gps.array
-		weights = np.ones(stamp.shape)
-		x_array, y_array = np.meshgrid(np.arange(stampsize), np.arange(stampsize))
+		# Do the fits
+		if backend == "fast":
+			(params, nfevs, iers) = _fastfits(np.array(stamps), np.array(inis), x_array, y_array)
+		else:
+			fits = [_astropyfit(stamp, ini, x_array, y_array) for (stamp, ini) in zip(stamps, inis)]
+			(params, nfevs, iers) = [np.array(values) for values in zip(*fits)]
 		
-		
-		#ini_flux = np.sum(stamp)
-		#ini_r_eff = gal["adamom_sigma"]
-		ini_flux = 1000.0
-		ini_r_eff = 10.0
-		
-		
-		
-		ini_mod = EllipSersic2D(flux=ini_flux, r_eff=ini_r_eff, n=2.0, x_0=stampsize/2.0, y_0=stampsize/2.0, g1=0.0, g2=0.0)
-
-		#fitter = fitting.SLSQPLSQFitter() # Does not work well, it seems
-		fitter = fitting.LevMarLSQFitter()
+		for (i, param, nfev, ier) in zip(todo, params, nfevs, iers):
+			if not np.all(np.isfinite(param)):
+				logger.debug("Fit of galaxy %i at (%.2f, %.2f) failed" % (i, xs[i], ys[i]))
+				flags[i] = 3
+				continue
+			results[i] = param
+			infos[i] = (nfev, ier)
+			mask[i] = False
 	
-		#fit_mod = fitter(ini_mod, x_array, y_array, stamp, weights=weights)
-		fit_mod = fitter(ini_mod, x_array, y_array, stamp, weights=weights, maxiter = 1000, acc=1.0e-7, epsilon=1.0e-6, estimate_jacobian=False)
+	# From stamp coordinates to image coordinates
+	results[:, 3] += offsets[:, 0]
+	results[:, 4] += offsets[:, 1]
 
-		#fitter.fit_info["nfev"] = 0
-		#fitter.fit_info["ierr"] = 0
+	# If we made it to this point, we check that the centroid is roughly ok:
+	#if np.hypot(x - gal[prefix+"x"], y - gal[prefix+"y"]) > 10.0:
+	#	gal[prefix + "flag"] = 2
 		
-
-		#logger.debug("Fit results: {}".format(fitter.fit_info["message"]))
-		#print fitter.fit_info
-		#if fitter.fit_info["ierr"] != 0:
-		#print fitter.fit_info["ierr"], fitter.fit_info["message"]
+	#if gal[prefix+"flux"] < 0 and gal[prefix + "flag"] > 0:
+	#	# The centroid checking is rough
+	#	gal[prefix + "flag"] = 4
 	
-	
-		gal[prefix+"flux"] = fit_mod.flux.value
-		gal[prefix+"x"] = fit_mod.x_0.value + x_offset
-		gal[prefix+"y"] = fit_mod.y_0.value + y_offset
-		gal[prefix+"g1"] = fit_mod.g1.value
-		gal[prefix+"g2"] = fit_mod.g2.value
-		gal[prefix+"r_eff"] = fit_mod.r_eff.value
-		gal[prefix+"n"] = fit_mod.n.value
-		
-		gal[prefix+"info_nfev"] = fitter.fit_info["nfev"]
-		gal[prefix+"info_ier"] = fitter.fit_info["ierr"]
-
-
-		# If we made it to this point, we check that the centroid is roughly ok:
-		#if np.hypot(x - gal[prefix+"x"], y - gal[prefix+"y"]) > 10.0:
-		#	gal[prefix + "flag"] = 2
-			
-		#if gal[prefix+"flux"] < 0 and gal[prefix + "flag"] > 0:
-		#	# The centroid checking is rough
-		#	gal[prefix + "flag"] = 4
-		
+	newcols = [astropy.table.Column(name=prefix+"flag", data=flags)] # We will always have a flag
+	for (name, index) in [("flux", 0), ("x", 3), ("y", 4), ("g1", 5), ("g2", 6), ("r_eff", 1), ("n", 2)]:
+		newcols.append(astropy.table.MaskedColumn(name=prefix+name, data=results[:, index], mask=mask.copy()))
+	newcols.append(astropy.table.MaskedColumn(name=prefix+"info_nfev", data=infos[:, 0], mask=mask.copy()))
+	newcols.append(astropy.table.MaskedColumn(name=prefix+"info_ier", data=infos[:, 1], mask=mask.copy()))
+	output = pipeline.addcolumns(catalog, newcols)
 
 	endtime = datetime.now()	
 	logger.info("All done")
 
-	nfailed = np.sum(output[prefix+"flag"] > 0)
+	nfailed = np.sum(flags > 0)
 	
-	logger.info("I failed on %i out of %i sources (%.1f percent)" % (nfailed, n, 100.0*float(nfailed)/float(n)))
-	logger.info("This measurement took %.3f ms per galaxy" % (1e3*(endtime - starttime).total_seconds() / float(n)))
+	logger.info("I failed on %i out of %i sources (%.1f percent)" % (nfailed, n, 100.0*float(nfailed)/float(max(n, 1))))
+	logger.info("This measurement took %.3f ms per galaxy" % (1e3*(endtime - starttime).total_seconds() / float(max(n, 1))))
 
 	return output
+
+
+_grids = {} # stampsize -> (x_array, y_array)
+
+def _getgrids(stampsize):
+	"""
+	The pixel coordinates of stamps, computed only once per stampsize.
+	They are read-only, as they are shared by all fits.
+	"""
+	if stampsize not in _grids:
+		(x_array, y_array) = np.meshgrid(np.arange(stampsize, dtype=float), np.arange(stampsize, dtype=float))
+		x_array.flags.writeable = False
+		y_array.flags.writeable = False
+		_grids[stampsize] = (x_array, y_array)
+	return _grids[stampsize]
+
+
+def _getseeds(catalog, seedprefix):
+	"""
+	Returns an array of shape (n, 6) with the flux, x, y, sigma, g1 and g2 from the seedprefix columns (nan where masked),
+	or None if these columns do not exist.
+	"""
+	if seedprefix is None:
+		return None
+	names = [seedprefix + name for name in ["flux", "x", "y", "sigma", "g1", "g2"]]
+	if not all([name in catalog.colnames for name in names]):
+		return None
+	logger.info("The fits start from the %s measurements" % (", ".join(names)))
+	return np.stack([np.where(np.ma.getmaskarray(catalog[name]), np.nan, np.ma.getdata(catalog[name])) for name in names], axis=1).astype(float)
+
+
+def _astropyfit(stamp, ini, x_array, y_array):
+	"""
+	Fits the EllipSersic2D model with astropy's LevMarLSQFitter, as MomentsML always did.
+	Returns the fitted parameters, nfev and ier.
+	"""
+	ini_mod = EllipSersic2D(flux=ini[0], r_eff=ini[1], n=ini[2], x_0=ini[3], y_0=ini[4], g1=ini[5], g2=ini[6])
+	weights = np.ones(stamp.shape)
+
+	#fitter = fitting.SLSQPLSQFitter() # Does not work well, it seems
+	fitter = fitting.LevMarLSQFitter()
+	fit_mod = fitter(ini_mod, x_array, y_array, stamp, weights=weights, maxiter = 1000, acc=1.0e-7, epsilon=1.0e-6, estimate_jacobian=False)
+	
+	params = [getattr(fit_mod, name).value for name in ["flux", "r_eff", "n", "x_0", "y_0", "g1", "g2"]]
+	return (params, fitter.fit_info["nfev"], fitter.fit_info["ierr"])
+
+
+# The bounds of the EllipSersic2D parameters (flux, r_eff, n, x_0, y_0, g1, g2)
+_lower = np.array([0.0, 0.0001, 0.1, -np.inf, -np.inf, -1.0, -1.0])
+_upper = np.array([np.inf, 100.0, 6.0, np.inf, np.inf, 1.0, 1.0])
+
+
+def _fastfits(stamps, inis, x_array, y_array, maxfev=1000, ftol=1.49012e-08, xtol=1.0e-7):
+	"""
+	Levenberg-Marquardt fits of the EllipSersic2D model to a stack of stamps at once, with the analytic Jacobian of the model.
+	Each fit has its own damping, and stops on its own, with convergence tests similar to those of MINPACK (used by scipy's
+	leastsq, and therefore by astropy's LevMarLSQFitter). As astropy does, the parameters are clipped to the bounds of
+	the EllipSersic2D parameters.
+	The normal equations of each step come from _normalequations(), without forming the Jacobian. They are only needed
+	where a step got accepted and the fit goes on: the trial parameters first only get their sum of squares, which is
+	enough to reject a step or to stop a fit. The fits that have converged get removed from the working arrays, so that
+	each iteration only costs the still active fits.
+
+	:param stamps: array of shape (m, stampsize, stampsize)
+	:param inis: initial parameters, shape (m, 7)
+
+	:returns: (params, nfev, ier), with ier as for leastsq: 1 if the relative reduction of the sum of squares was below ftol,
+		2 if the relative change of the parameters was below xtol, 3 if both, and 5 if maxfev was reached.
+	"""
+	m = len(stamps)
+	grid = _Grid(x_array, y_array)
+	params = np.clip(np.asarray(inis, dtype=float), _lower, _upper)
+	nfev = np.ones(m, dtype=int)
+	ier = np.zeros(m, dtype=int)
+
+	# The working arrays, only for the active fits (whose indices are act)
+	data = stamps.reshape(m, grid.npix).astype(float)
+	(chi2, jtj, jtr) = _normalequations(params, data, grid)
+	act = np.flatnonzero(np.isfinite(chi2))
+	(p, data, chi2, jtj, jtr) = (params[act], data[act], chi2[act], jtj[act], jtr[act])
+	damping = np.full(len(act), 1.0e-3)
+
+	while len(act) > 0:
+
+		# The damped normal equations, with the scaling of Marquardt
+		diag = np.diagonal(jtj, axis1=1, axis2=2)
+		diag = np.maximum(diag, 1.0e-12 * np.max(diag, axis=1)[:, np.newaxis] + 1.0e-300)
+		lhs = jtj + (damping[:, np.newaxis] * diag)[:, :, np.newaxis] * np.eye(7)
+		with np.errstate(all="ignore"):
+			try:
+				steps = -np.linalg.solve(lhs, jtr[:, :, np.newaxis])[:, :, 0]
+			except np.linalg.LinAlgError:
+				steps = -np.matmul(np.linalg.pinv(lhs), jtr[:, :, np.newaxis])[:, :, 0]
+
+			trials = np.clip(p + steps, _lower, _upper)
+			trialchi2 = _normalequations(trials, data, grid, jacobian=False)
+			nfev[act] += 1
+
+			# The convergence tests
+			better = trialchi2 < chi2
+			scale = np.sqrt(diag)
+			ftolok = np.logical_and(better, (chi2 - trialchi2) <= ftol * chi2)
+			xtolok = np.linalg.norm(scale * (trials - p), axis=1) <= xtol * np.linalg.norm(scale * p, axis=1)
+		actier = np.where(ftolok, 1, 0) + np.where(xtolok, 2, 0)
+		actier[np.logical_and(actier == 0, nfev[act] >= maxfev)] = 5
+		done = actier > 0
+
+		# We accept the steps that improve the fit, and the fits that go on from there need the new normal equations
+		(p[better], chi2[better]) = (trials[better], trialchi2[better])
+		damping = np.where(better, 0.1 * damping, 10.0 * damping)
+		update = np.logical_and(better, np.logical_not(done))
+		if np.any(update):
+			(jtj[update], jtr[update]) = _normalequations(p[update], data[update], grid)[1:]
+
+		# And we remove the fits that are done
+		if np.any(done):
+			(params[act[done]], ier[act[done]]) = (p[done], actier[done])
+			keep = np.logical_not(done)
+			(act, p, data, chi2, jtj, jtr, damping) = (act[keep], p[keep], data[keep], chi2[keep], jtj[keep], jtr[keep], damping[keep])
+
+	return (params, nfev, ier)
+
+
+class _Grid():
+	"""
+	The monomials [1, u, v, u^2, uv, v^2] of the pixel coordinates (u, v), relative to the center of the pixels to limit rounding errors.
+	"""
+
+	def __init__(self, x_array, y_array):
+		(x, y) = (np.ravel(x_array).astype(float), np.ravel(y_array).astype(float))
+		self.npix = x.size
+		self.center = (0.5 * (np.min(x) + np.max(x)), 0.5 * (np.min(y) + np.max(y))) if x.size > 0 else (0.0, 0.0)
+		(u, v) = (x - self.center[0], y - self.center[1])
+		self.monomials = np.stack([np.ones_like(u), u, v, u*u, u*v, v*v]) # (6, npix)
+
+
+def _normalequations(params, data, grid, blocksize=16384, jacobian=True):
+	"""
+	Returns the sum of squared residuals chi2, J^T J and J^T r of the EllipSersic2D model for each set of params (shape (k, 7)),
+	with r = model - data (shape (k, npix)) and J the Jacobian of the model, as computed by fastsersic().
+	The fits are processed in blocks of about blocksize pixels, so that the images stay in the CPU caches, and for each
+	block the rows of J and r are written into a single array, whose Gram matrix gives J^T J and J^T r at once.
+	The Jacobian itself is not kept.
+
+	:returns: (chi2, jtj, jtr), of shapes (k,), (k, 7, 7) and (k, 7), or only chi2 if jacobian is False
+	"""
+	k = len(params)
+	(flux, r_eff, n, x_0, y_0, g1, g2) = [params[:, i] for i in range(7)]
+	g = np.hypot(g1, g2)
+	toolarge = g > 0.999 # Beyond, the axis ratio does not make sense
+	if np.any(toolarge):
+		(g1, g2, g) = (np.where(toolarge, g1 * 0.999 / g, g1), np.where(toolarge, g2 * 0.999 / g, g2), np.minimum(g, 0.999))
+	(xc, yc) = (x_0 - grid.center[0], y_0 - grid.center[1])
+
+	# The coefficients of each fit, as in fastsersic()
+	f = 2.0 / (1.0 - g)**2
+	(a, b, c) = (1.0 + f * (g - g1), -f * g2, 1.0 + f * (g + g1))
+	zforms = _quadraticform(a, b, c, xc, yc) / (r_eff**2)[:, np.newaxis] # z^2
+	(bn, logk) = _sersicconstants(n)
+	logq = np.log((1.0 - g) / (1.0 + g))
+	lognorm = logk + np.log(2.0 * np.pi) + 2.0 * np.log(r_eff) + logq
+
+	if jacobian:
+		with np.errstate(divide="ignore", invalid="ignore"):
+			(ug1, ug2) = (np.where(g > 0.0, g1 / g, 0.0), np.where(g > 0.0, g2 / g, 0.0))
+		fp = 4.0 / (1.0 - g)**3 # df/dg
+		dforms = np.stack([
+			np.stack([2.0 * (a * xc + b * yc), -2.0 * a, -2.0 * b, 0*a, 0*a, 0*a], axis=1), # d (r_eff z)^2 / dx_0
+			np.stack([2.0 * (b * xc + c * yc), -2.0 * b, -2.0 * c, 0*a, 0*a, 0*a], axis=1), # d/dy_0
+			_quadraticform(fp * ug1 * (g - g1) + f * (ug1 - 1.0), -fp * ug1 * g2, fp * ug1 * (g + g1) + f * (ug1 + 1.0), xc, yc), # d/dg1
+			_quadraticform(fp * ug2 * (g - g1) + f * ug2, -fp * ug2 * g2 - f, fp * ug2 * (g + g1) + f * ug2, xc, yc), # d/dg2
+			], axis=1) # (k, 4, 6)
+		h = 1.0e-5 * n
+		(bnp, logkp) = _sersicconstants(n + h)
+		(bnm, logkm) = _sersicconstants(n - h)
+		(dbndn, dlogkdn) = ((bnp - bnm) / (2.0 * h), (logkp - logkm) / (2.0 * h))
+		dlogqdg = -2.0 / (1.0 - g*g)
+
+	col = lambda values: values[:, np.newaxis] # Per-fit scalars, broadcasted over the pixels
+	chi2 = np.empty(k)
+	gram = np.empty((k, 8, 8))
+	step = max(1, blocksize // max(grid.npix, 1))
+	for start in range(0, k, step):
+		bl = slice(start, min(start + step, k))
+		nb = bl.stop - bl.start
+		rows = np.empty((nb, 8 if jacobian else 1, grid.npix)) # The 7 rows of J, and r
+
+		z2 = np.dot(zforms[bl], grid.monomials) # z^2, (nb, npix)
+		np.maximum(z2, col(1.0e-12 / r_eff[bl]**2), out=z2) # avoiding the singularity at the center
+		logz2 = np.log(z2)
+		w = np.multiply(logz2, col(0.5 / n[bl])) # z^(1/n)
+		np.exp(w, out=w)
+
+		profile = rows[:, 0] # for a flux of 1
+		np.multiply(w, col(-bn[bl]), out=profile)
+		profile += col(bn[bl] - lognorm[bl])
+		np.exp(profile, out=profile)
+		model = profile * col(flux[bl])
+		r = np.subtract(model, data[bl], out=rows[:, -1])
+		chi2[bl] = np.einsum("ij,ij->i", r, r)
+		if not jacobian:
+			continue
+
+		mw = model * w
+		np.multiply(mw, col(bn[bl] / (n[bl] * r_eff[bl])), out=rows[:, 1])
+		rows[:, 1] -= model * col(2.0 / r_eff[bl])
+		np.multiply(logz2, col(bn[bl] * 0.5 / n[bl]**2), out=rows[:, 2])
+		rows[:, 2] -= col(dbndn[bl])
+		rows[:, 2] *= mw
+		rows[:, 2] += model * col(dbndn[bl] - dlogkdn[bl])
+
+		# The derivatives with respect to x_0, y_0, g1 and g2, via d model / d (r_eff z)^2
+		s = np.divide(mw, z2, out=w)
+		s *= col(-0.5 * bn[bl] / (n[bl] * r_eff[bl]**2))
+		rows[:, 3:7] = np.matmul(dforms[bl], grid.monomials)
+		rows[:, 3:7] *= s[:, np.newaxis, :]
+		rows[:, 5] -= model * col(dlogqdg[bl] * ug1[bl]) # from the normalization
+		rows[:, 6] -= model * col(dlogqdg[bl] * ug2[bl])
+
+		gram[bl] = np.matmul(rows, np.swapaxes(rows, 1, 2))
+
+	if not jacobian:
+		return chi2
+	return (chi2, gram[:, :7, :7], gram[:, :7, 7])
+
+
+def fastsersic(params, x_array, y_array, jacobian=False):
+	"""
+	Evaluates the EllipSersic2D model, optionally with its analytic Jacobian, for one or several sets of parameters at once.
+
+	The elliptical radius is written without trigonometric functions: with dx = x - x_0, dy = y - y_0 and g = |(g1, g2)|,
+	(r_eff z)^2 = A dx^2 + 2 B dx dy + C dy^2, with A = 1 + f (g - g1), B = -f g2, C = 1 + f (g + g1), and f = 2 / (1 - g)^2.
+	This quadratic form and its derivatives with respect to x_0, y_0, g1 and g2 are all linear combinations
+	of the monomials [1, u, v, u^2, uv, v^2] of the pixel coordinates, and get computed with a single matrix product.
+	Only the derivatives of the Sersic constants b_n and of the flux normalization with respect to n (scalars)
+	are computed numerically.
+
+	:param params: the parameters (flux, r_eff, n, x_0, y_0, g1, g2), as an array of shape (7,) or (m, 7)
+	:param x_array: the x coordinates of the pixels (any shape)
+	:param y_array: idem for y
+
+	:returns: the model, of shape x_array.shape (or (m,) + x_array.shape), and if jacobian is True, (model, jac) where
+		jac has the shape (7,) + x_array.shape (or (m, 7) + x_array.shape).
+	"""
+	params = np.asarray(params, dtype=float)
+	p = params.reshape(-1, 7)
+	(flux, r_eff, n, x_0, y_0, g1, g2) = [p[:, k] for k in range(7)]
+	g = np.hypot(g1, g2)
+	toolarge = g > 0.999 # Beyond, the axis ratio does not make sense
+	if np.any(toolarge):
+		(g1, g2, g) = (np.where(toolarge, g1 * 0.999 / g, g1), np.where(toolarge, g2 * 0.999 / g, g2), np.minimum(g, 0.999))
+
+	# The monomials of the pixel coordinates, relative to the center of the pixels to limit rounding errors
+	(x, y) = (np.ravel(x_array).astype(float), np.ravel(y_array).astype(float))
+	(cx, cy) = (0.5 * (np.min(x) + np.max(x)), 0.5 * (np.min(y) + np.max(y))) if x.size > 0 else (0.0, 0.0)
+	(u, v) = (x - cx, y - cy)
+	monomials = np.stack([np.ones_like(u), u, v, u*u, u*v, v*v])
+	(xc, yc) = (x_0 - cx, y_0 - cy)
+
+	f = 2.0 / (1.0 - g)**2
+	(a, b, c) = (1.0 + f * (g - g1), -f * g2, 1.0 + f * (g + g1))
+	forms = [_quadraticform(a, b, c, xc, yc)] # Coefficients of (r_eff z)^2, followed by its derivatives if needed
+	if jacobian:
+		with np.errstate(divide="ignore", invalid="ignore"):
+			(ug1, ug2) = (np.where(g > 0.0, g1 / g, 0.0), np.where(g > 0.0, g2 / g, 0.0))
+		fp = 4.0 / (1.0 - g)**3 # df/dg
+		forms.append(np.stack([2.0 * (a * xc + b * yc), -2.0 * a, -2.0 * b, 0*a, 0*a, 0*a], axis=1)) # d/dx_0
+		forms.append(np.stack([2.0 * (b * xc + c * yc), -2.0 * b, -2.0 * c, 0*a, 0*a, 0*a], axis=1)) # d/dy_0
+		forms.append(_quadraticform(fp * ug1 * (g - g1) + f * (ug1 - 1.0), -fp * ug1 * g2, fp * ug1 * (g + g1) + f * (ug1 + 1.0), xc, yc)) # d/dg1
+		forms.append(_quadraticform(fp * ug2 * (g - g1) + f * ug2, -fp * ug2 * g2 - f, fp * ug2 * (g + g1) + f * ug2, xc, yc)) # d/dg2
+	forms = np.dot(np.concatenate(forms, axis=1).reshape(-1, 6), monomials).reshape(len(p), len(forms), x.size) # one product, (m, 1 or 5, npix)
+
+	rz2 = np.maximum(forms[:, 0], 1.0e-12) # (r_eff z)^2, avoiding the singularity at the center
+	(flux, r_eff, n) = (flux[:, np.newaxis], r_eff[:, np.newaxis], n[:, np.newaxis])
+	logz2 = np.log(rz2) - 2.0 * np.log(r_eff)
+	w = np.exp((0.5 / n) * logz2) # z^(1/n)
+
+	(bn, logk) = _sersicconstants(n)
+	logq = np.log((1.0 - g) / (1.0 + g))[:, np.newaxis]
+	profile = np.exp(-bn * (w - 1.0) - (logk + np.log(2.0 * np.pi) + 2.0 * np.log(r_eff) + logq)) # for a flux of 1
+	model = flux * profile
+
+	outshape = params.shape[:-1] + np.shape(x_array)
+	if not jacobian:
+		return model.reshape(outshape)
+
+	h = 1.0e-5 * n
+	(bnp, logkp) = _sersicconstants(n + h)
+	(bnm, logkm) = _sersicconstants(n - h)
+	(dbndn, dlogkdn) = ((bnp - bnm) / (2.0 * h), (logkp - logkm) / (2.0 * h))
+	dlogqdg = -2.0 / (1.0 - g*g)
+
+	bnw = bn * w
+	jac = np.empty((len(p), 7, x.size))
+	jac[:, 0] = profile
+	np.multiply(model, (bnw / n - 2.0) / r_eff, out=jac[:, 1])
+	np.multiply(model, bnw * logz2 * (0.5 / n**2) - dbndn * (w - 1.0) - dlogkdn, out=jac[:, 2])
+	np.multiply((model * (-0.5 / n) * bnw / rz2)[:, np.newaxis], forms[:, 1:], out=jac[:, 3:]) # via d model / d (r_eff z)^2
+	jac[:, 5:] -= (dlogqdg * np.stack([ug1, ug2], axis=1).T).T[:, :, np.newaxis] * model[:, np.newaxis] # from the normalization
+
+	return (model.reshape(outshape), jac.reshape(params.shape[:-1] + (7,) + np.shape(x_array)))
+
+
+def _quadraticform(a, b, c, xc, yc):
+	"""
+	The coefficients of a (u - xc)^2 + 2 b (u - xc)(v - yc) + c (v - yc)^2 on the monomials [1, u, v, u^2, uv, v^2], shape (m, 6).
+	"""
+	return np.stack([a * xc**2 + 2.0 * b * xc * yc + c * yc**2, -2.0 * (a * xc + b * yc), -2.0 * (b * xc + c * yc), a, 2.0 * b, c], axis=1)
+
+
+def _sersicconstants(n):
+	"""
+	Returns b_n and the log of the flux normalization n exp(b_n) b_n^(-2n) Gamma(2n) of EllipSersic2D.
+	"""
+	bn = gammaincinv(2.0*n, 0.5)
+	return (bn, np.log(n) + bn - 2.0 * n * np.log(bn) + gammaln(2.0*n))
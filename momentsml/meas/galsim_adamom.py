@@ -4,7 +4,6 @@ Shape measurement with GalSim's adaptive moments (from its "hsm" module).
 
 import numpy as np
 import sys, os
-import copy
 import fitsio
 from datetime import datetime
 
@@ -15,6 +14,7 @@ import astropy.table
 import galsim
 
 from . import utils
+from . import pipeline
 from .. import tools
 
 try:
@@ -23,7 +23,7 @@ except:
         logger.warning("Could not import scipy.ndimage, adamom_size not available")
 
 
-def measfct(catalog, runon="img", stampsize=None, weight=False, **kwargs):
+def measfct(catalog, runon="img", stampsize=None, weight=False, persource=False, **kwargs):
         """
         This is a wrapper around galsim_adamom that meets the requirements of a MomentsML-conform shape measurement function, namely
         to take only one catalog (astropy table) object containing -- or link to -- all the required data.
@@ -37,6 +37,9 @@ def measfct(catalog, runon="img", stampsize=None, weight=False, **kwargs):
         :param runon: "img" or "psf" or other ImageInfo names to run on.
         :param weight: a boolean to activate reaserch of weight fit or header (used by old sextractor version)
         :type weight: boolean
+        :param persource: only used if weight is True. If False, the weight of each stamp selects the pixels belonging to any
+                of the sources of the catalog (according to the segmentation map). If True, it only selects the pixels of the source itself.
+        :type persource: boolean
         :param kwargs: keyword arguments that will be passed to the lower-level measure() function.
                 These set parameters of the shape measurement, but they do not pass any data.
                 Do not try to specify "img" or "xname" here, it will fail! Set the catalog's meta["img"] instead.
@@ -49,15 +52,13 @@ def measfct(catalog, runon="img", stampsize=None, weight=False, **kwargs):
         
         # We load the image:
         img = catalog.meta[runon].load()
-        # We load the weight image
+        # We prepare the weights from the segmentation map
         if weight:
                 img_filepath=catalog.meta[runon].filepath
                 segmap_img=img_filepath.replace(".fits","_seg.fits")
                 data_seg=fitsio.read(segmap_img) 
-                seg_indx= np.array([data_seg[int(j),int(i)] for i,j in zip(catalog["x"],catalog["y"])])
-                a=[ (data_seg==seg_indx[i]) for i in range(len(seg_indx))]
-                mask=np.where(np.bitwise_or.reduce(a), 1, 0)
-                wght=galsim.Image(mask, xmin=0,ymin=0)
+                seg_indx=data_seg[np.asarray(catalog["y"]).astype(int), np.asarray(catalog["x"]).astype(int)]
+                wght=SegWeights(data_seg, seg_indx, persource=persource)
         else:
                 wght=None
                 
@@ -66,11 +67,61 @@ def measfct(catalog, runon="img", stampsize=None, weight=False, **kwargs):
         return measure(img, catalog, xname=catalog.meta[runon].xname, yname=catalog.meta[runon].yname, stampsize=stampsize, wght=wght, **kwargs)
 
 
-def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="adamom_", variant="default", size=False, wght=None):
+def _getguess(catalog, spec):
+        """
+        Returns the values of a warm start specification (a column name of catalog, or an array) as a float array,
+        with nan for masked values.
+        """
+        if spec is None:
+                return None
+        if isinstance(spec, str):
+                return np.ma.filled(np.ma.array(catalog[spec], dtype=float), np.nan)
+        return np.array(spec, dtype=float)
+
+
+class SegWeights():
+        """
+        Weights for FindAdaptiveMom derived from a segmentation map, built lazily for each stamp.
+        Instead of building a full-image mask (or one per source), we use a lookup table indexed by the segmentation ids,
+        which is evaluated only on the pixels of each stamp. The cost is then similar to the one of extracting the stamps.
+        """
+
+        def __init__(self, segmap, segids, persource=False):
+                """
+                :param segmap: the segmentation map, as numpy array (in numpy orientation, with origin 0)
+                :param segids: the segmentation ids of the sources, in catalog order
+                :param persource: if True, the weight of source i only selects the pixels with id segids[i].
+                        Otherwise, it selects all pixels belonging to any of the segids.
+                """
+                self.segimg = galsim.Image(np.ascontiguousarray(segmap, dtype=np.int32), xmin=0, ymin=0)
+                self.segids = np.asarray(segids, dtype=int)
+                self.persource = persource
+                
+                # The lookup table: lut[id] is 1 if the pixels with this id are selected
+                self.lut = np.zeros(max(np.max(segmap), np.max(self.segids)) + 1, dtype=np.int32)
+                self.lut[self.segids] = 1
+
+        def getstamp(self, i, x, y, stampsize):
+                """
+                Returns a tuple (weight stamp, flag) for source i, "centered" at (x, y), as tools.image.getstamp does.
+                """
+                (segstamp, flag) = tools.image.getstamp(x, y, self.segimg, stampsize)
+                if flag != 0:
+                        return (None, flag)
+                if self.persource:
+                        weights = (segstamp.array == self.segids[i]).astype(np.int32)
+                else:
+                        weights = self.lut[segstamp.array]
+                return (galsim.Image(weights, xmin=segstamp.xmin, ymin=segstamp.ymin), 0)
+
+
+def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="adamom_", variant="default", size=False, wght=None,
+        guesssig=None, guesssigfactor=1.0, guesscentroid=None, priorcat=None, niter=False):
         """
         Use the pixel positions provided via the 'catalog' input table to extract
         postage stamps from the image and measure their shape parameters.
         Returns a copy of your input catalog with the new (masked) columns appended.
+        If catalog is a meas.pipeline.Pipeline, the new columns are appended to it instead, and the Pipeline is returned.
         One of these colums (the only one that is not masked) is the flag:
         
         * 0: OK
@@ -88,7 +139,22 @@ def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="adamom_"
         :param variant: a switch for different variants of parameters for this method. 'default' uses defaults,
                 'wider' starts failed default-measurements again with a larger sigma and more iterations.
         :type variant: string
+        :param wght: optional weights for the HSM, either as an integer galsim image with the geometry of img,
+                or as a SegWeights object, which builds the weight stamps on the fly.
+        :param guesssig: optional warm start for the HSM: the initial guess of the size sigma (in pixels) for each galaxy, instead of
+                GalSim's default. Give either a column name (e.g., "adamom_sigma" of a previous realization, or "tru_rad") or an array.
+                Masked, non-finite or non-positive values fall back to GalSim's default guess.
+        :param guesssigfactor: the guesssig values get multiplied by this factor (e.g., to convert a half-light radius into a sigma).
+        :param guesscentroid: optional warm start for the centroid, as a tuple of two column names (e.g., ("adamom_x", "adamom_y"))
+                or of two arrays, in the same convention as the output adamom_x and adamom_y.
+        :param priorcat: if given, the column names of guesssig and guesscentroid are read from this table (e.g., the output of
+                a previous measurement on another realization of the same catalog) instead of from catalog. It must have the same rows.
+                It can also be given as the path to a pickled catalog, which is handy in the measfctkwargs of meas.run.general.
         
+        :param niter: if True, the number of iterations of each successful HSM fit is written in the column niter, so that the effect
+                of the warm start can be measured. This column is off by default, as it differs between realizations of a catalog.
+        
+        The "wider" variant retries failed fits without the warm start.
         
         :returns: masked astropy table
         
@@ -105,86 +171,120 @@ def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="adamom_"
         else: flag_wght=False
         logger.info("Starting measurements on %ix%i stamps, with variant='%s' %s " % (stampsize, stampsize, variant, "and weights"*flag_wght))
         
-        # We prepare an output table with all the required columns
-        output = astropy.table.Table(copy.deepcopy(catalog), masked=True) # Convert the table to a masked table
-        # A bit strange: reading the doc I feel that this conversion is not needed.
-        # But without it, it just doesn't result in a masked table once the masked columns are appended.
-
-        output.add_columns([
-                astropy.table.Column(name=prefix+"flag", data=np.zeros(len(output), dtype=int)), # We will always have a flag
-                astropy.table.MaskedColumn(name=prefix+"flux", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"x", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"y", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"g1", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"g2", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"sigma", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"rho4", dtype=float, length=len(output)),
-                astropy.table.MaskedColumn(name=prefix+"size", dtype=float, length=len(output))
-        ])
-        
-        # We want to mask all these entries. They will get unmasked when values will be attributed.
-        for col in ["flux", "x", "y", "g1", "g2", "sigma", "rho4"]:
-                output[prefix+col].mask = [True] * len(output) # "True" means masked !
-                
-        n = len(output)
+        n = len(catalog)
+        
+        # The results go into preallocated numpy arrays, which get attached as columns to the output only once at the end.
+        # All values are masked (True), they get unmasked when values will be attributed. The flag and size are not masked.
+        flags = np.zeros(n, dtype=int) # We will always have a flag
+        sizes = np.zeros(n, dtype=float)
+        resnames = ["flux", "x", "y", "g1", "g2", "sigma", "rho4"]
+        resarrays = np.zeros((len(resnames), n), dtype=float)
+        resmask = np.ones(n, dtype=bool) # A single mask is enough, these values are all set together.
+        (fluxes, xs, ys, g1s, g2s, sigmas, rho4s) = resarrays
+        
+        niters = np.zeros(n, dtype=int)
+        nretries = 0
+        
+        # Reading the positions once, as plain arrays:
+        catxs = np.asarray(catalog[xname], dtype=float)
+        catys = np.asarray(catalog[yname], dtype=float)
+        
+        # And the optional warm start values, as arrays with nan for "no guess":
+        if priorcat is None:
+                priorcat = catalog
+        elif isinstance(priorcat, str):
+                priorcat = tools.io.readpickle(priorcat)
+        if len(priorcat) != n:
+                raise RuntimeError("The priorcat has %i rows, but the catalog has %i" % (len(priorcat), n))
+        guesssigs = _getguess(priorcat, guesssig)
+        if guesssigs is not None:
+                guesssigs = guesssigs * guesssigfactor
+                guesssigs[np.logical_not(guesssigs > 0.0)] = np.nan
+                logger.info("Using a warm start for sigma for %i galaxies" % (np.sum(np.isfinite(guesssigs))))
+        if guesscentroid is not None:
+                guessxs = _getguess(priorcat, guesscentroid[0])
+                guessys = _getguess(priorcat, guesscentroid[1])
+                logger.info("Using a warm start for the centroid for %i galaxies" % (np.sum(np.isfinite(guessxs + guessys))))
+        
+        # To report where the time goes:
+        stamptime = 0.0
+        hsmtime = 0.0
         
         # And loop
-        for gal in output:
+        for i in range(n):
                 
                 # Some simplistic progress indication:
-                if gal.index%5000 == 0:
-                        logger.info("%6.2f%% done (%i/%i) " % (100.0*float(gal.index)/float(n), gal.index, n))
+                if i%5000 == 0:
+                        logger.info("%6.2f%% done (%i/%i) " % (100.0*float(i)/float(n), i, n))
                 
-                (x, y) = (gal[xname], gal[yname])
+                t0 = datetime.now()
+                (x, y) = (catxs[i], catys[i])
                 (gps, flag) = tools.image.getstamp(x, y, img, stampsize)
-                if wght is not None:
+                if isinstance(wght, SegWeights):
+                        (gps_w, flag_w)=wght.getstamp(i, x, y, stampsize)
+                elif wght is not None:
                         (gps_w, flag_w)=tools.image.getstamp(x, y, wght, stampsize)
                 else:
                         gps_w=None
+                t1 = datetime.now()
+                stamptime += (t1 - t0).total_seconds()
                         
                 if flag != 0:
-                        logger.debug("Galaxy not fully within image:\n %s" % (str(gal)))
-                        gal[prefix+"flag"] = flag
+                        logger.debug("Galaxy %i at (%.2f, %.2f) not fully within image" % (i, x, y))
+                        flags[i] = flag
                         # We can't do anything, and we just skip this galaxy.
                         continue
                                 
+                # The warm start, if available for this galaxy:
+                guesskwargs = {}
+                if guesssigs is not None and np.isfinite(guesssigs[i]):
+                        guesskwargs["guess_sig"] = guesssigs[i]
+                if guesscentroid is not None and np.isfinite(guessxs[i]) and np.isfinite(guessys[i]):
+                        guesskwargs["guess_centroid"] = galsim.PositionD(guessxs[i] - 1.0, guessys[i] - 1.0) # See the +1.0 below
+                
                 # And now we measure the moments... galsim may fail from time to time, hence the try:
                 if variant == "default":
                         try: # We simply try defaults:
-                                res = galsim.hsm.FindAdaptiveMom(gps, weight=gps_w)
+                                res = galsim.hsm.FindAdaptiveMom(gps, weight=gps_w, **guesskwargs)
                         except:
                                 # This is awesome, but clutters the output 
-                                #logger.exception("GalSim failed on: %s" % (str(gal)))
+                                #logger.exception("GalSim failed on galaxy %i at (%.2f, %.2f)" % (i, x, y))
                                 # So instead of logging this as an exception, we use debug, but include the traceback :
-                                logger.debug("HSM with default settings failed on:\n %s" % (str(gal)), exc_info = True)        
-                                gal[prefix + "flag"] = 3        
+                                logger.debug("HSM with default settings failed on galaxy %i at (%.2f, %.2f)" % (i, x, y), exc_info = True)        
+                                flags[i] = 3        
+                                hsmtime += (datetime.now() - t1).total_seconds()
                                 continue # skip to next stamp !
                 
                 elif variant == "wider":
 
                         try:
                                 try: # First we try defaults:
-                                        res = galsim.hsm.FindAdaptiveMom(gps, weight=gps_w)
+                                        res = galsim.hsm.FindAdaptiveMom(gps, weight=gps_w, **guesskwargs)
                                 except: # We change a bit the settings:
                                         logger.debug("HSM defaults failed, retrying with larger sigma...")
+                                        nretries += 1
                                         hsmparams = galsim.hsm.HSMParams(max_mom2_iter=1000)
                                         res = galsim.hsm.FindAdaptiveMom(gps, guess_sig=15.0, hsmparams=hsmparams, weight=gps_w)                        
 
                         except: # If this also fails, we give up:
-                                logger.debug("Even the retry failed on:\n %s" % (str(gal)), exc_info = True)        
-                                gal[prefix + "flag"] = 3        
+                                logger.debug("Even the retry failed on galaxy %i at (%.2f, %.2f)" % (i, x, y), exc_info = True)        
+                                flags[i] = 3        
+                                hsmtime += (datetime.now() - t1).total_seconds()
                                 continue
                 
                 else:
                         raise RuntimeError("Unknown variant setting '{variant}'!".format(variant=variant))
+                hsmtime += (datetime.now() - t1).total_seconds()
         
-                gal[prefix+"flux"] = res.moments_amp
-                gal[prefix+"x"] = res.moments_centroid.x + 1.0 # Not fully clear why this +1 is needed. Maybe it's the setOrigin(0, 0).
-                gal[prefix+"y"] = res.moments_centroid.y + 1.0 # But I would expect that GalSim would internally keep track of these origin issues.
-                gal[prefix+"g1"] = res.observed_shape.g1
-                gal[prefix+"g2"] = res.observed_shape.g2
-                gal[prefix+"sigma"] = res.moments_sigma
-                gal[prefix+"rho4"] = res.moments_rho4
+                fluxes[i] = res.moments_amp
+                xs[i] = res.moments_centroid.x + 1.0 # Not fully clear why this +1 is needed. Maybe it's the setOrigin(0, 0).
+                ys[i] = res.moments_centroid.y + 1.0 # But I would expect that GalSim would internally keep track of these origin issues.
+                g1s[i] = res.observed_shape.g1
+                g2s[i] = res.observed_shape.g2
+                sigmas[i] = res.moments_sigma
+                rho4s[i] = res.moments_rho4
+                niters[i] = res.moments_n_iter
+                resmask[i] = False
 
                 if size:
                         imgstamp = gps.array
@@ -218,34 +318,45 @@ def measure(img, catalog, xname="x", yname="y", stampsize=None, prefix="adamom_"
                                 #print F.sum()
                                 #print F.sum() / res.moments_amp
                                 
-                                fact = gal["adamom_flux"] - F.sum()
+                                fact = fluxes[i] - F.sum()
                                 
                                 err = np.abs(F.sum() - res.moments_amp) / res.moments_amp
                                 ccc += 1
                                 
-                        gal[prefix+"size"] = a * b * np.pi
+                        sizes[i] = a * b * np.pi
                         #plt.figure()
                         #plt.imshow(ellipse * imgstamp, extent=(dx[0], dx[-1], dy[0], dy[-1]), origin="lower", interpolation="None")
                         #plt.show()
 
-                else:
-                        gal[prefix+"size"] = 0.
-
                 # If we made it to this point, we check that the centroid is roughly ok:
-                if np.hypot(x - gal[prefix+"x"], y - gal[prefix+"y"]) > 10.0:
-                        gal[prefix + "flag"] = 2
+                if np.hypot(x - xs[i], y - ys[i]) > 10.0:
+                        flags[i] = 2
                         
-                if gal[prefix+"flux"] < 0 and gal[prefix + "flag"] > 0:
+                if fluxes[i] < 0 and flags[i] > 0:
                         # The centroid checking is rough
-                        gal[prefix + "flag"] = 4
+                        flags[i] = 4
                 
-
+        # We attach all the new columns in one go
+        newcols = [astropy.table.Column(name=prefix+"flag", data=flags)]
+        for (resname, resarray) in zip(resnames, resarrays):
+                newcols.append(astropy.table.MaskedColumn(name=prefix+resname, data=resarray, mask=resmask.copy()))
+        newcols.append(astropy.table.MaskedColumn(name=prefix+"size", data=sizes))
+        if niter:
+                newcols.append(astropy.table.MaskedColumn(name=prefix+"niter", data=niters, mask=resmask.copy()))
+        output = pipeline.addcolumns(catalog, newcols)
+        
         endtime = datetime.now()        
         logger.info("All done")
 
-        nfailed = np.sum(output[prefix+"flag"] > 0)
+        nfailed = np.sum(flags > 0)
         
         logger.info("I failed on %i out of %i sources (%.1f percent)" % (nfailed, n, 100.0*float(nfailed)/float(n)))
-        logger.info("This measurement took %.3f ms per galaxy" % (1e3*(endtime - starttime).total_seconds() / float(n)))
+        if np.sum(~resmask) > 0:
+                logger.info("The HSM fits took %.2f iterations on average%s" % (np.mean(niters[~resmask]),
+                        (", and %i fits were retried" % nretries) * (variant == "wider")))
+        totaltime = (endtime - starttime).total_seconds()
+        logger.info("This measurement took %.3f ms per galaxy" % (1e3*totaltime / float(n)))
+        logger.info("Per galaxy: %.3f ms of stamp extraction, %.3f ms of HSM, %.3f ms of bookkeeping" % \
+                (1e3*stamptime / float(n), 1e3*hsmtime / float(n), 1e3*(totaltime - stamptime - hsmtime) / float(n)))
 
         return output
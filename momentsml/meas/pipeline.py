@@ -0,0 +1,146 @@
+"""
+A container to chain measfcts on a catalog without copying the catalog at every step.
+
+Traditionally, each measfct returns a masked deep copy of its input catalog with its new columns appended.
+Chaining for instance galsim_adamom, adamom_calc, skystats and snr therefore copies the full catalog four times.
+A Pipeline instead keeps the input catalog untouched and collects the new columns of each step.
+The output table gets materialized only once, by the table() method.
+
+The measfcts of momentsml.meas accept both a catalog and a Pipeline: they use addcolumns() to return their results.
+Any other (legacy) measfct can be used in a pipeline through the Adapter class.
+
+Typical use (this is what meas.run.general does with pipeline=True)::
+
+	pipe = Pipeline(catalog)
+	pipe = galsim_adamom.measfct(pipe, stampsize=64)
+	pipe = adamom_calc.measfct(pipe)
+	pipe = Adapter(mylegacymeasfct)(pipe)
+	output = pipe.table()
+
+"""
+
+import collections
+
+import astropy.table
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Pipeline():
+	"""
+	Holds an input catalog (which is not modified, nor copied) and the new columns that measfcts append to it.
+	It offers the small part of the astropy Table interface that measfcts need to read their inputs:
+	meta, colnames, len() and column access by name.
+	"""
+
+	def __init__(self, catalog):
+		"""
+		:param catalog: the input astropy table
+		"""
+		self.catalog = catalog
+		self.newcols = collections.OrderedDict() # name -> astropy Column or MaskedColumn
+
+	def __str__(self):
+		return "Pipeline on %i rows, with %i new columns (%s)" % (len(self), len(self.newcols), ", ".join(self.newcols.keys()))
+
+	def __len__(self):
+		return len(self.catalog)
+
+	@property
+	def meta(self):
+		return self.catalog.meta
+
+	@property
+	def colnames(self):
+		return self.catalog.colnames + [name for name in self.newcols.keys() if name not in self.catalog.colnames]
+
+	def __getitem__(self, name):
+		"""
+		Returns the column with the given name, be it a new column or a column of the input catalog.
+		"""
+		if name in self.newcols:
+			return self.newcols[name]
+		elif name in self.catalog.colnames:
+			return self.catalog[name]
+		else:
+			raise KeyError("Column '%s' is neither in the catalog nor among the new columns" % (name))
+
+	def addcolumns(self, cols):
+		"""
+		Appends new columns to the pipeline (without copying them).
+		As for traditional measfcts, a column with the name of an existing column replaces it in the output.
+
+		:param cols: list of astropy Column or MaskedColumn objects, with names, and of the length of the catalog
+		"""
+		for col in cols:
+			if len(col) != len(self):
+				raise RuntimeError("Column '%s' has length %i, expected %i" % (col.name, len(col), len(self)))
+			self.newcols[col.name] = col
+
+	def table(self):
+		"""
+		Returns the output table: a masked deep copy of the input catalog, with all the new columns appended.
+		This is what the chain of traditional measfcts would have returned, but with only one copy.
+		"""
+		return _withcolumns(self.catalog, list(self.newcols.values()))
+
+
+
+def addcolumns(catalog, cols):
+	"""
+	The function to be used by measfcts to return their new columns, so that they work both on catalogs and Pipelines.
+
+	:param catalog: the input catalog or Pipeline that was passed to the measfct
+	:param cols: list of new astropy Column or MaskedColumn objects
+
+	:returns: if catalog is a Pipeline, the columns are appended to it, and the Pipeline is returned.
+		Otherwise, a masked deep copy of catalog with the new columns appended (the traditional output of measfcts).
+		In both cases, columns that already exist get replaced.
+	"""
+	if isinstance(catalog, Pipeline):
+		catalog.addcolumns(cols)
+		return catalog
+	else:
+		return _withcolumns(catalog, cols)
+
+
+def _withcolumns(catalog, cols):
+	"""
+	Returns a masked copy of the catalog (data and meta), with the cols appended, replacing the existing columns of the same names.
+	The output table is built in one go: copying the catalog and then appending columns would copy the data twice,
+	and converting a copy into a masked table once more.
+	"""
+	newcols = collections.OrderedDict([(col.name, col) for col in cols])
+	allcols = [newcols.pop(name, catalog[name]) for name in catalog.colnames] + list(newcols.values())
+	return astropy.table.Table(allcols, masked=True, copy=True, meta=catalog.meta)
+
+
+
+class Adapter():
+	"""
+	Wraps a traditional measfct (that takes and returns a catalog), so that it can also be used on a Pipeline.
+	When called on a Pipeline, the current table gets materialized and passed to the measfct, and the columns
+	that the measfct has added are appended to the Pipeline. Changes to existing columns are ignored.
+	When called on a catalog, the measfct is simply called.
+	This is a class (and not a closure) so that adapted measfcts can be pickled by multiprocessing.
+	"""
+
+	def __init__(self, measfct):
+		self.measfct = measfct
+
+	def __str__(self):
+		return "Adapter(%s)" % (getattr(self.measfct, "__name__", str(self.measfct)))
+
+	def __call__(self, catalog, **kwargs):
+
+		if not isinstance(catalog, Pipeline):
+			return self.measfct(catalog, **kwargs)
+
+		incat = catalog.table()
+		output = self.measfct(incat, **kwargs)
+		if len(output) != len(catalog):
+			raise RuntimeError("The measfct %s changed the number of rows, it cannot be used in a Pipeline" % (self))
+
+		catalog.addcolumns([output[name] for name in output.colnames if name not in incat.colnames])
+		return catalog
@@ -12,8 +12,8 @@ The approach taken by general() is the following:
 - make a list of _WorkerSetting objects, each of them describing the elementary task of
   measuring shapes on one single image.
 - feed this list into _run(), which takes care of running the measurements.
-  We use the simple multiprocessing.Pool to distribute the work on several cpus.
-  This seems easier than implementing a pool-like queue ourself.
+  We use tools.pool.run to distribute the work on several cpus: it hands out the images one by one
+  (largest first) to a multiprocessing.Pool, and reports the progress while they complete.
 
   
 """
@@ -30,13 +30,15 @@ import os
 
 from .. import tools
 from . import sex
+from . import pipeline
 
 import logging
 logger = logging.getLogger(__name__)
 ###########################
 ### RUN MEASURES ON SIM ###
 ###########################
-def onsims(simdir, simparams, measdir, measfct, measfctkwargs, ncpu=1, skipdone=True):
+def onsims(simdir, simparams, measdir, measfct, measfctkwargs, ncpu=1, skipdone=True, usepipeline=False, imgcachemb=None, maxtasksperchild=None, progressfilepath=None,
+	maxattempts=1, quarantinefilepath=None, onlyfailed=False, uselease=False, leaseexpiry=3600.0):
 	"""
 	Run the given measfct on sims created by sim.run.multi() for this simdir and simparams.
 	This explores the simdir for potential images, and passes them to general().
@@ -72,27 +74,46 @@ def onsims(simdir, simparams, measdir, measfct, measfctkwargs, ncpu=1, skipdone=
 	if not os.path.exists(measworkdir):
 		os.makedirs(measworkdir)
 	
+	# The sim.run.multi manifest tells us the realizations of (most) catalogs without reading them.
+	# Catalogs missing from it (e.g., made before manifests existed) are read.
+	simmanifestfilepath = tools.manifest.getpath(simworkdir)
+	simmanifest = tools.manifest.read(simmanifestfilepath) if os.path.exists(simmanifestfilepath) else {}
+	
+	# We record our measurements in a manifest of the measdir (see meas.utils.simmeasdict). Existing measurement catalogs
+	# that are not yet in there (made before manifests existed, or by general() directly) get recorded now.
+	measmanifestfilepath = tools.manifest.getpath(measworkdir)
+	measmanifest = tools.manifest.read(measmanifestfilepath) if os.path.exists(measmanifestfilepath) else {}
+	
 	# The input lists for general():
 	genincatfilepaths = [] # This is not incatfilepaths! The same catalogs will appear multiple times in here.
 	genoutcatfilepaths = []
 	genincatmetadicts = [] # Indeed we will have to set meta["img"] to point to the different realizations.
-	
+	genmanifestrecords = []
 	
 	for incatfilepath in incatfilepaths:
 		
-		# We read the catalog
-		incat = tools.io.readpickle(incatfilepath)
+		catname = os.path.basename(incatfilepath).replace("_cat.pkl", "")
+		if catname in simmanifest and "catfilepath" in simmanifest[catname]:
+			# We use the manifest (the realizations that are not "done" do not exist, or are being drawn):
+			imgreas = simmanifest[catname]["imgreas"]
+			drawn = [simmanifest[catname]["status"][reaindex] == "done" for reaindex in range(len(imgreas))]
+		else:
+			# We read the catalog, and check which of its "declared" realizations exist:
+			imgreas = tools.io.readpickle(incatfilepath).meta["imgreas"]
+			drawn = [os.path.exists(imgrea.filepath) for imgrea in imgreas]
 		
 		# And loop over the "declared" realization ImageInfo objects:
-		for imgrea in incat.meta["imgreas"]:
+		for (reaindex, (imgrea, isdrawn)) in enumerate(zip(imgreas, drawn)):
 			
 			# Let's check that the declared image file does exist:
-			if not os.path.exists(imgrea.filepath):
+			if not isdrawn:
 				logger.warning("Could not find image realization '%s', will skip it" % (imgrea.filepath))
 				continue
 			
 			# If everything seems ok, we prepare the entries for general for this realization
 			outcatfilepath = os.path.join(measdir, simparams.name, imgrea.name + "_meascat.pkl")
+			if measmanifest.get(catname, {}).get("status", {}).get(reaindex, None) != "done" and os.path.exists(outcatfilepath):
+				tools.manifest.addrea(measmanifestfilepath, catname, reaindex, "done", filepath=outcatfilepath)
 			
 			# Now the ImageInfo object for meta["img"]. We make a new object, based on the
 			# info for this realization, and add a workdir (in case measfct uses it).
@@ -105,16 +126,21 @@ def onsims(simdir, simparams, measdir, measfct, measfctkwargs, ncpu=1, skipdone=
 			genincatfilepaths.append(incatfilepath)
 			genoutcatfilepaths.append(outcatfilepath)
 			genincatmetadicts.append({"img":imageinfo})
+			genmanifestrecords.append((measmanifestfilepath, catname, reaindex))
 				
 	
 	# And we pass the ball to general():
 	general(genincatfilepaths, genoutcatfilepaths, measfct, measfctkwargs,
-		ncpu=ncpu, skipdone=skipdone, incatmetadicts=genincatmetadicts)
+		ncpu=ncpu, skipdone=skipdone, incatmetadicts=genincatmetadicts, usepipeline=usepipeline, imgcachemb=imgcachemb,
+		maxtasksperchild=maxtasksperchild, progressfilepath=progressfilepath,
+		maxattempts=maxattempts, quarantinefilepath=quarantinefilepath, onlyfailed=onlyfailed, uselease=uselease, leaseexpiry=leaseexpiry,
+		manifestrecords=genmanifestrecords)
 	
 
-def general(incatfilepaths, outcatfilepaths, measfct, measfctkwargs, ncpu=1, skipdone=True, incatmetadicts=None):
+def general(incatfilepaths, outcatfilepaths, measfct, measfctkwargs, ncpu=1, skipdone=True, incatmetadicts=None, usepipeline=False, imgcachemb=None, maxtasksperchild=None, progressfilepath=None,
+	maxattempts=1, quarantinefilepath=None, onlyfailed=False, uselease=False, leaseexpiry=3600.0, manifestrecords=None):
 	"""
-	Run the given shape measurement (measfct) on your images using a multiprocessing pool map (ncpu).
+	Run the given shape measurement (measfct) on your images using a multiprocessing pool (ncpu).
 	This measfct must be MomentsML-compliant, i.e. find all the required images by reading the meta of the passed catalog.
 	Note that if you want to run on MomentsML simulations, see the function onsims() above (which calls this function).
 	
@@ -140,12 +166,46 @@ def general(incatfilepaths, outcatfilepaths, measfct, measfctkwargs, ncpu=1, ski
 		This trick is very useful when running over several images of the same incat. Using this trick,
 		you don't have to prepare and write to disk one copy of incat for every image.
 	:type incatmetadicts: list of dicts
+	:param usepipeline: If True, the measfct gets a meas.pipeline.Pipeline wrapping the input catalog, instead of the catalog itself.
+		The catalog is then copied only once, when the output table gets materialized, instead of once per chained measfct.
+		Use this with measfcts that only chain measfcts of momentsml.meas (or legacy ones wrapped with meas.pipeline.Adapter).
+	:type usepipeline: bool
+	:param imgcachemb: If set, each worker process enables an LRU cache of this many MB for the images it loads
+		(see tools.image.setimgcache), so that measfcts loading the same image several times read it only once.
+		The images are then read-only for the measfct.
+	:type imgcachemb: float
+	:param maxtasksperchild: If set, each worker process gets replaced after having measured this many images
+		(see tools.pool.run), to release memory that a measfct might accumulate.
+	:type maxtasksperchild: int
+	:param progressfilepath: If set, path to a JSON file that gets updated with the progress (number of images done,
+		throughput, ETA) each time an image is done, to monitor long runs.
+	:type progressfilepath: str
+	:param maxattempts: Number of times the measurement of an image gets tried before giving up on it.
+		An image that fails does not stop the measurement of the other images.
+	:type maxattempts: int
+	:param quarantinefilepath: If set, the images whose measurement failed get listed in this JSON file
+		(identified by their output catalog path, with the error and traceback, see tools.pool.run).
+		If not set, a RuntimeError is raised once all other images are measured, if any image failed.
+	:type quarantinefilepath: str
+	:param onlyfailed: If True, only the images listed in the quarantinefilepath get measured (again).
+		Note that with skipdone, a simple rerun already processes only the missing or failed images,
+		as no output catalog gets written for failed images. The quarantine file then gets rewritten with the remaining failures.
+	:type onlyfailed: bool
+	:param uselease: If True, each image is measured under a lease file (see tools.lease), next to its output catalog,
+		and only if this output catalog does not exist yet. Use this to let several scripts (or hosts sharing a filesystem)
+		measure the same images at the same time: each image gets measured only once, and the images whose lease is
+		held by another script are waited for.
+	:type uselease: bool
+	:param leaseexpiry: Time in seconds after which the lease of a killed script gets reclaimed.
+	:type leaseexpiry: float
+	:param manifestrecords: If specified, a list (as long as incatfilepaths) of tuples (manifestfilepath, catname, reaindex),
+		used to record each written output catalog in a manifest (see tools.manifest). This is what onsims() uses.
+	:type manifestrecords: list of tuples
 
 
 	.. warning:: If called "in parallel" (e.g., from several python scripts launched at about the same time),
-		(in the worst case) all the work in every script might be run, i.e., skipdone will not work.
-		Not a safety issue (hence currently no fix for this).  We can see if we want a fix for that.
-		(can be done e.g. with temporary files written/detected and deleted by the workers)
+		(in the worst case) all the work in every script might be run, i.e., skipdone will not work,
+		unless uselease is True.
 
 	"""
 	
@@ -159,6 +219,11 @@ def general(incatfilepaths, outcatfilepaths, measfct, measfctkwargs, ncpu=1, ski
 			raise RuntimeError("The list incatmetadicts does not have the same length as incatfilepaths")
 	else: # We turn this None into a list of None:
 		incatmetadicts = [None] * n
+	if manifestrecords is not None:
+		if len(manifestrecords) != n:
+			raise RuntimeError("The list manifestrecords does not have the same length as incatfilepaths")
+	else:
+		manifestrecords = [None] * n
 		
 		
 	# If measfctkwargs is a simple dict, we make a list of identical dicts.
@@ -177,22 +242,38 @@ def general(incatfilepaths, outcatfilepaths, measfct, measfctkwargs, ncpu=1, ski
 	# However, for this we would have to open the incats from the main process, this seems weird.
 	# And so we skip this test.
 	
+	if onlyfailed:
+		if quarantinefilepath is None:
+			raise RuntimeError("onlyfailed requires a quarantinefilepath")
+		failedoutcatfilepaths = set(tools.pool.readquarantine(quarantinefilepath))
+		logger.info("Only running on the %i images listed in '%s'" % (len(failedoutcatfilepaths), quarantinefilepath))
+	
 	# Now we prepare the parallel processing.
 	wslist = [] # The list to be filled with workersettings
 	
-	for (incatfilepath, outcatfilepath, measfctkwargsdict, incatmetadict) in zip(incatfilepaths, outcatfilepaths, measfctkwargslist, incatmetadicts):
+	for (incatfilepath, outcatfilepath, measfctkwargsdict, incatmetadict, manifestrecord) in zip(incatfilepaths, outcatfilepaths, measfctkwargslist, incatmetadicts, manifestrecords):
 			
 		if skipdone and os.path.exists(outcatfilepath):
 			logger.info("Output catalog %s already exists, skipping this one..." % (outcatfilepath))	
 			continue
+		
+		if onlyfailed and outcatfilepath not in failedoutcatfilepaths:
+			continue
 						
-		ws = _WorkerSettings(incatfilepath, outcatfilepath, measfct, measfctkwargsdict, incatmetadict)
+		ws = _WorkerSettings(incatfilepath, outcatfilepath, measfct, measfctkwargsdict, incatmetadict, usepipeline, imgcachemb, manifestrecord)
 		wslist.append(ws)
 	
 	logger.info("Ready to run measurements on %i images." % (len(wslist)))
 			
 	# And we run a pool of workers on this wslist.
-	_run(wslist, ncpu)
+	results = _run(wslist, ncpu, maxtasksperchild=maxtasksperchild, progressfilepath=progressfilepath,
+		maxattempts=maxattempts, quarantinefilepath=quarantinefilepath, uselease=uselease, leaseexpiry=leaseexpiry)
+	
+	# The successful measurements are recorded by the workers, we record the failures:
+	for (ws, result) in zip(wslist, results):
+		if result is None and ws.manifestrecord is not None and not os.path.exists(ws.outcatfilepath):
+			(manifestfilepath, catname, reaindex) = ws.manifestrecord
+			tools.manifest.addrea(manifestfilepath, catname, reaindex, "failed", filepath=ws.outcatfilepath)
 		
 
 class _WorkerSettings():
@@ -200,18 +281,41 @@ class _WorkerSettings():
 	A class that holds together all the settings for measuring an image.
 	"""
 	
-	def __init__(self, incatfilepath, outcatfilepath, measfct, measfctkwargs, incatmetadict):
+	def __init__(self, incatfilepath, outcatfilepath, measfct, measfctkwargs, incatmetadict, usepipeline=False, imgcachemb=None, manifestrecord=None):
 		
 		self.incatfilepath = incatfilepath
 		self.outcatfilepath = outcatfilepath
 		self.measfct = measfct
 		self.measfctkwargs = measfctkwargs
 		self.incatmetadict = incatmetadict
+		self.usepipeline = usepipeline
+		self.imgcachemb = imgcachemb
+		self.manifestrecord = manifestrecord # None, or (manifestfilepath, catname, reaindex)
 	
 	def __str__(self):
 		return "%s" % (os.path.basename(self.incatfilepath))
+	
+	def size(self):
+		"""
+		An estimate of the cost of this task, used to start the largest tasks first: the size of the image file
+		if it is known from the incatmetadict, and otherwise the size of the input catalog file.
+		"""
+		filepath = self.incatfilepath
+		if self.incatmetadict is not None and "img" in self.incatmetadict:
+			filepath = getattr(self.incatmetadict["img"], "filepath", filepath)
+		try:
+			return os.path.getsize(filepath)
+		except OSError:
+			return 0
+
 
 
+def _outcatfilepath(ws):
+	"""
+	Identifies the task of a _WorkerSettings object (for the quarantine and the leases).
+	"""
+	return ws.outcatfilepath
+
 
 def _worker(ws):
 	"""
@@ -230,25 +334,44 @@ def _worker(ws):
 		incat.meta.update(ws.incatmetadict)
 	
 	
+	# The image cache lives as long as the worker process, we enable it only once:
+	if ws.imgcachemb is not None and tools.image.getimgcache() is None:
+		tools.image.setimgcache(ws.imgcachemb)
+	
 	# Run measfct, it will read the image by itself:
 	logger.debug("%s will now run on image %s" % (p.name, incat.meta["img"].name))
-	outcat = ws.measfct(incat, **ws.measfctkwargs)
+	if ws.usepipeline:
+		outcat = ws.measfct(pipeline.Pipeline(incat), **ws.measfctkwargs)
+		if isinstance(outcat, pipeline.Pipeline):
+			outcat = outcat.table()
+	else:
+		outcat = ws.measfct(incat, **ws.measfctkwargs)
+	
+	if tools.image.getimgcache() is not None:
+		tools.image.getimgcache().logstats()
 	
 	# Write output catalog
 	tools.io.writepickle(outcat, ws.outcatfilepath)
+	if ws.manifestrecord is not None:
+		(manifestfilepath, catname, reaindex) = ws.manifestrecord
+		tools.manifest.addrea(manifestfilepath, catname, reaindex, "done", filepath=ws.outcatfilepath)
 
 	endtime = datetime.datetime.now()
 	logger.info("%s is done, it took %s" % (p.name, str(endtime - starttime)))
+	return True
 
 
-def _run(wslist, ncpu):
+def _run(wslist, ncpu, maxtasksperchild=None, progressfilepath=None, maxattempts=1, quarantinefilepath=None, uselease=False, leaseexpiry=3600.0):
 	"""
-	Wrapper around multiprocessing.Pool with some verbosity.
+	Wrapper around tools.pool.run with some verbosity.
+	Returns the list of results (True, or None for failed images and images measured by other runs).
 	"""
 	
 	if len(wslist) == 0: # This test is useful, as pool.map otherwise starts and is a pain to kill.
 		logger.info("No images to measure.")
-		return
+		if quarantinefilepath is not None:
+			tools.pool.writequarantine([], quarantinefilepath) # Nothing failed
+		return []
 
 	# We do not want to see the log from the low-level stuff:
 	mutemodules = ["momentsml.meas.galsim_adamom", "momentsml.meas.sewfunc",
@@ -270,14 +393,11 @@ def _run(wslist, ncpu):
 	
 	logger.info("Starting the measurement on %i images using %i CPUs" % (len(wslist), ncpu))
 	
-	if ncpu == 1: # The single process way (MUCH MUCH EASIER TO DEBUG...)
-		list(map(_worker, wslist))
-	
-	else:
-		pool = multiprocessing.Pool(processes=ncpu)
-		pool.map(_worker, wslist)
-		pool.close()
-		pool.join()
+	# With ncpu == 1, this runs in the current process (MUCH MUCH EASIER TO DEBUG...)
+	results = tools.pool.run(_worker, wslist, ncpu=ncpu, sizes=[ws.size() for ws in wslist],
+		maxtasksperchild=maxtasksperchild, progressfilepath=progressfilepath,
+		maxattempts=maxattempts, quarantinefilepath=quarantinefilepath, taskkey=_outcatfilepath,
+		leasekey=(_outcatfilepath if uselease else None), leaseexpiry=leaseexpiry)
 	
 	endtime = datetime.datetime.now()
 	logger.info("Done, the total measurement time was %s" % (str(endtime - starttime)))
@@ -286,6 +406,8 @@ def _run(wslist, ncpu):
 	#for modulename in mutemodules:
 	#	lowlevellogger = logging.getLogger(modulename)
 	#	lowlevellogger.propagate = True
+	
+	return results
 
 
 ###########################
@@ -4,23 +4,29 @@ A measfct which computes statistics about the sky noise/level, using the edge of
 """
 
 import numpy as np
-import copy
 import astropy.table
 
 import logging
 logger = logging.getLogger(__name__)
 
 from . import utils
+from . import pipeline
 from .. import tools
 
 
-def measfct(cat, runon="img", prefix="", stampsize=None):
+def measfct(cat, runon="img", prefix="", stampsize=None, vectorized=True, chunksize=1000):
 	"""
 	
 	:param runon: "img" or "psf" or ... -- decides on which image this should run.
 		You might want to adjust the prefix accordingly.
 	:param prefix: a prefix for the new column names. By default, no prefix is used.
 	:param stampsize: if None, uses the image's stampsize.
+	:param vectorized: if True and if the sources sit on a grid of stamps (as drawn by sim.stampgrid), all stamps get
+		processed together by a few numpy reductions (see gridstats). Otherwise, or if the sources are not on a grid,
+		each stamp is extracted and processed separately. Both give the same columns.
+	:param chunksize: number of stamps processed together by the vectorized path, to limit the memory usage.
+	
+	cat can also be a meas.pipeline.Pipeline.
 	
 	"""
 
@@ -30,48 +36,105 @@ def measfct(cat, runon="img", prefix="", stampsize=None):
 	# Load the image:
 	img = cat.meta[runon].load()
 	
-	# Prepare the catalog: THIS SHOULD BE REVIEWED ONCE WE ALL ADOPT ASTROPY 1.0 AND A RECENT NUMPY !
-	cat = astropy.table.Table(copy.deepcopy(cat), masked=True) # Convert the table to a masked table
-	# A bit stange: reading the doc I feel that this conversion is not needed.
-	# But without it, it just doesn't result in a masked table once the masked columns are appended.
-
-	cat.add_columns([
-		astropy.table.Column(name=prefix+"skyflag", data=np.zeros(len(cat), dtype=int)), # We will always have a flag
-		astropy.table.MaskedColumn(name=prefix+"skystd", dtype=float, length=len(cat)),
-		astropy.table.MaskedColumn(name=prefix+"skymad", dtype=float, length=len(cat)),
-		astropy.table.MaskedColumn(name=prefix+"skymean", dtype=float, length=len(cat)),
-		astropy.table.MaskedColumn(name=prefix+"skymed", dtype=float, length=len(cat)),
-		astropy.table.MaskedColumn(name=prefix+"skystampsum", dtype=float, length=len(cat)),
-	])
-	for col in ["skystd", "skymad", "skymean", "skymed", "skystampsum"]:
-		cat[prefix+col].mask = [True] * len(cat)
-		
+	n = len(cat)
+	
+	# The results go into numpy arrays, that get attached as columns at the end.
+	# All values are masked (True), they get unmasked when values will be attributed.
+	flags = np.zeros(n, dtype=int) # We will always have a flag
+	statnames = ["std", "mad", "mean", "med", "stampsum"]
+	statarrays = np.zeros((len(statnames), n), dtype=float)
+	statmask = np.ones(n, dtype=bool)
+	
+	xs = np.asarray(cat[cat.meta[runon].xname], dtype=float)
+	ys = np.asarray(cat[cat.meta[runon].yname], dtype=float)
+	
+	done = False
+	if vectorized:
+		try:
+			stats = gridstats(img, cat, stampsize, xname=cat.meta[runon].xname, yname=cat.meta[runon].yname, chunksize=chunksize)
+		except RuntimeError:
+			logger.debug("The sources are not on a grid of stamps, processing the stamps one by one")
+		else:
+			for (j, statname) in enumerate(statnames):
+				statarrays[j] = stats[statname]
+			statmask[:] = False
+			done = True
 	
-	# And now the loop
-	for gal in cat:
+	if not done: # The loop over the stamps
+		for i in range(n):
 		
-		# Some simplistic progress indication:
-		if gal.index%5000 == 0:
-			logger.info("%6.2f%% done (%i/%i) " % (100.0*float(gal.index)/float(len(cat)), gal.index, len(cat)))
+			# Some simplistic progress indication:
+			if i%5000 == 0:
+				logger.info("%6.2f%% done (%i/%i) " % (100.0*float(i)/float(n), i, n))
 		
-		(x, y) = (gal[cat.meta[runon].xname], gal[cat.meta[runon].yname])
-		(gps, flag) = tools.image.getstamp(x, y, img, stampsize)
+			(gps, flag) = tools.image.getstamp(xs[i], ys[i], img, stampsize)
 		
-		if flag != 0:
-			logger.debug("Galaxy not fully within image:\n %s" % (str(gal)))
-			gal[prefix+"skyflag"] = flag
+			if flag != 0:
+				logger.debug("Galaxy %i at (%.2f, %.2f) not fully within image" % (i, xs[i], ys[i]))
+				flags[i] = flag
 		
-		else:
-			out = utils.skystats(gps)
-			gal[prefix + "skystd"] = out["std"]
-			gal[prefix + "skymad"] = out["mad"]
-			gal[prefix + "skymean"] = out["mean"]
-			gal[prefix + "skymed"] = out["med"]
-			gal[prefix + "skystampsum"] = out["stampsum"]
+			else:
+				out = utils.skystats(gps)
+				for (j, statname) in enumerate(statnames):
+					statarrays[j, i] = out[statname]
+				statmask[i] = False
 			
 	
-	nfailed = np.sum(cat[prefix + "skyflag"] > 0)
+	newcols = [astropy.table.Column(name=prefix+"skyflag", data=flags)]
+	for (statname, statarray) in zip(statnames, statarrays):
+		newcols.append(astropy.table.MaskedColumn(name=prefix+"sky"+statname, data=statarray, mask=statmask.copy()))
+	
+	nfailed = np.sum(flags > 0)
 	if nfailed != 0:
-		logger.warning("The stamp extraction failed on %i out of %i sources (%.1f percent)" % (nfailed, len(cat), 100.0*float(nfailed)/float(len(cat))))
+		logger.warning("The stamp extraction failed on %i out of %i sources (%.1f percent)" % (nfailed, n, 100.0*float(nfailed)/float(n)))
+	
+	return pipeline.addcolumns(cat, newcols)
+
+
+
+_edges = {} # stampsize -> (rows, cols) of the edge pixels, in the order of utils.skystats
+
+
+def _getedges(stampsize):
+	"""
+	Returns the row and column indices of the edge pixels of a stamp, cached per stampsize.
+	The order is the one of utils.skystats, so that the statistics are computed on exactly the same sequences of values.
+	"""
+	if stampsize not in _edges:
+		(rows, cols) = np.indices((stampsize, stampsize))
+		edges = [(rows[0,1:], cols[0,1:]), (rows[-1,1:], cols[-1,1:]), (rows[:,0], cols[:,0]), (rows[1:-1,-1], cols[1:-1,-1])]
+		_edges[stampsize] = (np.concatenate([e[0] for e in edges]), np.concatenate([e[1] for e in edges]))
+	return _edges[stampsize]
+
+
+def gridstats(img, catalog, stampsize, xname="x", yname="y", chunksize=1000):
+	"""
+	Computes the statistics of utils.skystats for all the stamps of a gridded image (sim.stampgrid) at once.
+	The edge pixels of the stamps of a chunk get gathered from the zero-copy view of tools.image.getstampgrid()
+	into a (chunksize, 4*(stampsize-1)) array, and each statistic is a single reduction along its rows.
+	For the stamp sums, the stamps of a chunk get copied, so that they are summed in the same order as by utils.skystats.
+	Raises a RuntimeError if the positions are not on the grid.
+	
+	:returns: a dict of arrays (one value per row of the catalog) with the keys of utils.skystats.
+	"""
+	stampsize = int(stampsize)
+	grid = tools.image.getstampgrid(img, stampsize)
+	(ix, iy) = tools.image.getstampindices(catalog, stampsize, xname=xname, yname=yname)
+	if np.any(ix < 0) or np.any(ix >= grid.shape[1]) or np.any(iy < 0) or np.any(iy >= grid.shape[0]):
+		raise RuntimeError("Some positions (%s, %s) are outside of the %i x %i grid" % (xname, yname, grid.shape[1], grid.shape[0]))
+	(rows, cols) = _getedges(stampsize)
+	
+	n = len(ix)
+	stats = dict([(statname, np.zeros(n)) for statname in ["std", "mad", "mean", "med", "stampsum"]])
+	for start in range(0, n, chunksize):
+		(cix, ciy) = (ix[start:start+chunksize], iy[start:start+chunksize])
+		edgepixels = grid[ciy[:, np.newaxis], cix[:, np.newaxis], rows, cols]
+		stats["std"][start:start+chunksize] = np.std(edgepixels, axis=1)
+		stats["mean"][start:start+chunksize] = np.mean(edgepixels, axis=1)
+		med = np.median(edgepixels, axis=1)
+		stats["med"][start:start+chunksize] = med
+		stats["mad"][start:start+chunksize] = 1.4826 * np.median(np.fabs(edgepixels - med[:, np.newaxis]), axis=1)
+		stamps = grid[ciy, cix].reshape(len(cix), stampsize*stampsize) # Contiguous rows: same summation as np.sum on a stamp
+		stats["stampsum"][start:start+chunksize] = np.sum(stamps, axis=1)
 	
-	return cat
+	return stats
@@ -6,7 +6,8 @@ It does not measure the images.
 
 import astropy.table
 import numpy as np
-import copy
+
+from . import pipeline
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,36 +32,35 @@ def measfct(catalog, prefix="", fluxcol="adamom_flux", sigmacol="adamom_sigma",
 	if gain != None and gaincol != None:
 		raise RuntimeError("Please provide either gain or gaincol, not both!")
 		
-	output = astropy.table.Table(copy.deepcopy(catalog), masked=True)
+	# catalog can also be a meas.pipeline.Pipeline, we only read columns from it.
+	col = lambda name: np.ma.array(catalog[name])
 	
 	if gain != None:
 		gain = np.abs(gain)
 		logger.info("Now computing SNR assuming a gain of {0:.2} electrons per ADU.".format(gain))	
-		sourcefluxes = output[fluxcol] * gain
-		skynoisefluxes = (output[stdcol] * gain) ** 2 # per pixel
+		sourcefluxes = col(fluxcol) * gain
+		skynoisefluxes = (col(stdcol) * gain) ** 2 # per pixel
 	
 	elif gaincol != None:
 		logger.info("Now computing SNR using the gain from column '{}'".format(gaincol))	
-		gain = np.abs(output[gaincol])
-		sourcefluxes = output[fluxcol] * gain
-		skynoisefluxes = (output[stdcol] * gain) ** 2 # per pixel
+		gain = np.abs(col(gaincol))
+		sourcefluxes = col(fluxcol) * gain
+		skynoisefluxes = (col(stdcol) * gain) ** 2 # per pixel
 	
 	else:
 		raise RuntimeError("Please provide a gain or gaincol!")
 		
 	
 	if sizecol is None:
-		areas = np.pi * (output[sigmacol] * aper * 1.1774) ** 2 # 1.1774 x sigma = r half light
+		areas = np.pi * (col(sigmacol) * aper * 1.1774) ** 2 # 1.1774 x sigma = r half light
 	else: 
-		areas = output[sizecol]
+		areas = col(sizecol)
 	
 	noises = np.sqrt(sourcefluxes + areas * skynoisefluxes)
 	
 	snrcol = prefix + "snr"
 	
-	output[snrcol] = sourcefluxes / noises
-	
-	return output
+	return pipeline.addcolumns(catalog, [astropy.table.MaskedColumn(name=snrcol, data=sourcefluxes / noises)])
 	
 	
 	
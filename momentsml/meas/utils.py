@@ -8,6 +8,8 @@ import numpy as np
 import galsim
 import astropy
 
+from .. import tools
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -22,7 +24,9 @@ def simmeasdict(measdir, simparams):
 	:param measdir: See :func:`momentsml.meas.run.onsims`
 	:param simparams: idem
 	
-	Regular expressions are used for this to avoid making optimistic assumptions about these filenames.
+	If the measdir contains the manifest written by :func:`momentsml.meas.run.onsims` (see :mod:`momentsml.tools.manifest`),
+	the measurement catalogs recorded as done in there are returned, without listing the directory.
+	Otherwise, regular expressions are used to avoid making optimistic assumptions about the filenames.
 	A dict is returned whose keys are the simulated catalog names, and the corresponding entries
 	are lists of filenames of the pkls with the measurements on the different realizations for each catalog. 
 	
@@ -40,6 +44,22 @@ def simmeasdict(measdir, simparams):
 
 	"""
 	
+	manifestfilepath = tools.manifest.getpath(os.path.join(measdir, simparams.name))
+	if os.path.exists(manifestfilepath):
+		manifest = tools.manifest.read(manifestfilepath)
+		out = {}
+		for catname in sorted(manifest.keys()): # Same order as with the regular expressions below
+			entry = manifest[catname]
+			filenames = [os.path.basename(entry["filepaths"][reaindex]) for (reaindex, status) in entry["status"].items() if status == "done"]
+			if len(filenames) > 0:
+				out[catname] = sorted(filenames)
+		if len(out) == 0:
+			raise RuntimeError("No meascat found in manifest %s" % (manifestfilepath))
+		nrea = sum([len(filenames) for filenames in out.values()])
+		logger.info("Found %i catalogs, and %i realizations (%.1f per catalog, on average) in the manifest" %
+			(len(out), nrea, float(nrea)/float(len(out))))
+		return out
+	
 	incatfilepaths = sorted(glob.glob(os.path.join(measdir, simparams.name, "*_galimg_meascat.pkl")))
 	basenames = map(os.path.basename, incatfilepaths)
 	
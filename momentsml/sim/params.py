@@ -128,3 +128,22 @@ class Params:
 			"tru_psf_g2" : tru_psf_g2
 		}
 
+
+	def draw_batch(self, ix, iy, nx, ny):
+		"""
+		Optional vectorized version of draw(), to be redefined if you want fast catalog creation.
+		It gets called only *once* per catalog, with the indices of all the truly different galaxies.
+
+		:param ix: numpy array of x indices, going from 0 to nx-1
+		:param iy: idem for y
+		:param nx: number of x indexes
+		:param ny: idem for y
+
+		:returns: a dict of numpy arrays (one entry per galaxy, i.e. of the same length as ix), with the same keys
+			as the dict returned by draw(). Scalars are also accepted, they are used for all galaxies.
+
+		If you do not redefine this method, it simply calls draw() for every galaxy.
+		"""
+		rows = [self.draw(ix[i], iy[i], nx, ny) for i in range(len(ix))]
+		return dict((colname, [row[colname] for row in rows]) for colname in rows[0])
+
@@ -30,7 +30,9 @@ logger = logging.getLogger(__name__)
 
 def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         psfcat=None, psfselect="random", psfskipbad=False,
-          ncat=2, nrea=2, ncpu=1, savetrugalimg=False, savepsfimg=False, savepsfcoreimg=False):
+          ncat=2, nrea=2, ncpu=1, savetrugalimg=False, savepsfimg=False, savepsfcoreimg=False, njitter=None, cattransport="pickle",
+          maxtasksperchild=None, progressfilepath=None, maxattempts=1, quarantinefilepath=None,
+          measdir=None, measfct=None, measfctkwargs=None, saveimgfraction=0.0):
         """
         Uses stampgrid.drawcat and stampgrid.drawimg to draw several (ncat) catalogs
         and several (nrea) "image realizations" per catalog.
@@ -85,6 +87,41 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         :param savetrugalimg: if True, I will also save the true (unconvolved) galaxy images.
         :param savepsfimg: if True, I will also save the PSF stamps.
         :param savepsfcoreimg: if True, I will save the PSF for core odd number of pixels for sextractor++.
+        :param njitter: if set, the galaxies are **not** rendered again for every realization.
+                Instead, for each catalog, njitter noiseless images (each with its own sub-pixel jitter) are
+                drawn once and cached in the image directory of the catalog. Each realization then only gets fresh
+                noise added to one of these noiseless images (realization i uses the noiseless image i % njitter).
+                So njitter=1 means that the jitter is fixed per catalog. This is much faster for large nrea, but note
+                that the realizations are then not independent in terms of jitter (and neighbors).
+                The cached noiseless images get deleted once all realizations are drawn.
+        :type njitter: int
+        :param cattransport: how the catalogs get to the workers. With "pickle" (default), each task embeds its catalog,
+                so that every catalog is pickled and sent nrea times. With "memmap", each catalog is written once as a
+                columnar directory next to its _cat.pkl (see tools.io.writecolumns), and the workers only receive the path of
+                this directory, from which they memory-map the columns. The neighbors catalog is then read from its _cat_nei.pkl.
+                These columnar directories get deleted once all images are drawn.
+        :param maxtasksperchild: if set, each worker process gets replaced after having drawn this many images
+                (see tools.pool.run), to release memory that a long run might accumulate.
+        :param progressfilepath: if set, path to a JSON file that gets updated with the progress (number of images drawn,
+                throughput, ETA) each time an image is done, to monitor long runs.
+        :param maxattempts: number of times the drawing of an image gets tried before giving up on it.
+                An image that fails (for instance with a GalSim FFT size error) does not stop the drawing of the other images.
+        :param quarantinefilepath: if set, the images that could not be drawn get listed in this JSON file
+                (identified by their galimg filepath, with the error and traceback, see tools.pool.run).
+                If not set, a RuntimeError is raised once all other images are drawn, if any image failed.
+                The missing realizations can then be drawn with redraw().
+        :param measdir: to be given with a measfct, see below.
+        :param measfct: if set, each worker measures the image that it has just drawn, in memory, with this measfct
+                (and the measfctkwargs), as meas.run.onsims(simdir, simparams, measdir, measfct, measfctkwargs) would do.
+                The measurement catalogs get written to the same places (and recorded in the same manifest) as by meas.run.onsims,
+                so that meas.avg.onsims can be used on them. But the galaxy images are not read back from disk, and only
+                a fraction of them get saved (see saveimgfraction). The measfct loads its image as usual, via
+                catalog.meta["img"].load() (see tools.image.setmemimg), but it cannot use the image file itself
+                (e.g., to run an external program on it), and it gets the catalog as a measfct of meas.run.onsims would.
+                This cannot be combined with njitter.
+        :param measfctkwargs: the keyword arguments for the measfct.
+        :param saveimgfraction: with a measfct, the fraction of the (randomly chosen) realizations whose galaxy images get saved.
+                The others are only recorded as "measured" in the manifest, and cannot be measured again by meas.run.onsims.
         
         
         As an illustration, an example of the directory structure that this function produces (for ncat=2, nrea=2)::
@@ -109,6 +146,10 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
                 20141016T170441_BJjhps_1_trugalimg.fits
 
         
+        Besides, a manifest (see tools.manifest) is appended to in the workdir (simdir/name_of_simparams/manifest.jsonl): it lists
+        the catalogs with their number of rows and the ImageInfos of their realizations, and the status of each realization.
+        meas.run.onsims reads it instead of unpickling all catalogs.
+        
         For a single call to this function, the timestamp is the same for all catalogs. This is
         handy if you want to delete all files from a particular call.
         
@@ -132,6 +173,8 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         # First, some general checks:
         if ncat < 1 or nrea < 1:
                 raise RuntimeError("ncat and nrea must be above 0")
+        if cattransport not in ["pickle", "memmap"]:
+                raise RuntimeError("Unknown cattransport '%s'" % (cattransport))
         
         # Some tests about the drawimgkwargs:
         forbiddendrawimgkwargs = ["simgalimgfilepath", "simtrugalimgfilepath", "simpsfimgfilepath"]
@@ -258,11 +301,16 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         # The module tempfile takes care of making the filename unique.
         # And so, we do this in one loop
         
+        catcolsdirpaths = [] # Only used with cattransport "memmap"
+        nei_catfilepaths = []
         for catalog, nei_catalog in zip(catalogs, nei_catalogs):
                 # We open a file object:
                 catfile = tempfile.NamedTemporaryFile(mode='wb', prefix=prefix, suffix="_cat.pkl", dir=workdir, delete=False)
                 if nei_catalog is not None:
                         nei_catfile = open(catfile.name.replace("_cat.pkl","_cat_nei.pkl"), 'w+b')
+                        nei_catfilepaths.append(nei_catfile.name)
+                else:
+                        nei_catfilepaths.append(None)
                 # Now we can get the unique filename
                 catalog.meta["catname"] = os.path.basename(str(catfile.name)).replace("_cat.pkl","")
                 
@@ -280,9 +328,18 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
                 pickle.dump(catalog, catfile) # We directly use this open file object.
                 if nei_catalog is not None:
                         pickle.dump(nei_catalog, nei_catfile)
+                        nei_catfile.close()
                 catfile.close()
+                tools.manifest.addcatalog(tools.manifest.getpath(workdir), catalog, catfile.name)
                 logger.info("Wrote catalog '%s'" % catalog.meta["catname"])
                 
+                if cattransport == "memmap":
+                        catcolsdirpath = catfile.name.replace("_cat.pkl","_cat_cols")
+                        tools.io.writecolumns(catalog, catcolsdirpath)
+                        catcolsdirpaths.append(catcolsdirpath)
+                else:
+                        catcolsdirpaths.append(None)
+                
         
         # And now we draw the image realizations for those catalogs.
         # This is done with multiprocessing.
@@ -291,32 +348,62 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         # For this, we prepare a flat list of _WorkerSettings objects for all (cat, rea) combinations,
         # and run a pool of _worker functions on this list.
         
+        if njitter is not None and (njitter < 1 or njitter > nrea):
+                raise RuntimeError("njitter must be between 1 and nrea")
+        
+        if measfct is not None:
+                if measdir is None:
+                        raise RuntimeError("Give a measdir to measure the images with the measfct")
+                if njitter is not None:
+                        raise RuntimeError("The images cannot be measured on the fly with njitter")
+                measworkdir = os.path.join(measdir, simparams.name)
+                if not os.path.exists(measworkdir):
+                        os.makedirs(measworkdir)
+                logger.info("The images will be measured on the fly, and %.1f%% of them saved" % (100.0 * saveimgfraction))
+        
+        noiselesswslist = [] # Only used if njitter is set
         wslist = []
-        for catalog, nei_catalog in zip(catalogs, nei_catalogs):        
-                for reaindex in range(nrea):
-                        
-                        # We have to customize the drawimgkwargs, and so we work on a copy
-                        thisdrawimgkwargs = copy.deepcopy(drawimgkwargs)
-                        thisdrawimgkwargs["neighbors_catalog"] = nei_catalog
-                                
-                        # Preparing the filepaths in which we will write the output image(s)
+        for catalog, nei_catalog, catcolsdirpath, nei_catfilepath in zip(catalogs, nei_catalogs, catcolsdirpaths, nei_catfilepaths):        
+                
+                if cattransport == "memmap":
+                        # The tasks will only hold the paths, not the catalogs themselves:
+                        taskcatalog = catcolsdirpath
+                        nei_catalog = nei_catfilepath
+                else:
+                        taskcatalog = catalog
+                
+                if njitter is not None:
+                        # We prepare the drawing of the noiseless images, with filenames that do not look like realizations
                         catname = catalog.meta["catname"]
                         catimgdirpath = os.path.join(workdir, catname + "_img")
-                                
-                        # We have already stored the simgalimgfilepath in the catalog meta:
-                        thisdrawimgkwargs["simgalimgfilepath"] = catalog.meta["imgreas"][reaindex].filepath        
-                        #thisdrawimgkwargs["simgalimgfilepath"] =\
-                        #        os.path.join(catimgdirpath, "%s_%i_galimg.fits" % (catname, reaindex))
+                        catnoiselessdrawimgkwargs = []
+                        for jitterindex in range(njitter):
+                                noiselessdrawimgkwargs = copy.deepcopy(drawimgkwargs)
+                                noiselessdrawimgkwargs["neighbors_catalog"] = nei_catalog
+                                noiselessdrawimgkwargs["addnoise"] = False
+                                noiselessdrawimgkwargs["simgalimgfilepath"] = os.path.join(catimgdirpath, "%s_jitter%i_noiselessimg.fits" % (catname, jitterindex))
+                                if savetrugalimg:
+                                        noiselessdrawimgkwargs["simtrugalimgfilepath"] = os.path.join(catimgdirpath, "%s_jitter%i_trugalimg.fits" % (catname, jitterindex))
+                                if savepsfimg:
+                                        noiselessdrawimgkwargs["simpsfimgfilepath"] = os.path.join(catimgdirpath, "%s_jitter%i_psfimg.fits" % (catname, jitterindex))
+                                if savepsfcoreimg:
+                                        noiselessdrawimgkwargs["simpsfcoreimgfilepath"] = os.path.join(catimgdirpath, "%s_jitter%i_psfcoreimg.fits" % (catname, jitterindex))
+                                noiselesswslist.append(_WorkerSettings(taskcatalog, jitterindex, noiselessdrawimgkwargs, workdir))
+                                catnoiselessdrawimgkwargs.append(noiselessdrawimgkwargs)
                 
-                        # If the user asked for a trugalimg and a psfimg, we also prepare these filepaths.
-                        if savetrugalimg:
-                                thisdrawimgkwargs["simtrugalimgfilepath"] = os.path.join(catimgdirpath, "%s_%i_trugalimg.fits" % (catname, reaindex))
-                        if savepsfimg:
-                                thisdrawimgkwargs["simpsfimgfilepath"] = os.path.join(catimgdirpath, "%s_%i_psfimg.fits" % (catname, reaindex))
-                        if savepsfcoreimg:
-                                thisdrawimgkwargs["simpsfcoreimgfilepath"] = os.path.join(catimgdirpath, "%s_%i_psfcoreimg.fits" % (catname, reaindex))
-        
-                        ws = _WorkerSettings(catalog, reaindex, thisdrawimgkwargs, workdir)
+                for reaindex in range(nrea):
+                        
+                        thisdrawimgkwargs = _readrawimgkwargs(catalog, reaindex, drawimgkwargs, workdir, nei_catalog,
+                                savetrugalimg=savetrugalimg, savepsfimg=savepsfimg, savepsfcoreimg=savepsfcoreimg)
+        
+                        if njitter is not None:
+                                ws = _WorkerSettings(taskcatalog, reaindex, thisdrawimgkwargs, workdir, noiselessdrawimgkwargs=catnoiselessdrawimgkwargs[reaindex % njitter],
+                                        manifestfilepath=tools.manifest.getpath(workdir))
+                        else:
+                                ws = _WorkerSettings(taskcatalog, reaindex, thisdrawimgkwargs, workdir, manifestfilepath=tools.manifest.getpath(workdir))
+                        
+                        if measfct is not None:
+                                ws.meas = _MeasSettings(measfct, measfctkwargs, measworkdir, saveimg=(np.random.uniform() < saveimgfraction))
                         
                         wslist.append(ws)
                 
@@ -329,11 +416,9 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         assert len(wslist) == ncat * nrea
         
         # The catalogs could be heavy, but note that we do not put unique copies of the catalogs in this list !
-        # Still, it would seem better to just have small thinks like "indexes" in the settings.
-        # However it seems that accessing shared memory from a multiprocessing.Pool is not trivial.
-        # So until we need something better, we leave it like this.
-        # Note for the future: instead of thinking about how to share memory to optimize this, the workers could well
-        # read their data from disk, and stay embarassingly parallel. 
+        # Still, they get pickled for every task when using multiprocessing.
+        # With cattransport "memmap", the workers instead read their catalog from disk (memory-mapped, so the
+        # workers drawing the same catalog share the same pages of memory) and stay embarassingly parallel.
 
         if ncpu == 0:
                 try:
@@ -341,24 +426,39 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
                 except:
                         logger.warning("multiprocessing.cpu_count() is not implemented!")
                         ncpu = 1
-                        
-        logger.info("Start drawing %i images using %i CPUs" % (len(wslist), ncpu))
-
+        
         # Suppress the info-or-lower-level logging from the low-level functions:
         #stampgridlogger = logging.getLogger("momentsml.sim.stampgrid")
         #stampgridlogger.setLevel(logging.WARNING)
         
-        if ncpu == 1:
-                # The single-processing version (not using multiprocessing to keep it easier to debug):
-                logger.debug("Not using multiprocessing")
-                list(map(_worker, wslist))
-
-        else:
-                # multiprocessing map:
-                pool = multiprocessing.Pool(processes=ncpu)
-                pool.map(_worker, wslist)
-                pool.close()
-                pool.join()
+        # The two passes (noiseless images, then realizations) share a single progress and a single list of failures,
+        # so that the progress file and the quarantine file cover the full run.
+        allwslist = wslist if njitter is None else noiselesswslist + wslist
+        progress = tools.pool.Progress(len(allwslist), sum([ws.size() for ws in allwslist]), progressfilepath)
+        quarantine = []
+        
+        if njitter is not None:
+                # The noiseless images have to be ready before the realizations can be made.
+                logger.info("Start drawing %i noiseless images using %i CPUs" % (len(noiselesswslist), ncpu))
+                _run(noiselesswslist, ncpu, maxtasksperchild=maxtasksperchild, maxattempts=maxattempts,
+                        quarantinefilepath=quarantinefilepath, quarantine=quarantine, progress=progress)
+        
+        logger.info("Start drawing %i images using %i CPUs" % (len(wslist), ncpu))
+        results = _run(wslist, ncpu, maxtasksperchild=maxtasksperchild, maxattempts=maxattempts,
+                quarantinefilepath=quarantinefilepath, quarantine=quarantine, progress=progress)
+        _recordfailures(wslist, results)
+        
+        if cattransport == "memmap":
+                logger.info("Removing the columnar catalogs...")
+                for catcolsdirpath in catcolsdirpaths:
+                        shutil.rmtree(catcolsdirpath)
+        
+        if njitter is not None:
+                logger.info("Removing the cached noiseless images...")
+                for ws in noiselesswslist:
+                        for filepathkey in ["simgalimgfilepath", "simtrugalimgfilepath", "simpsfimgfilepath", "simpsfcoreimgfilepath"]:
+                                if filepathkey in ws.drawimgkwargs and os.path.exists(ws.drawimgkwargs[filepathkey]): # Could have failed
+                                        os.remove(ws.drawimgkwargs[filepathkey])
         
         endtime = datetime.datetime.now()
         nstamps = len(catalogs[0])*nrea
@@ -385,31 +485,217 @@ def multi(simdir, simparams, drawcatkwargs, drawimgkwargs=None,
         """
 
 
+def redraw(simdir, simparams, drawimgkwargs=None, ncpu=1, savetrugalimg=False, savepsfimg=False, savepsfcoreimg=False,
+        maxtasksperchild=None, progressfilepath=None, maxattempts=1, quarantinefilepath=None, onlyfailed=False, uselease=False, leaseexpiry=3600.0):
+        """
+        Draws the missing image realizations of the catalogs previously made by multi() for this simdir and simparams,
+        for instance after some of them failed. This is the "skipdone" of multi(): realizations whose galimg file
+        exists, or that the manifest records as "done" or "measured" (measured on the fly, without saving the image),
+        are left untouched, no new catalogs get drawn.
+        
+        The realizations are drawn from scratch (no njitter), with the catalogs read from their _cat.pkl (and _cat_nei.pkl) files.
+        
+        :param drawimgkwargs: the drawimgkwargs that you gave to multi()
+        :param onlyfailed: if True, only the realizations listed in the quarantinefilepath get drawn.
+        :param uselease: if True, each realization is drawn under a lease file (see tools.lease), so that several scripts
+                (or hosts sharing a filesystem) can call redraw() on the same simdir at the same time, without drawing any image twice.
+                Note that multi() itself does not need this: each call draws its own new catalogs, with unique filenames.
+        :param leaseexpiry: time in seconds after which the lease of a killed script gets reclaimed.
+        
+        See multi() for the other parameters. The quarantine file gets rewritten with the realizations that still failed.
+        """
+        if drawimgkwargs is None:
+                drawimgkwargs = {}
+        workdir = os.path.join(simdir, simparams.name)
+        if onlyfailed:
+                if quarantinefilepath is None:
+                        raise RuntimeError("onlyfailed requires a quarantinefilepath")
+                failedfilepaths = set(tools.pool.readquarantine(quarantinefilepath))
+        
+        manifestfilepath = tools.manifest.getpath(workdir)
+        if os.path.exists(manifestfilepath):
+                manifest = tools.manifest.read(manifestfilepath)
+        else:
+                manifest = {} # Older simdir, only the files tell what is done
+        
+        wslist = []
+        catfilepaths = sorted(glob.glob(os.path.join(workdir, "*_cat.pkl")))
+        logger.info("Looking for missing realizations of %i catalogs in '%s'" % (len(catfilepaths), workdir))
+        for catfilepath in catfilepaths:
+                catalog = tools.io.readpickle(catfilepath)
+                nei_catfilepath = catfilepath.replace("_cat.pkl", "_cat_nei.pkl")
+                nei_catalog = tools.io.readpickle(nei_catfilepath) if os.path.exists(nei_catfilepath) else None
+                reastatus = manifest.get(catalog.meta["catname"], {}).get("status", {})
+                for (reaindex, imgrea) in enumerate(catalog.meta["imgreas"]):
+                        if os.path.exists(imgrea.filepath) or reastatus.get(reaindex) in ("done", "measured"):
+                                continue
+                        if onlyfailed and imgrea.filepath not in failedfilepaths:
+                                continue
+                        thisdrawimgkwargs = _readrawimgkwargs(catalog, reaindex, drawimgkwargs, workdir, nei_catalog,
+                                savetrugalimg=savetrugalimg, savepsfimg=savepsfimg, savepsfcoreimg=savepsfcoreimg)
+                        wslist.append(_WorkerSettings(catalog, reaindex, thisdrawimgkwargs, workdir, manifestfilepath=manifestfilepath))
+        
+        logger.info("Start drawing %i missing images using %i CPUs" % (len(wslist), ncpu))
+        if len(wslist) == 0:
+                if quarantinefilepath is not None:
+                        tools.pool.writequarantine([], quarantinefilepath) # Nothing failed
+                return
+        results = _run(wslist, ncpu, maxtasksperchild=maxtasksperchild, progressfilepath=progressfilepath,
+                maxattempts=maxattempts, quarantinefilepath=quarantinefilepath, uselease=uselease, leaseexpiry=leaseexpiry)
+        _recordfailures(wslist, results)
+
+
+def _recordfailures(wslist, results):
+        """
+        Records the realizations that could not be drawn in the manifest (the successful ones are recorded by the workers).
+        """
+        for (ws, result) in zip(wslist, results):
+                if result is None and not os.path.exists(ws.drawimgkwargs["simgalimgfilepath"]): # Not drawn by another run
+                        tools.manifest.addrea(ws.manifestfilepath, ws.getcatname(), ws.reaindex, "failed")
+
+
+def _readrawimgkwargs(catalog, reaindex, drawimgkwargs, workdir, nei_catalog, savetrugalimg=False, savepsfimg=False, savepsfcoreimg=False):
+        """
+        Returns the drawimgkwargs for the realization reaindex of a catalog, with the filepaths of the images to be written.
+        """
+        # We have to customize the drawimgkwargs, and so we work on a copy
+        thisdrawimgkwargs = copy.deepcopy(drawimgkwargs)
+        thisdrawimgkwargs["neighbors_catalog"] = nei_catalog
+                
+        # Preparing the filepaths in which we will write the output image(s)
+        catname = catalog.meta["catname"]
+        catimgdirpath = os.path.join(workdir, catname + "_img")
+                
+        # We have already stored the simgalimgfilepath in the catalog meta:
+        thisdrawimgkwargs["simgalimgfilepath"] = catalog.meta["imgreas"][reaindex].filepath        
+        #thisdrawimgkwargs["simgalimgfilepath"] =\
+        #        os.path.join(catimgdirpath, "%s_%i_galimg.fits" % (catname, reaindex))
+
+        # If the user asked for a trugalimg and a psfimg, we also prepare these filepaths.
+        if savetrugalimg:
+                thisdrawimgkwargs["simtrugalimgfilepath"] = os.path.join(catimgdirpath, "%s_%i_trugalimg.fits" % (catname, reaindex))
+        if savepsfimg:
+                thisdrawimgkwargs["simpsfimgfilepath"] = os.path.join(catimgdirpath, "%s_%i_psfimg.fits" % (catname, reaindex))
+        if savepsfcoreimg:
+                thisdrawimgkwargs["simpsfcoreimgfilepath"] = os.path.join(catimgdirpath, "%s_%i_psfcoreimg.fits" % (catname, reaindex))
+        return thisdrawimgkwargs
+
+
 class _WorkerSettings():
         """
         A class to hold together all the settings for processing a catalog-realization combination.
         If one day we have different drawimg() functions, we'll just pass this function here as well.
         """
         
-        def __init__(self, catalog, reaindex, drawimgkwargs, workdir):
+        def __init__(self, catalog, reaindex, drawimgkwargs, workdir, noiselessdrawimgkwargs=None, manifestfilepath=None):
                 """
                 The catalog's catname, reaindex, and workdir define the filepaths in which the image(s)
                 drawn with the drawimgkwargs will be written.
+                The catalog can also be given as the path to a columnar directory written by tools.io.writecolumns,
+                and the "neighbors_catalog" of the drawimgkwargs as the path to a pickle. They are then read by the worker.
+                If noiselessdrawimgkwargs are given, the realization is not drawn from scratch, but made by
+                adding noise to the noiseless image drawn (previously) with these noiselessdrawimgkwargs.
+                If a manifestfilepath is given, the worker records the realization as done in this manifest.
                 """
                 
                 self.catalog = catalog # No copy needed, we won't change it!
                 self.reaindex = reaindex
                 self.drawimgkwargs = drawimgkwargs # This is already a changed deep copy from the original argument to multi().
                 self.workdir = workdir # Stays the same for all workers !
+                self.noiselessdrawimgkwargs = noiselessdrawimgkwargs
+                self.manifestfilepath = manifestfilepath
+                self.meas = None # Optionally, a _MeasSettings object
         
                 
         def __str__(self):
                 """
                 A short string describing these settings
                 """
-                return "[catalog '%s', realization %i]" % (self.catalog.meta["catname"], self.reaindex)
+                return "[catalog '%s', realization %i]" % (self.getcatname(), self.reaindex)
+        
+        
+        def getcatname(self):
+                """
+                Returns the catname, without reading the catalog if only its path was given.
+                """
+                if isinstance(self.catalog, str):
+                        return os.path.basename(self.catalog).replace("_cat_cols", "")
+                else:
+                        return self.catalog.meta["catname"]
+        
+        
+        def size(self):
+                """
+                An estimate of the cost of drawing this image, used to start the largest tasks first: the number of rows of the catalog
+                (or the size of its columnar directory, if only its path is known).
+                """
+                if isinstance(self.catalog, str):
+                        return sum(os.path.getsize(os.path.join(self.catalog, filename)) for filename in os.listdir(self.catalog))
+                else:
+                        return len(self.catalog)
+        
+        
+        def loadcatalog(self):
+                """
+                Returns the catalog, reading it if only its path was given.
+                """
+                if isinstance(self.catalog, str):
+                        return tools.io.readcolumns(self.catalog, mmap_mode="r")
+                else:
+                        return self.catalog
+        
+        
+        def loaddrawimgkwargs(self, drawimgkwargs):
+                """
+                Returns a copy of the given drawimgkwargs in which a neighbors_catalog path is replaced by the catalog itself.
+                """
+                if isinstance(drawimgkwargs.get("neighbors_catalog", None), str):
+                        drawimgkwargs = dict(drawimgkwargs) # A shallow copy is enough
+                        drawimgkwargs["neighbors_catalog"] = tools.io.readpickle(drawimgkwargs["neighbors_catalog"])
+                return drawimgkwargs
+        
+        
+class _MeasSettings():
+        """
+        The settings to measure a realization right after drawing it, see the measfct of multi().
+        """
+        
+        def __init__(self, measfct, measfctkwargs, measworkdir, saveimg=False):
+                self.measfct = measfct
+                self.measfctkwargs = measfctkwargs if measfctkwargs is not None else {}
+                self.measworkdir = measworkdir
+                self.saveimg = saveimg
         
         
+        def measure(self, catalog, catname, reaindex, galimg):
+                """
+                Measures the in-memory image galimg of the realization reaindex of the catalog, and writes the measurement catalog,
+                with the same meta["img"] and filepath as meas.run.onsims would use.
+                """
+                imgrea = catalog.meta["imgreas"][reaindex]
+                incat = astropy.table.Table(catalog, copy=False)
+                incat.meta = copy.deepcopy(catalog.meta) # So that the catalog itself is not modified
+                incat.meta["img"] = tools.imageinfo.ImageInfo(imgrea.filepath, imgrea.xname, imgrea.yname, imgrea.stampsize,
+                        workdir=os.path.join(self.measworkdir, imgrea.name + "_workdir"))
+                
+                tools.image.setmemimg(imgrea.filepath, galimg)
+                try:
+                        outcat = self.measfct(incat, **self.measfctkwargs)
+                finally:
+                        tools.image.setmemimg(imgrea.filepath, None)
+                
+                outcatfilepath = os.path.join(self.measworkdir, imgrea.name + "_meascat.pkl")
+                tools.io.writepickle(outcat, outcatfilepath)
+                tools.manifest.addrea(tools.manifest.getpath(self.measworkdir), catname, reaindex, "done", filepath=outcatfilepath)
+
+
+def _galimgfilepath(ws):
+        """
+        Identifies the task of a _WorkerSettings object (for the quarantine and the leases).
+        """
+        return ws.drawimgkwargs["simgalimgfilepath"]
+
+
 def _worker(ws):
         """
         Worker function that processes one _WorkerSettings object.
@@ -420,8 +706,49 @@ def _worker(ws):
         p = multiprocessing.current_process()
         logger.info("%s is starting to draw %s with PID %s" % (p.name, str(ws), p.pid))
         
-        # It's just a single call:
-        stampgrid.drawimg(ws.catalog, **ws.drawimgkwargs)
+        catalog = ws.loadcatalog()
+        
+        status = "done"
+        if ws.noiselessdrawimgkwargs is None and ws.meas is None:
+                # It's just a single call:
+                cachestats = stampgrid.drawimg(catalog, **ws.loaddrawimgkwargs(ws.drawimgkwargs))
+                logger.debug("%s drawimg cache statistics: %s" % (p.name, str(cachestats)))
+        
+        elif ws.noiselessdrawimgkwargs is None:
+                # We draw, measure the image in memory, and maybe save it:
+                drawimgkwargs = dict(ws.loaddrawimgkwargs(ws.drawimgkwargs))
+                if not ws.meas.saveimg:
+                        drawimgkwargs["simgalimgfilepath"] = None
+                        status = "measured"
+                (cachestats, galimg) = stampgrid.drawimg(catalog, returnimg=True, **drawimgkwargs)
+                logger.debug("%s drawimg cache statistics: %s" % (p.name, str(cachestats)))
+                ws.meas.measure(catalog, ws.getcatname(), ws.reaindex, galimg)
+        
+        else:
+                # We only add noise to the cached noiseless image, and copy the other (noiseless) images:
+                stampgrid.drawnoise(catalog, ws.noiselessdrawimgkwargs["simgalimgfilepath"], ws.drawimgkwargs["simgalimgfilepath"])
+                for filepathkey in ["simtrugalimgfilepath", "simpsfimgfilepath", "simpsfcoreimgfilepath"]:
+                        if filepathkey in ws.drawimgkwargs:
+                                shutil.copy(ws.noiselessdrawimgkwargs[filepathkey], ws.drawimgkwargs[filepathkey])
+        
+        if ws.manifestfilepath is not None:
+                tools.manifest.addrea(ws.manifestfilepath, ws.getcatname(), ws.reaindex, status)
         
         endtime = datetime.datetime.now()
         logger.info("%s is done, it took %s" % (p.name, str(endtime - starttime)))
+        return True
+
+
+def _run(wslist, ncpu, maxtasksperchild=None, progressfilepath=None, maxattempts=1, quarantinefilepath=None, uselease=False, leaseexpiry=3600.0,
+        quarantine=None, progress=None):
+        """
+        Runs the _worker on all elements of wslist, using ncpu processes (see tools.pool.run).
+        Successive calls can share a quarantine list and a progress (tools.pool.Progress), to write single files.
+        With ncpu == 1, this does not use multiprocessing, to keep it easier to debug.
+        Returns the list of results (True, or None for failed tasks and tasks done by other runs).
+        """
+        return tools.pool.run(_worker, wslist, ncpu=ncpu, sizes=[ws.size() for ws in wslist],
+                maxtasksperchild=maxtasksperchild, progressfilepath=progressfilepath,
+                maxattempts=maxattempts, quarantinefilepath=quarantinefilepath, taskkey=_galimgfilepath,
+                leasekey=(_galimgfilepath if uselease else None), leaseexpiry=leaseexpiry,
+                quarantine=quarantine, progress=progress)
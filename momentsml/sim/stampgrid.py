@@ -8,6 +8,10 @@ import random
 import os
 import sys
 import copy
+import ctypes
+import multiprocessing
+import traceback
+from queue import Empty
 
 import logging
 logger = logging.getLogger(__name__)
@@ -57,6 +61,10 @@ def drawcat(simparams, n=10, nc=2, stampsize=64, pixelscale=1.0, idprefix="", ne
         Different SNC-versions of a galaxy are placed directly one after the other, with consecutive ix indices but same iy.
         (however for the purpose of drawing the parameters, the SNC-versions *all* have the same ix as well, of course)
         
+        Without neighbors, the catalog is built column by column: if simparams implements draw_batch(), all
+        parameters are drawn in a single call, otherwise draw() gets called for each galaxy as before.
+        The SNC rotations are then done with numpy on whole columns.
+        
         :returns: A catalog (astropy table). The stampsize is stored in meta.
         
         """
@@ -83,137 +91,144 @@ def drawcat(simparams, n=10, nc=2, stampsize=64, pixelscale=1.0, idprefix="", ne
         
         logger.info("The grid will be %i x %i, and the number of SNC rotations is %i." % (nx, ny, nsnc))
 
-        ## Each catalog have different number of neighbors and positions
-        n_config = copy.deepcopy(neighbors_config)
+        if neighbors_config is None:
+                # The fast columnar path: parameters are drawn (if possible) in one go, and the SNC versions are made with numpy.
+                catalog = _drawcatcols(simparams, statparams, n, nc, ny, nsnc, sncrot, stampsize, idprefix)
+                neis_catalog = None
+                logger.info("Drawing of catalog done")
+        
+        else:
+                ## Each catalog have different number of neighbors and positions
+                n_config = copy.deepcopy(neighbors_config)
         
-        nn = neighbors_config["nn"]
-        nn_min = neighbors_config["nn_min"]
-        nn_max = neighbors_config["nn_max"]
-        if nn is None:
-                nn = random.choice(range(nn_min, nn_max + 1))
+                nn = neighbors_config["nn"]
+                nn_min = neighbors_config["nn_min"]
+                nn_max = neighbors_config["nn_max"]
+                if nn is None:
+                        nn = random.choice(range(nn_min, nn_max + 1))
 
-        neighs_pos = [ placer_dict(stampsize, neighbors_config) for n in range(nn) ]
+                neighs_pos = [ placer_dict(stampsize, neighbors_config) for n in range(nn) ]
         
-        rows = [] # The "table"
-        neigh_rows = [] #neighbors table
-        for i in range(n): # We loop over all "truely different" galaxies (not all SNC galaxies)
-                # The indices used to draw parameters for each of these truely different galaxies:
-                (piy, pix) = divmod(i, nc)                
-                assert pix < nc and piy < ny
+                rows = [] # The "table"
+                neigh_rows = [] #neighbors table
+                for i in range(n): # We loop over all "truely different" galaxies (not all SNC galaxies)
+                        # The indices used to draw parameters for each of these truely different galaxies:
+                        (piy, pix) = divmod(i, nc)                
+                        assert pix < nc and piy < ny
         
-                # And draw one:
-                gal = simparams.draw(pix, piy, nc, ny)
+                        # And draw one:
+                        gal = simparams.draw(pix, piy, nc, ny)
                 
-                #neighbors features fixed by case
-                if neighbors_config is not None:
-                        nei_limits = neighbors_config["nei_limits"]
-                        if nei_limits is not None:
-                                # Brightness and radius limit for neighbors
-                                nei_limits = {'Sersic':{'tru_sb_max':2.0*gal['tru_sb'],'tru_rad_max':2.0*gal['tru_rad']} }
-                                n_config.update({'nn': nn})
-                        else :
-                                nei_limits = None
+                        #neighbors features fixed by case
+                        if neighbors_config is not None:
+                                nei_limits = neighbors_config["nei_limits"]
+                                if nei_limits is not None:
+                                        # Brightness and radius limit for neighbors
+                                        nei_limits = {'Sersic':{'tru_sb_max':2.0*gal['tru_sb'],'tru_rad_max':2.0*gal['tru_rad']} }
+                                        n_config.update({'nn': nn})
+                                else :
+                                        nei_limits = None
                         
-                        if statparams["snc_type"] == 0:
-                                # for training weights. catalogs with realization of different galaxies, same nn and rotations in neighbors                     
-                                neighs = [ draw_neighbor_dict(n_config, nei_limits=nei_limits) for n in range(nn) ]
-                                for nei_p in neighs_pos:
-                                        polar_translation(nei_p, n_config)
-                                for d1, d2 in zip(neighs, neighs_pos): d1.update(d2)
-                        else:
-                                neighs = draw_all_neighbors(n_config, stampsize, nei_limits=nei_limits)
+                                if statparams["snc_type"] == 0:
+                                        # for training weights. catalogs with realization of different galaxies, same nn and rotations in neighbors                     
+                                        neighs = [ draw_neighbor_dict(n_config, nei_limits=nei_limits) for n in range(nn) ]
+                                        for nei_p in neighs_pos:
+                                                polar_translation(nei_p, n_config)
+                                        for d1, d2 in zip(neighs, neighs_pos): d1.update(d2)
+                                else:
+                                        neighs = draw_all_neighbors(n_config, stampsize, nei_limits=nei_limits)
                         
-                        #TODO might be different number of neighbors among realizations just set  n_config.update({'nn': None})
-                        #TODO this should be implemented in meas.run.onsim`s 
-                        gal["nn"] =  len(neighs)
-                        if len(neighs) != 0:
-                                gal["neighbor1"] = find_nearest(neighs)
-                        else:
-                                gal["neighbor1"] = None
+                                #TODO might be different number of neighbors among realizations just set  n_config.update({'nn': None})
+                                #TODO this should be implemented in meas.run.onsim`s 
+                                gal["nn"] =  len(neighs)
+                                if len(neighs) != 0:
+                                        gal["neighbor1"] = find_nearest(neighs)
+                                else:
+                                        gal["neighbor1"] = None
 
                 
-                # Now things get different depending on SNC
-                if statparams["snc_type"] == 0:        # No SNC, so we simply add this galaxy to the list.
-                        gal["ix"] = pix
-                        gal["iy"] = piy
+                        # Now things get different depending on SNC
+                        if statparams["snc_type"] == 0:        # No SNC, so we simply add this galaxy to the list.
+                                gal["ix"] = pix
+                                gal["iy"] = piy
                         
-                        gal.update(statparams) # This would overwrite any of the "draw" params.
-                        rows.append(gal) # So rows will be a list of dicts
+                                gal.update(statparams) # This would overwrite any of the "draw" params.
+                                rows.append(gal) # So rows will be a list of dicts
 
-                        if neighbors_config is not None:
-                                neigh_rows.append(neighs)
+                                if neighbors_config is not None:
+                                        neigh_rows.append(neighs)
                 
-                else: # SNC with nsnc different versions rotated by sncrot degrees
+                        else: # SNC with nsnc different versions rotated by sncrot degrees
                         
-                        for roti in range(nsnc):
-                                rotgal = copy.deepcopy(gal)
+                                for roti in range(nsnc):
+                                        rotgal = copy.deepcopy(gal)
                                 
-                                # We perform the rotation in different ways, depending on the parametrisation
-                                profile_type = params.profile_types[rotgal["tru_type"]]
-                                if profile_type in ["Sersic", "Gaussian"]:
-                                        (rotgal["tru_g1"], rotgal["tru_g2"]) = tools.calc.rotg(gal["tru_g1"], gal["tru_g2"], roti*sncrot)
-                                elif profile_type ==  "EBulgeDisk":
-                                        rotgal["tru_theta"] = gal["tru_theta"] + roti*sncrot
-                                else:
-                                        raise RuntimeError("Unknown profile type")
+                                        # We perform the rotation in different ways, depending on the parametrisation
+                                        profile_type = params.profile_types[rotgal["tru_type"]]
+                                        if profile_type in ["Sersic", "Gaussian"]:
+                                                (rotgal["tru_g1"], rotgal["tru_g2"]) = tools.calc.rotg(gal["tru_g1"], gal["tru_g2"], roti*sncrot)
+                                        elif profile_type ==  "EBulgeDisk":
+                                                rotgal["tru_theta"] = gal["tru_theta"] + roti*sncrot
+                                        else:
+                                                raise RuntimeError("Unknown profile type")
                                 
-                                # And now each of the SNC versions gets a consecutive ix but the same iy:
-                                rotgal["ix"] = pix * nsnc + roti
-                                rotgal["iy"] = piy
+                                        # And now each of the SNC versions gets a consecutive ix but the same iy:
+                                        rotgal["ix"] = pix * nsnc + roti
+                                        rotgal["iy"] = piy
                                 
-                                rotgal.update(statparams)
-                                rows.append(rotgal)
+                                        rotgal.update(statparams)
+                                        rows.append(rotgal)
                                 
-                                if neighbors_config is not None:
-                                        rotneighs = copy.deepcopy(neighs)
-                                        theta = None
-                                        if neighbors_config["snc_stamp"]:
-                                                 neighbors_config["snc_neighbors"] = True
-                                                 neighbors_config["polar_translation"] =  True
-                                                 logger.info("Using snc_stamp")
-                                                 theta=roti*sncrot*(np.pi/180.0) 
-                                        if neighbors_config["snc_neighbors"]:
-                                                logger.info("Using SNC for neighbors too")
-                                                for i in range(len(rotneighs)):
-                                                        profile_type = rotneighs[i]["profile_type"]
-                                                        if profile_type in ["Sersic", "Gaussian"]:
-                                                                (rotneighs[i]["tru_g1"], rotneighs[i]["tru_g2"]) = tools.calc.rotg(neighs[i]["tru_g1"],
-                                                                                                                           neighs[i]["tru_g2"],
-                                                                                                                           roti*sncrot)
-                                                        elif profile_type ==  "EBulgeDisk":
-                                                                rotneighs[i]["tru_theta"] = neighs[i]["tru_theta"] + roti*sncrot
-                                                        else:
-                                                                raise RuntimeError("Unknown profile type")
-                                        if neighbors_config["polar_translation"]:
-                                                logger.info("Using polar translation")
-                                                for nei in rotneighs:
-                                                        print(theta)
-                                                        polar_translation(nei, neighbors_config, theta=theta)
-                                        neigh_rows.append(rotneighs)
-                
-                
-        # A second loop simply adds the pixel positions and ids, for all galaxies (not just truely different ones):
-        for (i, gal) in enumerate(rows):
-                gal["id"] = idprefix + str(i)
-                gal["x"] = gal["ix"]*stampsize + stampsize/2.0 + 0.5# I'm not calling this tru_x, as it will be jittered, and also as a simple x is default.
-                gal["y"] = gal["iy"]*stampsize + stampsize/2.0 + 0.5
+                                        if neighbors_config is not None:
+                                                rotneighs = copy.deepcopy(neighs)
+                                                theta = None
+                                                if neighbors_config["snc_stamp"]:
+                                                         neighbors_config["snc_neighbors"] = True
+                                                         neighbors_config["polar_translation"] =  True
+                                                         logger.info("Using snc_stamp")
+                                                         theta=roti*sncrot*(np.pi/180.0) 
+                                                if neighbors_config["snc_neighbors"]:
+                                                        logger.info("Using SNC for neighbors too")
+                                                        for i in range(len(rotneighs)):
+                                                                profile_type = rotneighs[i]["profile_type"]
+                                                                if profile_type in ["Sersic", "Gaussian"]:
+                                                                        (rotneighs[i]["tru_g1"], rotneighs[i]["tru_g2"]) = tools.calc.rotg(neighs[i]["tru_g1"],
+                                                                                                                                   neighs[i]["tru_g2"],
+                                                                                                                                   roti*sncrot)
+                                                                elif profile_type ==  "EBulgeDisk":
+                                                                        rotneighs[i]["tru_theta"] = neighs[i]["tru_theta"] + roti*sncrot
+                                                                else:
+                                                                        raise RuntimeError("Unknown profile type")
+                                                if neighbors_config["polar_translation"]:
+                                                        logger.info("Using polar translation")
+                                                        for nei in rotneighs:
+                                                                print(theta)
+                                                                polar_translation(nei, neighbors_config, theta=theta)
+                                                neigh_rows.append(rotneighs)
+                
+                
+                # A second loop simply adds the pixel positions and ids, for all galaxies (not just truely different ones):
+                for (i, gal) in enumerate(rows):
+                        gal["id"] = idprefix + str(i)
+                        gal["x"] = gal["ix"]*stampsize + stampsize/2.0 + 0.5# I'm not calling this tru_x, as it will be jittered, and also as a simple x is default.
+                        gal["y"] = gal["iy"]*stampsize + stampsize/2.0 + 0.5
                         
                                 
-        # All elements in row_list must have same size.
-        # Astropy will reshape using the min len element
-        if neighbors_config is not None:
-                if statparams["snc_type"] == 0:
-                        neis_catalog = neigh_rows
+                # All elements in row_list must have same size.
+                # Astropy will reshape using the min len element
+                if neighbors_config is not None:
+                        if statparams["snc_type"] == 0:
+                                neis_catalog = neigh_rows
+                        else:
+                                neis_catalog = astropy.table.Table(rows= neigh_rows)
+                                logger.info("Drawing of neighbors catalog done")
                 else:
-                        neis_catalog = astropy.table.Table(rows= neigh_rows)
-                        logger.info("Drawing of neighbors catalog done")
-        else:
-                neis_catalog = None
+                        neis_catalog = None
 
-        # There are many ways to build a new astropy.table
-        # One of them directly uses a list of dicts...
-        catalog = astropy.table.Table(rows=rows)
-        logger.info("Drawing of catalog done")
+                # There are many ways to build a new astropy.table
+                # One of them directly uses a list of dicts...
+                catalog = astropy.table.Table(rows=rows)
+                logger.info("Drawing of catalog done")
         
         # The following is aimed at drawimg:
         catalog.meta["stampsize"] = stampsize
@@ -231,9 +246,65 @@ def drawcat(simparams, n=10, nc=2, stampsize=64, pixelscale=1.0, idprefix="", ne
         if metadict:
                 catalog.meta.update(metadict)
         return catalog, neis_catalog
+
+
+def _drawcatcols(simparams, statparams, n, nc, ny, nsnc, sncrot, stampsize, idprefix):
+        """
+        Columnar version of the catalog creation done by drawcat (without neighbors).
+        Returns an astropy table with the same columns and row order as the row-by-row approach.
+        """
+        
+        # The indices used to draw parameters for each of the truely different galaxies:
+        (piy, pix) = np.divmod(np.arange(n), nc)
+        assert np.all(pix < nc) and np.all(piy < ny)
+        
+        # The default draw_batch of params.Params calls draw() for every galaxy.
+        cols = simparams.draw_batch(pix, piy, nc, ny)
+        
+        # Scalars returned by draw_batch are simply broadcasted:
+        cols = dict((colname, np.broadcast_to(np.asarray(data), (n,)).copy()) for (colname, data) in cols.items())
+        
+        # Each truely different galaxy gets repeated nsnc times, and we keep track of the rotation index:
+        if nsnc > 1:
+                cols = dict((colname, np.repeat(data, nsnc)) for (colname, data) in cols.items())
+        roti = np.tile(np.arange(nsnc), n)
+        
+        if statparams["snc_type"] != 0:
+                # We perform the rotation in different ways, depending on the parametrisation
+                tru_type = cols["tru_type"] if "tru_type" in cols else np.full(n * nsnc, statparams["tru_type"])
+                if np.any(tru_type < 0) or np.any(tru_type >= len(params.profile_types)):
+                        raise RuntimeError("Unknown profile type")
+                profile_type = np.asarray(params.profile_types)[tru_type]
+                
+                gmask = np.logical_or(profile_type == "Sersic", profile_type == "Gaussian")
+                if np.any(gmask):
+                        (rotg1, rotg2) = tools.calc.rotg(cols["tru_g1"][gmask], cols["tru_g2"][gmask], roti[gmask]*sncrot)
+                        cols["tru_g1"] = cols["tru_g1"].astype(float)
+                        cols["tru_g2"] = cols["tru_g2"].astype(float)
+                        cols["tru_g1"][gmask] = rotg1
+                        cols["tru_g2"][gmask] = rotg2
+                
+                thetamask = profile_type == "EBulgeDisk"
+                if np.any(thetamask):
+                        cols["tru_theta"] = cols["tru_theta"].astype(float)
+                        cols["tru_theta"][thetamask] += roti[thetamask]*sncrot
+        
+        # And now each of the SNC versions gets a consecutive ix but the same iy:
+        cols["ix"] = np.repeat(pix, nsnc) * nsnc + roti
+        cols["iy"] = np.repeat(piy, nsnc)
+        
+        for (colname, value) in statparams.items(): # This overwrites any of the "draw" params.
+                cols[colname] = np.full(n * nsnc, value)
+        
+        # Finally the pixel positions and ids, for all galaxies (not just truely different ones):
+        cols["id"] = np.array([idprefix + str(i) for i in range(n * nsnc)])
+        cols["x"] = cols["ix"]*stampsize + stampsize/2.0 + 0.5 # I'm not calling this tru_x, as it will be jittered, and also as a simple x is default.
+        cols["y"] = cols["iy"]*stampsize + stampsize/2.0 + 0.5
+        
+        return astropy.table.Table(cols, names=list(cols.keys()))
    
 
-def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, simpsfimgfilepath=None, simpsfcoreimgfilepath=None, gsparams=None, sersiccut=None, neighbors_catalog=None):
+def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, simpsfimgfilepath=None, simpsfcoreimgfilepath=None, gsparams=None, sersiccut=None, neighbors_catalog=None, addnoise=True, profilecachesize=100, psfcachemaxmb=500.0, nbands=1, seed=None, returnimg=False):
 
         """
         Turns a catalog as obtained from drawcat into FITS images.
@@ -248,12 +319,35 @@ def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, s
                 If no PSF stamps are specifed, the code will look for Gaussian PSF parameters in the catalog.
                 If such parameters are not given, no PSF convolution is done.
                 
-        :param simgalimgfilepath: where I write my output image of simulated and noisy galaxies
+        :param simgalimgfilepath: where I write my output image of simulated and noisy galaxies.
+                If None, this image is not written (use returnimg to get it).
         :param simtrugalimgfilepath: (optional) where I write the image without convolution and noise
         :param simpsfimgfilepath: (optional) where I write the PSFs
         :param simpsfimgfilepath: (optional) where I write the PSF core
         
         :param sersiccut: cuts the sersic profile at this number of rad
+        :param addnoise: if False, the image written to simgalimgfilepath is the noiseless convolved one.
+                Use drawnoise() to later turn such an image into a noisy realization.
+        :param profilecachesize: maximum number of unit-flux and unit-radius Sersic profiles to keep in a LRU cache.
+                These are keyed by sersic index (and truncation), and each galaxy is derived from them by dilation.
+                So discretize your tru_sersicn to make this efficient.
+        :param psfcachemaxmb: memory budget, in MB, for the cache of PSF InterpolatedImages (only used for PSF stamps given
+                via catalog.meta["psf"]). The PSFs are keyed by their position in the PSF image, so galaxies sharing the same PSF
+                (e.g. within SNC blocks, or as psfcat stamps are randomly attributed) reuse the same InterpolatedImage, including
+                its internally computed k-space image. Set this to 0 to disable the cache.
+        :param nbands: number of bands of rows of stamps (along iy) to draw in parallel, each in its own process.
+                The processes draw directly into images in shared memory, so there is nothing to copy or assemble.
+                This is meant to speed up large single images, when only few catalogs are simulated: inside a worker of sim.run.multi
+                with ncpu > 1, which cannot have child processes, I fall back to nbands = 1. The caches are per band.
+        :param seed: if given (positive int), seeds the random number generators, so that the same catalog, seed and nbands
+                give the same image. The band i uses its own generator, seeded with seed + 1 + i.
+                Do not give a seed via the drawimgkwargs of sim.run.multi, or all realizations will get the same noise!
+        
+        :param returnimg: if True, I also return the image of simulated and noisy galaxies (a galsim image with origin (0, 0),
+                as tools.image.loadimg would give), so that it can be measured without reading it from disk.
+        
+        :returns: a dict with the statistics of the profile and PSF caches, so that you can size them.
+                If returnimg is True, a tuple (this dict, image).
         
         .. note::
                 See this function in MomentsML v4 (great3) for attempts to speed up galsim by playing with fft params, accuracy, etc...
@@ -292,22 +386,12 @@ def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, s
                 # A special function checks the combination of settings in the provided catalog:
                 todo = checkcat(catalog)
                 
+                psfimg = None
                 if "loadpsfimg" in todo:
-                        psfimg = catalog.meta["psf"].load() # Loading the actual GalSim Image
-                        psfinfo = catalog.meta["psf"]
-        
-                if "tru_pixel" in todo:
-                        # This is only if you want "effective pixels" larger than the actual pixels (related to SBE, normally you don't want this).
-                        pix = galsim.Pixel(catalog["tru_pixel"][0]) # We have checked in checkcat that all values are equal.
-                        
-                # Galsim random number generators
-                rng = galsim.BaseDeviate()
-                ud = galsim.UniformDeviate() # This gives a random float in [0, 1)
+                        psfimg = catalog.meta["psf"].load() # Loading the actual GalSim Image (only once, also with several bands)
 
-                # We prepare the big images :
-                gal_image = galsim.ImageF(stampsize * nx , stampsize * ny)
-                trugal_image = galsim.ImageF(stampsize * nx , stampsize * ny)
-                psf_image = galsim.ImageF(stampsize * nx , stampsize * ny)
+                # Galsim random number generator, for the PSF core (each band of rows gets its own generators, see below)
+                ud = galsim.UniformDeviate(seed) # This gives a random float in [0, 1)
 
                 #PSF_CORE must be odd for the newsextractor understand it.
                 psfcore_image=galsim.ImageF(stampsize -1 , stampsize -1)
@@ -328,180 +412,67 @@ def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, s
                                 psf.drawImage(psfcore_image, method="auto") # Will convolve by the sampling pixel.
                                 psfcore_image.write(simpsfcoreimgfilepath)
       
-                                
+                if neighbors_catalog is None or len(neighbors_catalog)==0 : neighbors_catalog =  [None]*len(catalog)
                 
+                if nbands > 1 and multiprocessing.current_process().daemon:
+                        logger.warning("drawimg is running in a daemonic process (e.g., a worker of sim.run.multi with ncpu > 1), which cannot have children. Using nbands = 1.")
+                        nbands = 1
+                nbands = max(1, min(nbands, ny))
                 
-                gal_image.scale = 1.0 # we use pixels as units. Note that if you change something here, you also have to change the jitter.
-                trugal_image.scale = 1.0
-                psf_image.scale = 1.0
-
-                # And loop through the catalog:
-
-                if neighbors_catalog is None or len(neighbors_catalog)==0 : neighbors_catalog =  [None]*len(catalog)
+                # The bands of rows of stamps, and their seeds. The bands only depend on ny and nbands, and each band has its own
+                # random number generator seeded by seed + 1 + bandindex, so that a given seed reproduces the same image.
+                bandedges = np.linspace(0, ny, nbands + 1).astype(int)
+                bandindices = [np.where(np.logical_and(catalog["iy"] >= bandedges[i], catalog["iy"] < bandedges[i+1]))[0] for i in range(nbands)]
+                if seed is None:
+                        bandseeds = [None] * nbands
+                else:
+                        bandseeds = [seed + 1 + i for i in range(nbands)]
                 
-                for row,  nei_row in zip(catalog, neighbors_catalog):
-                        # Some simplistic progress indication:
-                        fracdone = float(row.index) / len(catalog)
-                        if row.index%500 == 0:
-                                logger.info("%6.2f%% done (%i/%i) " % (fracdone*100.0, row.index, len(catalog)))
-                        
-                        # We will draw this galaxy in a postage stamp, but first we need the bounds of this stamp.
-                        ix = int(row["ix"])
-                        iy = int(row["iy"])
-                        assert ix < nx and iy < ny
-                        bounds = galsim.BoundsI(ix*stampsize+1 , (ix+1)*stampsize, iy*stampsize+1 , (iy+1)*stampsize) # Default Galsim convention, index starts at 1.
-                        gal_stamp = gal_image[bounds]
-                        trugal_stamp = trugal_image[bounds]
-                        psf_stamp = psf_image[bounds]
-        
-                        # We draw the desired profile
-                        profile_type = params.profile_types[row["tru_type"]]
-                        
-                        if profile_type == "Sersic":
-                                if sersiccut is None:
-                                        trunc = 0
-                                else:
-                                        trunc = float(row["tru_rad"]) * sersiccut
-                                gal = galsim.Sersic(n=float(row["tru_sersicn"]), half_light_radius=float(row["tru_rad"]), flux=float(row["tru_flux"]), gsparams=gsparams, trunc=trunc)
-                                # We make this profile elliptical
-                                gal = gal.shear(g1=row["tru_g1"], g2=row["tru_g2"]) # This adds the ellipticity to the galaxy
-
-                        elif profile_type == "Gaussian":
-                                
-                                gal = galsim.Gaussian(flux=float(row["tru_flux"]), sigma=float(row["tru_sigma"]), gsparams=gsparams)
-                                # We make this profile elliptical
-                                gal = gal.shear(g1=row["tru_g1"], g2=row["tru_g2"]) # This adds the ellipticity to the galaxy        
-        
-                        elif profile_type == "EBulgeDisk":
-                        
-                                # A more advanced Bulge + Disk model
-                                # It needs GalSim version master, as of April 2017 (probably 1.5).
-                                
-                                # Get a Sersic bulge:
-                                bulge = galsim.Sersic(n=row["tru_bulge_sersicn"], half_light_radius=row["tru_bulge_hlr"], flux=row["tru_bulge_flux"])
-                                # Make it elliptical:
-                                bulge_ell = galsim.Shear(g=row["tru_bulge_g"], beta=row["tru_theta"] * galsim.degrees)
-                                bulge = bulge.shear(bulge_ell)
-                                
-                                # Get a disk
-                                scale_radius = row["tru_disk_hlr"] / galsim.Exponential._hlr_factor
-                                disk = galsim.InclinedExponential(inclination=row["tru_disk_tilt"] * galsim.degrees, scale_radius=scale_radius,
-                                        flux=row["tru_disk_flux"], scale_h_over_r=row["tru_disk_scale_h_over_r"])
-                                # Rotate it in the same orientation as the bulge:
-                                disk = disk.rotate(row["tru_theta"] * galsim.degrees)
-                                
-                                # And we add those profiles, as done in GalSim demo3.py :
-                                gal = bulge + disk
-                                
-                        else:
-                                raise RuntimeError("Unknown galaxy profile!")        
+                bandkwargs = {"todo":todo, "psfimg":psfimg, "gsparams":gsparams, "sersiccut":sersiccut, "addnoise":addnoise,
+                        "profilecachesize":profilecachesize, "psfcachemaxmb":psfcachemaxmb}
                 
+                # We prepare the big images (only the requested ones). With several bands, their pixels live in shared memory.
+                imagepaths = [simgalimgfilepath or "memory", simtrugalimgfilepath, simpsfimgfilepath] # The galaxy image is always drawn
+                xsize = stampsize * nx
+                ysize = stampsize * ny
                 
-                        # And now we add lensing, if s1, s2 and mu are different from no lensing...
-                        if row["tru_s1"] != 0 or row["tru_s2"] != 0 or row["tru_mu"] != 1:
-                                gal = gal.lens(float(row["tru_s1"]), float(row["tru_s2"]), float(row["tru_mu"]))
-                        else:
-                                pass
-                                #logger.info("No lensing!")
-                        
-                        
-                        # We apply some jitter to the position of this galaxy
-                        xjitter = ud() - 0.5 # This is the minimum amount -- should we do more, as real galaxies are not that well centered in their stamps ?
-                        yjitter = ud() - 0.5
-                        gal = gal.shift(xjitter,yjitter)
-                        
-                        # We draw the pure unconvolved galaxy
-                        if simtrugalimgfilepath != None:
-                                gal.drawImage(trugal_stamp, method="auto") # Will convolve by the sampling pixel.
-                                # We draw the pure unconvolved neighbors
-                                if nei_row is not None:
-                                        #logger.info("Drawing image with neighbors")
-                                        for doc in nei_row:           
-                                                nei = draw_neighbor( neighbors_config=doc, psf=None)
-                                                conv = doc['profile_type'] in ["Gaussian_PSF", "Stamp_PSF"]
-                                                if conv and type(conv) == bool:
-                                                        logger.warning("Can not draw point sources in trugal_stamp")
-                                                else:
-                                                        pos = galsim.PositionD(row["x"] + doc["x_rel"],row["y"] + doc["y_rel"])
-                                                        nei.drawImage(trugal_stamp, center=pos,  add_to_image=True,  method="auto" )
-                                
-
-                        # We prepare/get the PSF and do the convolution:
-                        
-                        # Should the final operation skip the convolution by the pixel (because the PSF already is in large pixels) ?
-                        skip_pixel_conv = False
+                if nbands == 1:
+                
+                        # gal_image.scale is 1.0, we use pixels as units. Note that if you change something here, you also have to change the jitter.
+                        (gal_image, trugal_image, psf_image) = [None if path is None else galsim.ImageF(xsize, ysize, scale=1.0) for path in imagepaths]
+                        bandkwargs["seed"] = bandseeds[0]
+                        cachestats = _drawband(catalog, neighbors_catalog, gal_image, trugal_image, psf_image, **bandkwargs)
+                
+                else:
+                
+                        logger.info("Drawing the %i rows of stamps in %i bands of %s rows, in parallel..." % (ny, nbands, "/".join(map(str, np.diff(bandedges)))))
+                        sharedarrays = [None if path is None else multiprocessing.RawArray(ctypes.c_float, xsize * ysize) for path in imagepaths]
+                        queue = multiprocessing.Queue()
+                        processes = []
+                        for (bandindex, indices) in enumerate(bandindices):
+                                bandkwargs["seed"] = bandseeds[bandindex]
+                                p = multiprocessing.Process(target=_bandworker, args=(bandindex, catalog[indices], [neighbors_catalog[i] for i in indices],
+                                        sharedarrays, xsize, ysize, dict(bandkwargs), queue))
+                                p.start()
+                                processes.append(p)
                         
-                        if "usegausspsf" in todo:
-                                
-                                if row["tru_psf_sigma"] < 0.0:
-                                        raise RuntimeError("Unknown hack!")        
-                                else:
-                                        psf = galsim.Gaussian(flux=1., sigma=row["tru_psf_sigma"])        
-                                        psf = psf.shear(g1=row["tru_psf_g1"], g2=row["tru_psf_g2"])
+                        # We collect the results before joining, the queue could otherwise block the processes.
+                        bandresults = _collectbands(processes, queue)
+                        for p in processes:
+                                p.join()
+                        failedbands = [bandindex for (bandindex, result) in sorted(bandresults.items()) if isinstance(result, str)]
+                        if len(failedbands) > 0:
+                                raise RuntimeError("Drawing of band(s) %s failed:\n%s" % (failedbands, "\n".join([bandresults[bandindex] for bandindex in failedbands])))
                         
-                                        # Let's apply some jitter to the position of the PSF (not sure if this is required, but should not harm ?)
-                                        psf_xjitter = ud() - 0.5
-                                        psf_yjitter = ud() - 0.5
-                                        psf = psf.shift(psf_xjitter,psf_yjitter)
-                                        
-                                if simpsfimgfilepath != None:
-                                        psf.drawImage(psf_stamp, method="auto") # Will convolve by the sampling pixel.
-                
-                                if "tru_pixel" in todo: # Not sure if this should only apply to gaussian PSFs, but so far this seems OK.
-                                        # Remember that this is an "additional" pixel convolution, not the usual sampling-related convolution that happens in drawImage.
-                                        galconv = galsim.Convolve([gal, psf, pix])
-                                
-                                else:
-                                        galconv = galsim.Convolve([gal,psf])
-                                
-                        elif "loadpsfimg" in todo:
-                                
-                                (inputpsfstamp, flag) = tools.image.getstamp(row[psfinfo.xname], row[psfinfo.yname], psfimg, psfinfo.stampsize)
-                                psfpixelscale = getattr(psfinfo, "pixelscale", 1.0) # Using getattr so that it works with old objects as well
-                                if psfpixelscale > 0.5:
-                                        #logger.warning("You seem to be using a sampled PSF with large pixels (e.g., observed stars). I'll do my best and skip the pixel conv, but this might well lead to errors.")
-                                        skip_pixel_conv = True
-                                if flag != 0:
-                                        raise RuntimeError("Could not extract a %ix%i stamp at (%.2f, %.2f) from the psfimg %s" %\
-                                                (psfinfo.stampsize, psfinfo.stampsize, row[psfinfo.xname], row[psfinfo.yname], psfinfo.name))
-                                psf = galsim.InterpolatedImage(inputpsfstamp, flux=1.0, scale=psfpixelscale)
-                                if simpsfimgfilepath != None:
-                                        psf.drawImage(psf_stamp, method="no_pixel") # psf_stamp has a different size than inputpsfstamp, so this could lead to problems one day.
-                                
-                                #galconv = galsim.Convolve([gal,psf], real_space=False)        
-                                galconv = galsim.Convolve([gal,psf])                        
-
-                        elif "nopsf" in todo:
-                                # Nothing to do                
-                                galconv = gal
-                                
-                        else:
-                                raise RuntimeError("Bug in todo.")
+                        # The images share their pixels with the RawArrays, there is nothing to assemble.
+                        (gal_image, trugal_image, psf_image) = [None if sharedarray is None else _sharedimage(sharedarray, xsize, ysize) for sharedarray in sharedarrays]
+                        cachestats = dict([(key, tools.cache.mergestats([bandresults[bandindex][key] for bandindex in range(nbands)])) for key in ["profilecache", "psfcache"]])
+                        logger.info("Cache hit rates over all bands: %.1f%% (profiles), %.1f%% (PSFs)" % (100.0*cachestats["profilecache"]["hitrate"], 100.0*cachestats["psfcache"]["hitrate"]))
                 
-                        # Draw the convolved galaxy        
-                        if skip_pixel_conv == False:        
-                                galconv.drawImage(gal_stamp, method="auto") # This will convolve by the image sampling pixel. Don't do this yourself ahead! 
-                        else:
-                                #logger.warning("NOT computing any pixel convolution")
-                                galconv.drawImage(gal_stamp, method="no_pixel") # Simply uses pixel-center values. Know what you are doing, see doc of galsim. 
-
-                        #Add neighbors to each galaxy in a stamp
-                        if nei_row is not None :
-                                for doc in nei_row:           
-                                        nei = draw_neighbor( neighbors_config=doc, psf=psf)
-                                        conv = doc['profile_type'] not in ["Gaussian_PSF", "Stamp_PSF"]
-                                        if conv and type(conv) == bool:
-                                                nei = galsim.Convolve([nei,psf])
-                                        pos = galsim.PositionD(row["x"] + doc["x_rel"],row["y"] + + doc["y_rel"])
-                                        nei.drawImage(gal_stamp, center=pos,  add_to_image=True,  method="auto" )
-                                                
-                                        
-                        # And add noise to the convolved galaxy:
-                        gal_stamp.addNoise(galsim.CCDNoise(rng, sky_level=float(row["tru_sky_level"]), gain=float(row["tru_gain"]), read_noise=float(row["tru_read_noise"])))
-
                 logger.info("Done with drawing, now writing output FITS files ...")
                 
-                gal_image.write(simgalimgfilepath)
+                if simgalimgfilepath is not None:
+                        gal_image.write(simgalimgfilepath)
                 
                 if simtrugalimgfilepath != None:
                         trugal_image.write(simtrugalimgfilepath)
@@ -519,6 +490,7 @@ def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, s
                         
                 """
                 logger.info("Using special hack for nicobackgals")
+                cachestats = {}
                                                 
                 gsparams = galsim.GSParams(xvalue_accuracy=2.e-4, kvalue_accuracy=2.e-4, maxk_threshold=5.e-3, folding_threshold=1.e-2)
                 pixel_scale = 0.1
@@ -585,12 +557,14 @@ def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, s
 
                       
                          # And add noise to the convolved galaxy:
-                        gal_stamp.addNoise(galsim.CCDNoise(rng, sky_level=float(row["tru_sky_level"]), gain=float(row["tru_gain"]), read_noise=float(row["tru_read_noise"])))
+                        if addnoise:
+                                gal_stamp.addNoise(galsim.CCDNoise(rng, sky_level=float(row["tru_sky_level"]), gain=float(row["tru_gain"]), read_noise=float(row["tru_read_noise"])))
         
                         
 
                 logger.info("Done with drawing, now writing output FITS files ...")
-                gal_image.write(simgalimgfilepath)
+                if simgalimgfilepath is not None:
+                        gal_image.write(simgalimgfilepath)
                 
         
                         
@@ -601,8 +575,324 @@ def drawimg(catalog, simgalimgfilepath="test.fits", simtrugalimgfilepath=None, s
         
         endtime = datetime.now()
         logger.info("This drawing took %s" % (str(endtime - starttime)))
+        if returnimg:
+                gal_image.setOrigin(0, 0)
+                return (cachestats, gal_image)
+        return cachestats
     
 
+def _drawband(catalog, neighbors_catalog, gal_image, trugal_image=None, psf_image=None, todo=None, psfimg=None, seed=None,
+        gsparams=None, sersiccut=None, addnoise=True, profilecachesize=100, psfcachemaxmb=500.0):
+        """
+        Draws the galaxies of catalog (typically a band of rows of stamps) into the stamps of the given full-size images.
+        This is the actual drawing loop of drawimg, see there for the parameters.
+        Only the stamps of the rows of catalog are written, so that several bands can draw in parallel into the same images.
+        
+        :param trugal_image: if None, the unconvolved galaxies are not drawn
+        :param psf_image: if None, the PSFs are not drawn
+        :param todo: the output of checkcat(catalog)
+        :param psfimg: the loaded PSF image, if "loadpsfimg" is in todo
+        :param seed: seed for the random number generators of this band. If None, they get seeded from the time.
+        
+        :returns: a dict with the statistics of the profile and PSF caches
+        """
+        
+        nx = catalog.meta["nx"]
+        ny = catalog.meta["ny"]
+        stampsize = catalog.meta["stampsize"]
+        
+        if "loadpsfimg" in todo:
+                psfinfo = catalog.meta["psf"]
+
+        if "tru_pixel" in todo:
+                # This is only if you want "effective pixels" larger than the actual pixels (related to SBE, normally you don't want this).
+                pix = galsim.Pixel(catalog["tru_pixel"][0]) # We have checked in checkcat that all values are equal.
+        
+        # Galsim random number generators
+        rng = galsim.BaseDeviate(seed)
+        ud = galsim.UniformDeviate(rng) # This gives a random float in [0, 1)
+        
+        # The cache of base Sersic profiles
+        profilecache = tools.cache.LRUCache(maxsize=profilecachesize, name="Sersic profile cache")
+        psfcache = tools.cache.LRUCache(maxbytes=psfcachemaxmb*1.0e6, name="PSF InterpolatedImage cache")
+
+        # And loop through the catalog:
+        
+        for row,  nei_row in zip(catalog, neighbors_catalog):
+                # Some simplistic progress indication:
+                fracdone = float(row.index) / len(catalog)
+                if row.index%500 == 0:
+                        logger.info("%6.2f%% done (%i/%i) " % (fracdone*100.0, row.index, len(catalog)))
+                
+                # We will draw this galaxy in a postage stamp, but first we need the bounds of this stamp.
+                ix = int(row["ix"])
+                iy = int(row["iy"])
+                assert ix < nx and iy < ny
+                bounds = galsim.BoundsI(ix*stampsize+1 , (ix+1)*stampsize, iy*stampsize+1 , (iy+1)*stampsize) # Default Galsim convention, index starts at 1.
+                gal_stamp = gal_image[bounds]
+                if trugal_image is not None:
+                        trugal_stamp = trugal_image[bounds]
+                if psf_image is not None:
+                        psf_stamp = psf_image[bounds]
+
+                # We draw the desired profile
+                profile_type = params.profile_types[row["tru_type"]]
+                
+                if profile_type == "Sersic":
+                        if sersiccut is None:
+                                unittrunc = 0 # No truncation
+                        else:
+                                unittrunc = float(sersiccut) # The truncation, in units of tru_rad
+                        profilekey = (float(row["tru_sersicn"]), unittrunc)
+                        baseprofile = profilecache.get(profilekey)
+                        if baseprofile is None:
+                                baseprofile = galsim.Sersic(n=profilekey[0], half_light_radius=1.0, flux=1.0, gsparams=gsparams, trunc=unittrunc)
+                                profilecache.put(profilekey, baseprofile)
+                        # The dilation scales both the half-light-radius and the truncation, and preserves the flux
+                        gal = baseprofile.dilate(float(row["tru_rad"])).withFlux(float(row["tru_flux"]))
+                        # We make this profile elliptical
+                        gal = gal.shear(g1=row["tru_g1"], g2=row["tru_g2"]) # This adds the ellipticity to the galaxy
+
+                elif profile_type == "Gaussian":
+                        
+                        gal = galsim.Gaussian(flux=float(row["tru_flux"]), sigma=float(row["tru_sigma"]), gsparams=gsparams)
+                        # We make this profile elliptical
+                        gal = gal.shear(g1=row["tru_g1"], g2=row["tru_g2"]) # This adds the ellipticity to the galaxy        
+
+                elif profile_type == "EBulgeDisk":
+                
+                        # A more advanced Bulge + Disk model
+                        # It needs GalSim version master, as of April 2017 (probably 1.5).
+                        
+                        # Get a Sersic bulge:
+                        bulge = galsim.Sersic(n=row["tru_bulge_sersicn"], half_light_radius=row["tru_bulge_hlr"], flux=row["tru_bulge_flux"])
+                        # Make it elliptical:
+                        bulge_ell = galsim.Shear(g=row["tru_bulge_g"], beta=row["tru_theta"] * galsim.degrees)
+                        bulge = bulge.shear(bulge_ell)
+                        
+                        # Get a disk
+                        scale_radius = row["tru_disk_hlr"] / galsim.Exponential._hlr_factor
+                        disk = galsim.InclinedExponential(inclination=row["tru_disk_tilt"] * galsim.degrees, scale_radius=scale_radius,
+                                flux=row["tru_disk_flux"], scale_h_over_r=row["tru_disk_scale_h_over_r"])
+                        # Rotate it in the same orientation as the bulge:
+                        disk = disk.rotate(row["tru_theta"] * galsim.degrees)
+                        
+                        # And we add those profiles, as done in GalSim demo3.py :
+                        gal = bulge + disk
+                        
+                else:
+                        raise RuntimeError("Unknown galaxy profile!")        
+        
+        
+                # And now we add lensing, if s1, s2 and mu are different from no lensing...
+                if row["tru_s1"] != 0 or row["tru_s2"] != 0 or row["tru_mu"] != 1:
+                        gal = gal.lens(float(row["tru_s1"]), float(row["tru_s2"]), float(row["tru_mu"]))
+                else:
+                        pass
+                        #logger.info("No lensing!")
+                
+                
+                # We apply some jitter to the position of this galaxy
+                xjitter = ud() - 0.5 # This is the minimum amount -- should we do more, as real galaxies are not that well centered in their stamps ?
+                yjitter = ud() - 0.5
+                gal = gal.shift(xjitter,yjitter)
+                
+                # We draw the pure unconvolved galaxy
+                if trugal_image is not None:
+                        gal.drawImage(trugal_stamp, method="auto") # Will convolve by the sampling pixel.
+                        # We draw the pure unconvolved neighbors
+                        if nei_row is not None:
+                                #logger.info("Drawing image with neighbors")
+                                for doc in nei_row:           
+                                        nei = draw_neighbor( neighbors_config=doc, psf=None)
+                                        conv = doc['profile_type'] in ["Gaussian_PSF", "Stamp_PSF"]
+                                        if conv and type(conv) == bool:
+                                                logger.warning("Can not draw point sources in trugal_stamp")
+                                        else:
+                                                pos = galsim.PositionD(row["x"] + doc["x_rel"],row["y"] + doc["y_rel"])
+                                                nei.drawImage(trugal_stamp, center=pos,  add_to_image=True,  method="auto" )
+                        
+
+                # We prepare/get the PSF and do the convolution:
+                
+                # Should the final operation skip the convolution by the pixel (because the PSF already is in large pixels) ?
+                skip_pixel_conv = False
+                
+                if "usegausspsf" in todo:
+                        
+                        if row["tru_psf_sigma"] < 0.0:
+                                raise RuntimeError("Unknown hack!")        
+                        else:
+                                psf = galsim.Gaussian(flux=1., sigma=row["tru_psf_sigma"])        
+                                psf = psf.shear(g1=row["tru_psf_g1"], g2=row["tru_psf_g2"])
+                
+                                # Let's apply some jitter to the position of the PSF (not sure if this is required, but should not harm ?)
+                                psf_xjitter = ud() - 0.5
+                                psf_yjitter = ud() - 0.5
+                                psf = psf.shift(psf_xjitter,psf_yjitter)
+                                
+                        if psf_image is not None:
+                                psf.drawImage(psf_stamp, method="auto") # Will convolve by the sampling pixel.
+        
+                        if "tru_pixel" in todo: # Not sure if this should only apply to gaussian PSFs, but so far this seems OK.
+                                # Remember that this is an "additional" pixel convolution, not the usual sampling-related convolution that happens in drawImage.
+                                galconv = galsim.Convolve([gal, psf, pix])
+                        
+                        else:
+                                galconv = galsim.Convolve([gal,psf])
+                        
+                elif "loadpsfimg" in todo:
+                        
+                        psfpixelscale = getattr(psfinfo, "pixelscale", 1.0) # Using getattr so that it works with old objects as well
+                        if psfpixelscale > 0.5:
+                                #logger.warning("You seem to be using a sampled PSF with large pixels (e.g., observed stars). I'll do my best and skip the pixel conv, but this might well lead to errors.")
+                                skip_pixel_conv = True
+                        psfkey = (float(row[psfinfo.xname]), float(row[psfinfo.yname]))
+                        psf = psfcache.get(psfkey)
+                        if psf is None:
+                                (inputpsfstamp, flag) = tools.image.getstamp(row[psfinfo.xname], row[psfinfo.yname], psfimg, psfinfo.stampsize)
+                                if flag != 0:
+                                        raise RuntimeError("Could not extract a %ix%i stamp at (%.2f, %.2f) from the psfimg %s" %\
+                                                (psfinfo.stampsize, psfinfo.stampsize, row[psfinfo.xname], row[psfinfo.yname], psfinfo.name))
+                                psf = galsim.InterpolatedImage(inputpsfstamp, flux=1.0, scale=psfpixelscale)
+                                # Rough size estimate: the 4x padded real-space image (float64) and its k-space image, plus the stamp
+                                psfnbytes = 2 * (4 * psfinfo.stampsize)**2 * 8 + inputpsfstamp.array.nbytes
+                                psfcache.put(psfkey, psf, nbytes=psfnbytes)
+                        if psf_image is not None:
+                                psf.drawImage(psf_stamp, method="no_pixel") # psf_stamp has a different size than inputpsfstamp, so this could lead to problems one day.
+                        
+                        #galconv = galsim.Convolve([gal,psf], real_space=False)        
+                        galconv = galsim.Convolve([gal,psf])                        
+
+                elif "nopsf" in todo:
+                        # Nothing to do                
+                        galconv = gal
+                        
+                else:
+                        raise RuntimeError("Bug in todo.")
+        
+                # Draw the convolved galaxy        
+                if skip_pixel_conv == False:        
+                        galconv.drawImage(gal_stamp, method="auto") # This will convolve by the image sampling pixel. Don't do this yourself ahead! 
+                else:
+                        #logger.warning("NOT computing any pixel convolution")
+                        galconv.drawImage(gal_stamp, method="no_pixel") # Simply uses pixel-center values. Know what you are doing, see doc of galsim. 
+
+                #Add neighbors to each galaxy in a stamp
+                if nei_row is not None :
+                        for doc in nei_row:           
+                                nei = draw_neighbor( neighbors_config=doc, psf=psf)
+                                conv = doc['profile_type'] not in ["Gaussian_PSF", "Stamp_PSF"]
+                                if conv and type(conv) == bool:
+                                        nei = galsim.Convolve([nei,psf])
+                                pos = galsim.PositionD(row["x"] + doc["x_rel"],row["y"] + + doc["y_rel"])
+                                nei.drawImage(gal_stamp, center=pos,  add_to_image=True,  method="auto" )
+                                        
+                                
+                # And add noise to the convolved galaxy:
+                if addnoise:
+                        gal_stamp.addNoise(galsim.CCDNoise(rng, sky_level=float(row["tru_sky_level"]), gain=float(row["tru_gain"]), read_noise=float(row["tru_read_noise"])))
+
+        profilecache.logstats()
+        if "loadpsfimg" in todo:
+                psfcache.logstats()
+        return {"profilecache":profilecache.stats(), "psfcache":psfcache.stats()}
+
+
+
+def _sharedimage(sharedarray, xsize, ysize):
+        """
+        Returns a galsim.ImageF of xsize x ysize pixels (scale 1.0) that uses the memory of the given multiprocessing.RawArray,
+        without copying it.
+        """
+        array = np.frombuffer(sharedarray, dtype=np.float32).reshape(ysize, xsize)
+        return galsim.ImageF(array, scale=1.0)
+
+
+
+def _bandworker(bandindex, catalog, neighbors_catalog, sharedarrays, xsize, ysize, bandkwargs, queue):
+        """
+        Runs _drawband in a child process, drawing into the shared memory images, and puts (bandindex, cachestats) on the queue.
+        In case of failure, the put result is the traceback string, so that drawimg does not wait forever.
+        """
+        try:
+                images = [None if sharedarray is None else _sharedimage(sharedarray, xsize, ysize) for sharedarray in sharedarrays]
+                result = _drawband(catalog, neighbors_catalog, *images, **bandkwargs)
+        except:
+                result = traceback.format_exc()
+        queue.put((bandindex, result))
+
+
+def _collectbands(processes, queue, timeout=1.0):
+        """
+        Gets the results that the _bandworker processes (in the order of their bandindex) put on the queue, as a dict.
+        A band process that gets killed (e.g., by the OOM killer) cannot put its result. So whenever nothing arrives
+        within timeout seconds, I check that the processes whose result is missing are still alive, and otherwise
+        terminate the others and raise a RuntimeError naming the failed bands.
+        """
+        bandresults = {}
+        while len(bandresults) < len(processes):
+                # The processes that were dead before waiting would have had their result read by the get.
+                dead = [bandindex for (bandindex, p) in enumerate(processes) if p.exitcode is not None and bandindex not in bandresults]
+                try:
+                        (bandindex, result) = queue.get(timeout=timeout)
+                        bandresults[bandindex] = result
+                except Empty:
+                        if len(dead) > 0:
+                                for p in processes:
+                                        if p.is_alive():
+                                                p.terminate()
+                                        p.join()
+                                raise RuntimeError("Drawing of band(s) %s failed: the process(es) exited with code(s) %s without a result" % (dead, [processes[bandindex].exitcode for bandindex in dead]))
+        return bandresults
+
+
+
+def drawnoise(catalog, noiselessimgfilepath, simgalimgfilepath="test.fits"):
+        """
+        Turns a noiseless image drawn by drawimg (with addnoise=False) into a noisy realization.
+        This is much faster than calling drawimg again, as none of the profiles have to be rendered.
+        Of course, the position jitter of the galaxies is then the same as in the noiseless image.
+        
+        :param catalog: the input catalog that was given to drawimg to draw the noiseless image.
+                The noise parameters are read from its columns.
+        :param noiselessimgfilepath: path to the noiseless image
+        :param simgalimgfilepath: where I write the output image of noisy galaxies
+        
+        """
+        starttime = datetime.now()
+        
+        for f in ["tru_sky_level", "tru_gain", "tru_read_noise"]:
+                if f not in catalog.colnames:
+                        raise RuntimeError("The field '%s' is not in the catalog (i.e., the simulation parameters)!" % (f))
+        stampsize = catalog.meta["stampsize"]
+        
+        gal_image = galsim.fits.read(noiselessimgfilepath) # Note that we keep the GalSim default origin, as in drawimg
+        if gal_image.array.shape != (stampsize * catalog.meta["ny"], stampsize * catalog.meta["nx"]):
+                raise RuntimeError("The noiseless image %s does not match the catalog" % (noiselessimgfilepath))
+        
+        rng = galsim.BaseDeviate()
+        
+        noiseparams = [np.unique(catalog[f]) for f in ["tru_sky_level", "tru_gain", "tru_read_noise"]]
+        if all([len(values) == 1 for values in noiseparams]):
+                # The usual case: the same noise everywhere, so we can add it to the full image in one go.
+                logger.info("Adding the same noise to all the stamps at once")
+                gal_image.addNoise(galsim.CCDNoise(rng, sky_level=float(noiseparams[0][0]), gain=float(noiseparams[1][0]), read_noise=float(noiseparams[2][0])))
+        
+        else:
+                for row in catalog:
+                        ix = int(row["ix"])
+                        iy = int(row["iy"])
+                        bounds = galsim.BoundsI(ix*stampsize+1 , (ix+1)*stampsize, iy*stampsize+1 , (iy+1)*stampsize) # Same as in drawimg
+                        gal_stamp = gal_image[bounds]
+                        gal_stamp.addNoise(galsim.CCDNoise(rng, sky_level=float(row["tru_sky_level"]), gain=float(row["tru_gain"]), read_noise=float(row["tru_read_noise"])))
+        
+        gal_image.write(simgalimgfilepath)
+        
+        endtime = datetime.now()
+        logger.info("Adding noise to %s took %s" % (os.path.basename(noiselessimgfilepath), str(endtime - starttime)))
+        
+
 def drawneigh(doc=None, psf=None):
         gsparams=None
         if gsparams is None:
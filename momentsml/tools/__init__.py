@@ -11,4 +11,8 @@ from . import calc
 from . import metrics
 from . import dirs
 from . import imageinfo
+from . import cache
 
+from . import pool
+from . import lease
+from . import manifest
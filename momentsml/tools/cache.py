@@ -0,0 +1,115 @@
+"""
+A simple LRU cache, used to avoid recomputing or reloading expensive objects (GalSim profiles, images...).
+"""
+
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LRUCache():
+	"""
+	A dict-like container that keeps at most maxsize items (and/or maxbytes bytes),
+	evicting the least recently used items first. It counts hits and misses, so that
+	the cache can be sized.
+	"""
+
+	def __init__(self, maxsize=None, maxbytes=None, name="cache"):
+		"""
+		:param maxsize: maximum number of items. None means no limit.
+		:param maxbytes: maximum total size of the items, in bytes, as declared when putting them.
+			None means no limit.
+		:param name: a short name used in the logs
+		"""
+		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.name = name
+
+		self._items = collections.OrderedDict() # key -> (value, nbytes)
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __str__(self):
+		return "LRUCache '%s' (%i items, %.1f MB)" % (self.name, len(self._items), self.nbytes/1.0e6)
+
+	def __len__(self):
+		return len(self._items)
+
+	def __contains__(self, key):
+		return key in self._items
+
+	def get(self, key):
+		"""
+		Returns the cached value for key, or None if the key is not in the cache.
+		"""
+		if key in self._items:
+			self.hits += 1
+			(value, nbytes) = self._items.pop(key)
+			self._items[key] = (value, nbytes) # It's now the most recently used one
+			return value
+		else:
+			self.misses += 1
+			return None
+
+	def put(self, key, value, nbytes=0):
+		"""
+		Adds a value to the cache, evicting the least recently used items if needed.
+
+		:param nbytes: the size of the value, used if maxbytes is set
+		"""
+		if key in self._items:
+			self.nbytes -= self._items.pop(key)[1]
+
+		if self.maxbytes is not None and nbytes > self.maxbytes:
+			logger.debug("%s: item of %i bytes is larger than the cache, not caching it" % (self.name, nbytes))
+			return
+
+		self._items[key] = (value, nbytes)
+		self.nbytes += nbytes
+
+		while (self.maxsize is not None and len(self._items) > self.maxsize) or \
+			(self.maxbytes is not None and self.nbytes > self.maxbytes):
+			(oldkey, (oldvalue, oldnbytes)) = self._items.popitem(last=False)
+			self.nbytes -= oldnbytes
+			self.evictions += 1
+
+	def clear(self):
+		"""
+		Empties the cache (the counters are kept).
+		"""
+		self._items.clear()
+		self.nbytes = 0
+
+	def stats(self):
+		"""
+		Returns a dict with the counters of this cache.
+		"""
+		nrequests = self.hits + self.misses
+		return {
+			"name":self.name, "size":len(self._items), "nbytes":self.nbytes,
+			"hits":self.hits, "misses":self.misses, "evictions":self.evictions,
+			"hitrate":float(self.hits)/float(nrequests) if nrequests > 0 else 0.0
+			}
+
+	def logstats(self, level=logging.INFO):
+		"""
+		Logs the counters of this cache.
+		"""
+		s = self.stats()
+		logger.log(level, "%s: %i hits, %i misses (hit rate %.1f%%), %i evictions, %i items (%.1f MB)" %
+			(self.name, s["hits"], s["misses"], 100.0*s["hitrate"], s["evictions"], s["size"], s["nbytes"]/1.0e6))
+
+
+def mergestats(statslist):
+	"""
+	Combines the stats() dicts of several caches with the same role (e.g., one per process) into a single dict.
+	"""
+	merged = {"name":statslist[0]["name"] if len(statslist) > 0 else "cache"}
+	for key in ["size", "nbytes", "hits", "misses", "evictions"]:
+		merged[key] = sum([s[key] for s in statslist])
+	nrequests = merged["hits"] + merged["misses"]
+	merged["hitrate"] = float(merged["hits"])/float(nrequests) if nrequests > 0 else 0.0
+	return merged
@@ -91,6 +91,90 @@ def linreg(x, y, prob=0.68):
 	return ret
 
 
+class Accumulator():
+	"""
+	Accumulates statistics of arrays of values that are given one after the other (e.g., a column of the measurement
+	catalogs of successive realizations), without keeping these arrays in memory. Each element is treated independently,
+	and masked values are skipped. The results are the same as np.ma.count, np.ma.mean, np.ma.std and np.ma.median along the
+	axis of the realizations would give.
+	
+	The count, mean and M2 (sum of squared deviations from the mean) are updated with Welford's algorithm.
+	For the median, a sketch of at most mediansize values per element is kept: the first mediansize values, and then a uniform
+	reservoir sample of all the values. So the median is exact as long as no element got more than mediansize values,
+	and an approximation otherwise.
+	"""
+	
+	def __init__(self, shape, mediansize=None, seed=None):
+		"""
+		:param shape: shape of the arrays of values (typically, the number of rows of the catalogs)
+		:param mediansize: number of values kept per element to compute the median. If None, all values are kept (exact median,
+			but no memory gain for the median). If 0, no median gets computed.
+		:param seed: seed of the random generator used for the reservoir sampling
+		"""
+		self.shape = shape
+		self.mediansize = mediansize
+		self.n = np.zeros(shape, dtype=int)
+		self.mean = np.zeros(shape)
+		self.m2 = np.zeros(shape)
+		if mediansize is None:
+			self.sketch = [] # We keep all the masked arrays
+		elif mediansize > 0:
+			self.sketch = np.zeros(self.n.shape + (mediansize,))
+			self.rng = np.random.RandomState(seed)
+	
+	def add(self, values):
+		"""
+		Adds an array (or masked array) of values.
+		"""
+		data = np.ma.getdata(values).astype(float)
+		if data.shape != self.n.shape:
+			raise RuntimeError("Shape %s does not match the shape %s of the accumulator" % (data.shape, self.n.shape))
+		ok = np.logical_not(np.ma.getmaskarray(values))
+		
+		self.n += ok
+		delta = np.where(ok, data - self.mean, 0.0)
+		self.mean += delta / np.maximum(self.n, 1)
+		self.m2 += delta * np.where(ok, data - self.mean, 0.0)
+		
+		if self.mediansize is None:
+			self.sketch.append(np.ma.array(data, mask=np.logical_not(ok)))
+		elif self.mediansize > 0:
+			# The value goes into slot n-1 while the sketch is not full, and then replaces a random slot with probability mediansize/n
+			slots = np.where(self.n <= self.mediansize, self.n - 1, (self.rng.uniform(size=self.n.shape) * self.n).astype(int))
+			replace = np.logical_and(ok, slots < self.mediansize)
+			self.sketch[replace, slots[replace]] = data[replace]
+	
+	def getn(self):
+		"""
+		Returns the number of unmasked values of each element.
+		"""
+		return self.n.copy()
+	
+	def getmean(self):
+		"""
+		Returns the mean as a masked array (masked where no value was available).
+		"""
+		return np.ma.array(self.mean, mask=(self.n == 0))
+	
+	def getstd(self):
+		"""
+		Returns the standard deviation (with ddof = 0, as np.ma.std), as a masked array.
+		"""
+		return np.ma.array(np.sqrt(self.m2 / np.maximum(self.n, 1)), mask=(self.n == 0))
+	
+	def getmedian(self):
+		"""
+		Returns the median (approximate, if more than mediansize values were added), as a masked array.
+		"""
+		if self.mediansize == 0:
+			raise RuntimeError("This accumulator does not compute medians")
+		if self.mediansize is None:
+			return np.ma.median(np.ma.vstack(self.sketch), axis=0)
+		nkept = np.minimum(self.n, self.mediansize)
+		sketch = np.ma.array(self.sketch, mask=(np.arange(self.mediansize) >= nkept[..., np.newaxis]))
+		return np.ma.median(sketch, axis=-1)
+
+
 # This function is unsufficiently documented, and the fact != a float is a joke (a bad one).
 #
 #def complex2geometrical(e1, e2, fact=1):
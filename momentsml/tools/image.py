@@ -6,19 +6,92 @@ Helper functions related to manipulate fits images, get stamps...
 import os
 import galsim
 
+from . import cache
+
 import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 
 
+_imgcache = None # The optional LRU cache used by loadimg(), see setimgcache()
+_memimgs = {} # In-memory images that loadimg() returns instead of reading their files, see setmemimg()
+
+
+def setimgcache(maxmb=None):
+	"""
+	Enables an LRU cache of the images loaded by loadimg(), for the current process.
+	This is useful if several functions (e.g., several measfcts chained on the same catalog) load the same FITS file.
+	The images are keyed by their path and modification time, so that a modified file gets reloaded.
+	Images obtained from the cache are read-only (galsim "const" images), as they are shared.
+	
+	:param maxmb: maximum total size of the cached images, in MB. None disables (and empties) the cache.
+	"""
+	global _imgcache
+	if maxmb is None:
+		_imgcache = None
+	else:
+		logger.info("Enabling an image cache of %.1f MB for loadimg" % (maxmb))
+		_imgcache = cache.LRUCache(maxbytes=maxmb*1.0e6, name="loadimg cache")
+
+
+def getimgcache():
+	"""
+	Returns the LRUCache used by loadimg(), or None if no cache is enabled (see setimgcache()).
+	"""
+	return _imgcache
+
+
+def setmemimg(imgfilepath, img):
+	"""
+	Registers an in-memory image (with origin (0, 0)) for the current process, so that loadimg(imgfilepath) returns it
+	(read-only) without reading any file, even if imgfilepath does not exist. This lets measfcts, which load their images
+	through ImageInfo objects, run on images that were just drawn (see sim.run.multi with a measfct).
+	Call setmemimg(imgfilepath, None) to release the image.
+	"""
+	key = os.path.abspath(imgfilepath)
+	if img is None:
+		_memimgs.pop(key, None)
+	else:
+		_memimgs[key] = img
+
+
 def loadimg(imgfilepath):
 	"""
 	Uses GalSim to load and image from a FITS file, enforcing that the GalSim origin is (0, 0).
+	If a cache was enabled with setimgcache(), the image might come from the cache, and is then read-only.
+	Images registered with setmemimg() are returned directly (also read-only).
 
 	:param imgfilepath: path to FITS image
 	:returns: galsim image
 	"""
+	
+	memimg = _memimgs.get(os.path.abspath(imgfilepath), None)
+	if memimg is not None:
+		logger.info("Got image %s from memory" % (os.path.basename(imgfilepath)))
+		img = memimg.view(make_const=True)
+		img.origimgfilepath = imgfilepath
+		return img
+	
+	if _imgcache is not None:
+		key = (os.path.abspath(imgfilepath), os.path.getmtime(imgfilepath))
+		img = _imgcache.get(key)
+		if img is None:
+			img = _readimg(imgfilepath)
+			_imgcache.put(key, img, nbytes=img.array.nbytes)
+		else:
+			logger.info("Got FITS image %s from the cache" % (os.path.basename(imgfilepath)))
+		img = img.view(make_const=True) # A read-only view, with its own attributes
+		img.origimgfilepath = imgfilepath
+		return img
+	
+	return _readimg(imgfilepath)
+
 
+def _readimg(imgfilepath):
+	"""
+	The actual reading of the FITS file, for loadimg()
+	"""
+	
 	logger.info("Loading FITS image %s..." % (os.path.basename(imgfilepath)))
 	img = galsim.fits.read(imgfilepath)
 	img.setOrigin(0,0)
@@ -114,3 +187,77 @@ def getstamp(x, y, img, stampsize, getfrom=None):
 		return (None, 1)
 	else: 
 		return (stamp, 0)
+
+
+
+def getstampgrid(img, stampsize, nx=None, ny=None):
+	"""
+	Returns all the stamps of a gridded image (as drawn by sim.stampgrid.drawimg) as a numpy view of shape (ny, nx, stampsize, stampsize),
+	without copying any pixel. grid[iy, ix] is the stamp (in numpy orientation, i.e., [y, x]) with indices ix, iy.
+	Writing into this view writes into the image.
+	
+	:param img: input galsim or numpy image
+	:param stampsize: width = height of the stamps, in pixels
+	:param nx: number of stamps along x. If None, I deduce it from the image width.
+	:param ny: idem for y
+	"""
+	if isinstance(img, galsim.Image):
+		array = img.array
+	else:
+		array = np.asarray(img)
+	stampsize = int(stampsize)
+	
+	if nx is None:
+		nx = array.shape[1] // stampsize
+	if ny is None:
+		ny = array.shape[0] // stampsize
+	if array.shape != (ny * stampsize, nx * stampsize):
+		raise RuntimeError("The image shape %s does not correspond to a grid of %i x %i stamps of %i pixels" % (array.shape, nx, ny, stampsize))
+	
+	# The reshape of the (ny*stampsize, nx*stampsize) array and the swap of axes only change the strides.
+	grid = array.reshape(ny, stampsize, nx, stampsize).swapaxes(1, 2)
+	assert np.may_share_memory(grid, array)
+	return grid
+
+
+def getstampindices(catalog, stampsize, xname="x", yname="y"):
+	"""
+	Returns the grid indices (ix, iy) of the stamps "centered" at the positions (xname, yname) of a catalog, using the same
+	conventions as getstamp(). Raises a RuntimeError if some positions do not correspond to stamps of the grid.
+	"""
+	stampsize = int(stampsize)
+	xmins = np.round(np.asarray(catalog[xname], dtype=float) - 0.5).astype(int) - stampsize//2
+	ymins = np.round(np.asarray(catalog[yname], dtype=float) - 0.5).astype(int) - stampsize//2
+	if np.any(xmins % stampsize != 0) or np.any(ymins % stampsize != 0):
+		raise RuntimeError("The positions (%s, %s) do not correspond to a grid of stamps of %i pixels" % (xname, yname, stampsize))
+	return (xmins // stampsize, ymins // stampsize)
+
+
+def getstampcube(img, catalog, stampsize, xname="x", yname="y", nx=None, ny=None):
+	"""
+	Returns the stamps of a gridded image for all the rows of a catalog, as a numpy array of shape (n, stampsize, stampsize),
+	in the order of the catalog. This is the vectorized alternative to calling getstamp() for each row.
+	
+	The stamps of a row of the grid are interleaved in memory, so such a cube can in general not be a strided view of the image:
+	it gets gathered from the zero-copy view of getstampgrid() in a single numpy operation. Only for a single column of stamps
+	(nx == 1) in catalog order is the cube a view. Use getstampgrid() directly if you need to avoid any copy.
+	
+	:param img: input galsim or numpy image
+	:param catalog: table with the stamp positions
+	:param stampsize: width = height of the stamps, in pixels
+	:param xname: column containing the x positions of the stamp centers
+	:param yname: idem for y
+	:param nx: number of stamps along x. If None, I deduce it from the image width (catalog.meta["nx"] is a good choice).
+	:param ny: idem for y
+	
+	:returns: the numpy array of stamps. Stamp i is in numpy orientation ([y, x]), as the array attribute of the stamps of getstamp().
+	"""
+	grid = getstampgrid(img, stampsize, nx=nx, ny=ny)
+	(ny, nx) = grid.shape[:2]
+	(ix, iy) = getstampindices(catalog, stampsize, xname=xname, yname=yname)
+	if np.any(ix < 0) or np.any(ix >= nx) or np.any(iy < 0) or np.any(iy >= ny):
+		raise RuntimeError("Some positions (%s, %s) are outside of the %i x %i grid" % (xname, yname, nx, ny))
+	
+	if nx == 1 and np.array_equal(iy, np.arange(ny)):
+		return grid.reshape(ny, stampsize, stampsize) # A view
+	return grid[iy, ix]
@@ -73,9 +73,36 @@ class ImageInfo():
 	def load(self):
 		"""
 		Returns the image as GalSim Image object.
+		If an image cache is enabled (see tools.image.setimgcache), the image is read-only.
 		"""
 		return image.loadimg(self.filepath)
 
+	def loadstampgrid(self, catalog=None, stampsize=None):
+		"""
+		Loads the image and returns all its stamps as a (ny, nx, stampsize, stampsize) numpy view, see tools.image.getstampgrid.
+		This only makes sense for gridded images (e.g., simulations from sim.stampgrid).
+		
+		:param catalog: if given, its meta["nx"] and meta["ny"] (if available) are used to check the geometry of the image.
+		:param stampsize: a stampsize given e.g. as argument to a measfct, see get_stampsize()
+		"""
+		(nx, ny) = (None, None)
+		if catalog is not None:
+			(nx, ny) = (catalog.meta.get("nx", None), catalog.meta.get("ny", None))
+		return image.getstampgrid(self.load(), self.get_stampsize(stampsize), nx=nx, ny=ny)
+	
+	def loadstampcube(self, catalog, stampsize=None):
+		"""
+		Loads the image and returns the stamps of all rows of the catalog, in catalog order, as a (n, stampsize, stampsize) numpy array,
+		see tools.image.getstampcube. The positions are read from the xname and yname columns, and the grid size from
+		catalog.meta["nx"] and meta["ny"] if available.
+		
+		:param catalog: the catalog "linked" to this image
+		:param stampsize: a stampsize given e.g. as argument to a measfct, see get_stampsize()
+		"""
+		self.checkcolumns(catalog)
+		return image.getstampcube(self.load(), catalog, self.get_stampsize(stampsize), xname=self.xname, yname=self.yname,
+			nx=catalog.meta.get("nx", None), ny=catalog.meta.get("ny", None))
+
 
 	def checkcolumns(self, catalog):
 		"""
@@ -3,19 +3,37 @@ In/out functions
 """
 
 import os
+import json
+import base64
+import shutil
 import pickle
+import collections
+import numpy as np
 import astropy.io.fits
+import astropy.table
 import gzip
 
+from . import imageinfo
+
 import logging
 logger = logging.getLogger(__name__)
 
+
+catext = ".cat" # Extension of the columnar catalog directories, see writecolumns()
+
+
 def writepickle(obj, filepath, protocol = -1):
     """
     I write your python object obj into a pickle file at filepath.
     If filepath ends with .gz, I'll use gzip to compress the pickle.
+    If filepath ends with .cat, obj has to be an astropy table, and I'll write it as a columnar catalog
+    directory instead (see writecolumns()).
     Leave protocol = -1 : I'll use the latest binary protocol of pickle.
     """
+    if os.path.splitext(filepath)[1] == catext:
+        writecolumns(obj, filepath)
+        return
+    
     if os.path.splitext(filepath)[1] == ".gz":
         pkl_file = gzip.open(filepath, 'wb')
     else:
@@ -29,7 +47,12 @@ def readpickle(filepath):
     """
     I read a pickle file and return whatever object it contains.
     If the filepath ends with .gz, I'll unzip the pickle file.
+    If the filepath ends with .cat, I'll read the columnar catalog directory, memory-mapped in copy-on-write mode
+    (see readcolumns()): the columns can be modified as for a pickled catalog, without changing the files.
     """
+    if os.path.splitext(filepath)[1] == catext:
+        return readcolumns(filepath)
+    
     if os.path.splitext(filepath)[1] == ".gz":
         pkl_file = gzip.open(filepath,'rb')
     else:
@@ -60,3 +83,163 @@ def tofits(a, filepath):
 
     astropy.io.fits.writeto(filepath, a.transpose(), clobber=1)
     logger.info("Wrote %s array to %s" % (a.shape, filepath))
+
+
+def writecolumns(cat, dirpath):
+    """
+    I write an astropy table into a directory, with one .npy file per column (and one for the mask
+    of each masked column), plus a JSON file "table.json" describing the columns and holding the meta.
+    Such a directory can be read back with memory-mapping, see readcolumns().
+    
+    Multidimensional columns, masks, fill values, units, formats and descriptions are kept.
+    The meta gets written as JSON, including ImageInfo objects. Values that JSON cannot represent get pickled inside
+    the JSON file (see _tojson()), so the round-trip is exact, but those values are not human-readable.
+    
+    The directory is first written under a temporary name. An existing catalog at dirpath is then renamed aside,
+    the new directory renamed into place, and only then the old one gets deleted. So dirpath always holds a complete
+    catalog, except for the short moment between the two renames (processes having memory-mapped the old files
+    can continue to read them).
+    """
+    tmpdirpath = "%s.tmp%i" % (dirpath, os.getpid())
+    if os.path.exists(tmpdirpath):
+        shutil.rmtree(tmpdirpath)
+    os.makedirs(tmpdirpath)
+    
+    for (i, colname) in enumerate(cat.colnames):
+        col = cat[colname]
+        data = np.asarray(col)
+        np.save(os.path.join(tmpdirpath, "%i.npy" % i), data, allow_pickle=(data.dtype.kind == "O"))
+        if isinstance(col, astropy.table.MaskedColumn):
+            np.save(os.path.join(tmpdirpath, "%i_mask.npy" % i), np.ma.getmaskarray(col))
+    writecolumnsinfo(cat, tmpdirpath)
+    
+    if os.path.exists(dirpath):
+        olddirpath = "%s.old%i" % (dirpath, os.getpid())
+        if os.path.exists(olddirpath):
+            shutil.rmtree(olddirpath)
+        os.rename(dirpath, olddirpath)
+        os.rename(tmpdirpath, dirpath)
+        shutil.rmtree(olddirpath)
+    else:
+        os.rename(tmpdirpath, dirpath)
+    logger.info("Wrote %i columns into %s" % (len(cat.colnames), dirpath))
+
+
+def writecolumnsinfo(cat, dirpath):
+    """
+    I write the "table.json" file of the table cat into dirpath, in which the data of each column i (and its mask,
+    for masked columns) are already saved as "i.npy" (and "i_mask.npy").
+    This allows to fill the .npy files directly, for instance as memory-mapped arrays (see np.lib.format.open_memmap),
+    and still get a directory that readcolumns() can read.
+    """
+    colinfos = []
+    for (i, colname) in enumerate(cat.colnames):
+        col = cat[colname]
+        colinfo = {"name":colname, "file":"%i.npy" % i, "dtype":col.dtype.str, "shape":list(col.shape), "object":col.dtype.kind == "O",
+            "masked":isinstance(col, astropy.table.MaskedColumn),
+            "unit":None if col.unit is None else col.unit.to_string(), "format":col.format, "description":col.description,
+            "meta":_tojson(col.meta)}
+        if colinfo["masked"]:
+            colinfo["maskfile"] = "%i_mask.npy" % i
+            colinfo["fill_value"] = _tojson(col.fill_value)
+        colinfos.append(colinfo)
+    
+    with open(os.path.join(dirpath, "table.json"), "w") as f:
+        json.dump({"nrows":len(cat), "masked":cat.masked, "colinfos":colinfos, "meta":_tojson(cat.meta)}, f, indent=1)
+
+
+def readcolumns(dirpath, mmap_mode="c", colnames=None):
+    """
+    I read a table written by writecolumns().
+    By default the column data is memory-mapped instead of being loaded.
+    So only the pages of the columns that are actually used get read from disk, and several processes
+    reading the same directory share the same pages of memory (until they modify them).
+    
+    :param mmap_mode: "c" (copy-on-write: the columns can be modified, but the changes do not go to the files),
+        "r" (read-only, any assignment raises an error), or None to load the columns into memory (see numpy.load).
+    :param colnames: if set, only these columns get read (in this order).
+    """
+    with open(os.path.join(dirpath, "table.json")) as f:
+        tableinfo = json.load(f)
+    
+    colinfos = tableinfo["colinfos"]
+    if colnames is not None:
+        colinfodict = dict([(colinfo["name"], colinfo) for colinfo in colinfos])
+        missing = [colname for colname in colnames if colname not in colinfodict]
+        if len(missing) > 0:
+            raise RuntimeError("Columns %s are not in %s" % (missing, dirpath))
+        colinfos = [colinfodict[colname] for colname in colnames]
+    
+    cols = []
+    for colinfo in colinfos:
+        if colinfo["object"]: # Object arrays cannot be memory-mapped
+            data = np.load(os.path.join(dirpath, colinfo["file"]), allow_pickle=True)
+        else:
+            data = np.load(os.path.join(dirpath, colinfo["file"]), mmap_mode=mmap_mode)
+        kwargs = {"name":colinfo["name"], "unit":colinfo["unit"], "format":colinfo["format"],
+            "description":colinfo["description"], "meta":_fromjson(colinfo["meta"]), "copy":False}
+        if colinfo["masked"]:
+            mask = np.load(os.path.join(dirpath, colinfo["maskfile"]), mmap_mode=mmap_mode)
+            # Given as a masked array, so that astropy does not copy the (memory-mapped) mask
+            cols.append(astropy.table.MaskedColumn(data=np.ma.MaskedArray(data, mask=mask, copy=False), fill_value=_fromjson(colinfo["fill_value"]), **kwargs))
+        else:
+            cols.append(astropy.table.Column(data=data, **kwargs))
+    
+    cat = astropy.table.Table(cols, masked=tableinfo["masked"], meta=_fromjson(tableinfo["meta"]), copy=False)
+    logger.info("Read %i columns from %s%s" % (len(cols), dirpath, "" if mmap_mode is None else " (memory-mapped, mode '%s')" % mmap_mode))
+    return cat
+
+
+def _tojson(obj):
+    """
+    Converts obj (typically the meta dict of a table) into something that json can write, and that _fromjson() converts back.
+    Dicts (with string keys), lists, strings, numbers, numpy scalars and arrays and ImageInfo objects get readable representations,
+    anything else gets pickled (and base64-encoded).
+    """
+    if isinstance(obj, np.generic) and obj.dtype.kind in "biufU":
+        return {"__type__":"numpy", "dtype":obj.dtype.str, "value":obj.item()}
+    elif obj is None or type(obj) in (bool, int, float, str):
+        return obj
+    elif isinstance(obj, list):
+        return [_tojson(item) for item in obj]
+    elif isinstance(obj, dict) and all([isinstance(key, str) for key in obj.keys()]) and "__type__" not in obj:
+        return {"__type__":"OrderedDict" if isinstance(obj, collections.OrderedDict) else "dict",
+            "items":[[key, _tojson(value)] for (key, value) in obj.items()]}
+    elif isinstance(obj, tuple) and type(obj) is tuple:
+        return {"__type__":"tuple", "items":[_tojson(item) for item in obj]}
+    elif isinstance(obj, np.ndarray) and type(obj) is np.ndarray and obj.dtype.kind in "biufU":
+        return {"__type__":"ndarray", "dtype":obj.dtype.str, "shape":list(obj.shape), "value":obj.tolist()}
+    elif type(obj) is imageinfo.ImageInfo:
+        return {"__type__":"ImageInfo", "attributes":_tojson(obj.__dict__)}
+    else:
+        return {"__type__":"pickle", "value":base64.b64encode(pickle.dumps(obj, -1)).decode("ascii")}
+
+
+def _fromjson(obj):
+    """
+    The inverse of _tojson().
+    """
+    if isinstance(obj, list):
+        return [_fromjson(item) for item in obj]
+    elif not isinstance(obj, dict):
+        return obj
+    
+    objtype = obj["__type__"]
+    if objtype == "dict":
+        return dict([(key, _fromjson(value)) for (key, value) in obj["items"]])
+    elif objtype == "OrderedDict":
+        return collections.OrderedDict([(key, _fromjson(value)) for (key, value) in obj["items"]])
+    elif objtype == "tuple":
+        return tuple([_fromjson(item) for item in obj["items"]])
+    elif objtype == "numpy":
+        return np.array(obj["value"], dtype=obj["dtype"])[()]
+    elif objtype == "ndarray":
+        return np.array(obj["value"], dtype=obj["dtype"]).reshape(obj["shape"])
+    elif objtype == "ImageInfo":
+        img = imageinfo.ImageInfo.__new__(imageinfo.ImageInfo)
+        img.__dict__.update(_fromjson(obj["attributes"]))
+        return img
+    elif objtype == "pickle":
+        return pickle.loads(base64.b64decode(obj["value"]))
+    else:
+        raise RuntimeError("Unknown type %s in JSON" % (objtype))
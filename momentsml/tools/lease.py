@@ -0,0 +1,148 @@
+"""
+Lease files, to let several independent processes (or hosts sharing a filesystem) work on the same set of tasks,
+without doing any task twice.
+
+A task is identified by the path of its output file. A process that wants to do the task first acquires a lease,
+i.e., creates the file "<output>.lease" (atomically: only one process can succeed), then checks that the output
+does not exist yet, does the task, and removes the lease once the output is written.
+
+While a lease is held, a thread regularly touches the lease file. A lease that has not been touched for longer than
+its expiry time is considered stale (its process was probably killed), and can be reclaimed by another process.
+The expiry should be much longer than the heartbeat (a third of the expiry), and than the clock differences between hosts.
+"""
+
+import os
+import json
+import time
+import socket
+import datetime
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Lease():
+	"""
+	A lease on the task whose output is written to filepath.
+	"""
+
+	def __init__(self, filepath, expiry=3600.0):
+		"""
+		:param filepath: the path of the output file of the task. The lease file is this path + ".lease".
+		:param expiry: time in seconds after which a lease that was not refreshed is considered stale.
+		"""
+		self.filepath = filepath
+		self.leasefilepath = filepath + ".lease"
+		self.expiry = expiry
+		self.held = False
+		self._stop = None
+		self._thread = None
+
+	def __str__(self):
+		return "Lease on %s" % (self.filepath)
+
+	def acquire(self):
+		"""
+		Tries to acquire the lease, reclaiming it if it is stale.
+
+		:returns: True if the lease is now held by this process, False if another process holds it.
+		"""
+		if self._create():
+			return True
+		if self.isstale():
+			# To avoid that two processes reclaim the same stale lease, the stale file is first renamed, which only one can do.
+			stalefilepath = "%s.stale.%s.%i" % (self.leasefilepath, socket.gethostname(), os.getpid())
+			try:
+				os.rename(self.leasefilepath, stalefilepath)
+			except OSError:
+				return False # Another process was faster
+			# Between isstale() and the rename, another process might have reclaimed the lease itself,
+			# in which case we have just renamed its fresh lease file, and have to put it back.
+			if not _isstale(stalefilepath, self.expiry):
+				self._restore(stalefilepath)
+				return False
+			logger.warning("Reclaiming stale lease %s (%s)" % (self.leasefilepath, _readinfo(stalefilepath)))
+			os.remove(stalefilepath)
+			return self._create()
+		return False
+
+	def release(self):
+		"""
+		Stops the heartbeat and removes the lease file.
+		"""
+		if not self.held:
+			return
+		self._stop.set()
+		self._thread.join()
+		try:
+			os.remove(self.leasefilepath)
+		except OSError:
+			logger.warning("Lease file %s had disappeared" % (self.leasefilepath))
+		self.held = False
+
+	def isstale(self):
+		"""
+		True if the lease file exists and was not refreshed during the expiry time.
+		"""
+		return _isstale(self.leasefilepath, self.expiry)
+
+	def _restore(self, stalefilepath):
+		"""
+		Puts back a lease file that was renamed by mistake, without overwriting a lease file that might exist by now.
+		"""
+		try:
+			os.link(stalefilepath, self.leasefilepath) # Fails if the file exists, as O_EXCL
+		except FileExistsError:
+			logger.warning("Could not restore the lease file %s, it was created again meanwhile" % (self.leasefilepath))
+		except OSError: # Hard links are not supported by this filesystem
+			if not os.path.exists(self.leasefilepath):
+				os.rename(stalefilepath, self.leasefilepath)
+		if os.path.exists(stalefilepath):
+			os.remove(stalefilepath)
+
+	def _create(self):
+		"""
+		Atomically creates the lease file, and starts the heartbeat. Returns False if the file already exists.
+		"""
+		try:
+			fd = os.open(self.leasefilepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except OSError:
+			return False
+		with os.fdopen(fd, "w") as f:
+			json.dump({"host":socket.gethostname(), "pid":os.getpid(), "acquired":datetime.datetime.now().isoformat()}, f)
+		self.held = True
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._heartbeat)
+		self._thread.daemon = True
+		self._thread.start()
+		return True
+
+	def _heartbeat(self):
+		while not self._stop.wait(self.expiry / 3.0):
+			try:
+				os.utime(self.leasefilepath, None)
+			except OSError:
+				logger.warning("Could not refresh lease file %s" % (self.leasefilepath))
+
+
+def _isstale(leasefilepath, expiry):
+	"""
+	True if the file exists and was not modified during the expiry time.
+	"""
+	try:
+		age = time.time() - os.path.getmtime(leasefilepath)
+	except OSError:
+		return False # The lease was just released
+	return age > expiry
+
+
+def _readinfo(leasefilepath):
+	"""
+	Returns the content of a lease file, for log messages.
+	"""
+	try:
+		with open(leasefilepath) as f:
+			return f.read()
+	except (OSError, IOError):
+		return "unreadable"
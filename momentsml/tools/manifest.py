@@ -0,0 +1,106 @@
+"""
+Manifests: small append-only index files describing the contents of a simulation (or measurement) directory.
+
+sim.run.multi appends one line per catalog (its name, number of rows, and the ImageInfos of its realizations),
+and one line each time a realization is drawn (or has failed). meas.run.onsims does the same in the measdir for the
+measurement catalogs. Functions exploring these directories (meas.run.onsims, meas.utils.simmeasdict, meas.avg.onsims)
+then only have to read this file, instead of listing directories and unpickling every catalog.
+
+The file has one JSON record per line. Each record is written with a single os.write() on a file opened in append mode,
+so that records from several processes do not get mixed. The last record about a realization defines its status.
+Paths are stored relative to the directory containing the manifest, so that the directories can be moved.
+"""
+
+import os
+import json
+import datetime
+import collections
+
+from . import imageinfo
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def getpath(workdir):
+	"""
+	Returns the path of the manifest of a simulation or measurement workdir (the directory named after the simparams).
+	"""
+	return os.path.join(workdir, "manifest.jsonl")
+
+
+def append(manifestfilepath, record):
+	"""
+	Appends a record (a dict) to the manifest, with a timestamp.
+	"""
+	record = dict(record)
+	record["time"] = datetime.datetime.now().isoformat()
+	line = (json.dumps(record) + "\n").encode("utf-8")
+	fd = os.open(manifestfilepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+	try:
+		os.write(fd, line)
+	finally:
+		os.close(fd)
+
+
+def addcatalog(manifestfilepath, catalog, catfilepath):
+	"""
+	Records a catalog written by sim.run.multi, with the ImageInfos of its realizations (in meta["imgreas"]) as "pending".
+	"""
+	manifestdir = os.path.dirname(manifestfilepath)
+	append(manifestfilepath, {
+		"type":"catalog", "catname":catalog.meta["catname"], "catfilepath":os.path.relpath(catfilepath, manifestdir), "nrows":len(catalog),
+		"imgreas":[{"filepath":os.path.relpath(imgrea.filepath, manifestdir), "xname":imgrea.xname, "yname":imgrea.yname,
+			"stampsize":imgrea.stampsize, "pixelscale":imgrea.pixelscale} for imgrea in catalog.meta["imgreas"]]
+		})
+
+
+def addrea(manifestfilepath, catname, reaindex, status, filepath=None):
+	"""
+	Records the status ("done" or "failed") of a realization of a catalog.
+	A realization that was measured on the fly by sim.run.multi, without saving its image, is "measured".
+	For measurements, filepath is the path of the measurement catalog of this realization.
+	"""
+	record = {"type":"rea", "catname":catname, "reaindex":reaindex, "status":status}
+	if filepath is not None:
+		record["filepath"] = os.path.relpath(filepath, os.path.dirname(manifestfilepath))
+	append(manifestfilepath, record)
+
+
+def read(manifestfilepath):
+	"""
+	Reads a manifest.
+
+	:returns: an OrderedDict whose keys are the catalog names, and whose values are dicts with the keys:
+
+		* "catfilepath" and "nrows", if the catalog was recorded (sim manifests)
+		* "imgreas": list of ImageInfo objects of the realizations (sim manifests)
+		* "status": dict reaindex -> "pending", "done", "measured" or "failed"
+		* "filepaths": dict reaindex -> path of the file of the realization recorded with its status (meas manifests)
+
+	All paths are joined to the directory of the manifest.
+	"""
+	manifestdir = os.path.dirname(manifestfilepath)
+	catalogs = collections.OrderedDict()
+	with open(manifestfilepath) as f:
+		lines = f.readlines()
+	for (linenumber, line) in enumerate(lines):
+		try:
+			record = json.loads(line)
+		except ValueError:
+			logger.warning("Skipping unreadable line %i of manifest '%s'" % (linenumber + 1, manifestfilepath))
+			continue
+		entry = catalogs.setdefault(record["catname"], {"imgreas":[], "status":{}, "filepaths":{}})
+		if record["type"] == "catalog":
+			entry["catfilepath"] = os.path.join(manifestdir, record["catfilepath"])
+			entry["nrows"] = record["nrows"]
+			entry["imgreas"] = [imageinfo.ImageInfo(os.path.join(manifestdir, imgrea["filepath"]), imgrea["xname"], imgrea["yname"],
+				imgrea["stampsize"], pixelscale=imgrea["pixelscale"]) for imgrea in record["imgreas"]]
+			for reaindex in range(len(entry["imgreas"])):
+				entry["status"].setdefault(reaindex, "pending")
+		elif record["type"] == "rea":
+			entry["status"][record["reaindex"]] = record["status"]
+			if "filepath" in record:
+				entry["filepaths"][record["reaindex"]] = os.path.join(manifestdir, record["filepath"])
+	logger.info("Read manifest '%s' with %i catalogs" % (manifestfilepath, len(catalogs)))
+	return catalogs
@@ -0,0 +1,300 @@
+"""
+A small task scheduler around multiprocessing.Pool.imap_unordered, used by meas.run and sim.run.
+
+Compared to a plain Pool.map, the tasks are handed out one by one, in order of decreasing size, so that a large task
+does not end up alone at the tail of the run. The progress is logged (with throughput and ETA) while the tasks
+complete, and can also be written to a small JSON file, to monitor long runs from outside::
+
+	$ cat progress.json
+	{"status": "running", "ntasks": 200, "ndone": 57, "nfailed": 0, "elapsed": 1203.4, "rate": 0.047, "eta": 3011.2, ...}
+
+An exception raised by a task does not abort the other tasks. The task can be retried (maxattempts), and if it keeps failing,
+it gets recorded in a quarantine file, so that a later run can process only the missing or failed tasks.
+
+With a leasekey, several independent runs (processes, or hosts sharing a filesystem) can cooperatively drain the same tasks:
+each task is done only once, under a lease file (see tools.lease).
+
+"""
+
+import os
+import json
+import time
+import datetime
+import traceback
+import multiprocessing
+
+from . import lease
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def run(fct, tasks, ncpu=1, sizes=None, maxtasksperchild=None, progressfilepath=None, logperiod=60.0,
+	maxattempts=1, quarantinefilepath=None, taskkey=str, leasekey=None, leaseexpiry=3600.0, leasepoll=10.0,
+	quarantine=None, progress=None):
+	"""
+	Calls fct on every task, using ncpu processes.
+
+	:param fct: the function to call on each task. With ncpu > 1, fct and the tasks have to be picklable.
+	:param tasks: list of tasks
+	:param ncpu: number of processes. 1 runs everything in the current process (easier to debug), 0 uses all CPUs.
+	:param sizes: optional list of numbers (file sizes, row counts...) estimating the cost of each task.
+		The tasks get started in order of decreasing size, and the ETA gets computed from the sizes.
+	:param maxtasksperchild: if set, each worker process gets replaced by a fresh one after this many tasks
+		(see multiprocessing.Pool), to release the memory that long runs might accumulate.
+	:param progressfilepath: if set, a JSON file with the progress is (atomically) rewritten at each completed task.
+	:param logperiod: minimum time in seconds between two progress log messages.
+	:param maxattempts: number of times a task gets tried (in the same worker process) before being considered as failed.
+	:param quarantinefilepath: if set, the failed tasks get listed in this JSON file (with their key, the error and the traceback),
+		which is rewritten at the end of the run (and at each failure). The file gets removed if no task failed.
+		If not set, a RuntimeError is raised at the end of the run if some tasks failed.
+		In both cases, all other tasks are processed.
+	:param taskkey: function returning a string that identifies a task in the quarantine file, for instance its output filepath.
+	:param leasekey: if set, a (picklable) function returning the path of the output file of a task. Each task is then done
+		under a lease (see tools.lease), and only if its output does not exist yet, so that other runs can work on the same tasks.
+		Tasks leased by other runs are checked again every leasepoll seconds, until their output exists or until their
+		lease is stale (older than leaseexpiry seconds), in which case this run reclaims and does them.
+	:param leaseexpiry: time in seconds after which a lease that was not refreshed gets reclaimed.
+	:param leasepoll: time in seconds between two checks of the tasks leased by other runs.
+	:param quarantine: optional list of failures, to which the failed tasks get appended. Use the same list for several runs
+		(for instance successive stages of a job) writing to the same quarantine file, so that the file lists all their failures.
+	:param progress: optional Progress object, to share a single progress (and progress file) between several runs.
+		It has to count the tasks of all these runs. If given, progressfilepath and logperiod are not used.
+
+	:returns: the list of the return values of fct, in the order of the tasks (None for failed tasks,
+		and for tasks done by other runs).
+	"""
+
+	n = len(tasks)
+	if maxattempts < 1:
+		raise RuntimeError("maxattempts must be at least 1")
+	if sizes is None:
+		order = list(range(n))
+	else:
+		if len(sizes) != n:
+			raise RuntimeError("The list of sizes (%i) does not have the same length as the tasks (%i)" % (len(sizes), n))
+		order = sorted(range(n), key=lambda i: sizes[i], reverse=True) # Stable: ties keep their order
+
+	if ncpu == 0:
+		try:
+			ncpu = multiprocessing.cpu_count()
+		except:
+			logger.warning("multiprocessing.cpu_count() is not implemented!")
+			ncpu = 1
+
+	if progress is None:
+		progress = Progress(n, None if sizes is None else sum(sizes), progressfilepath, logperiod)
+	results = [None] * n
+	if quarantine is None:
+		quarantine = [] # The failed tasks
+	nprevious = len(quarantine) # Failures of earlier runs
+	call = _IndexedCall(fct, maxattempts, leasekey, leaseexpiry)
+	pool = None
+	if ncpu == 1:
+		logger.debug("Not using multiprocessing")
+	else:
+		pool = multiprocessing.Pool(processes=ncpu, maxtasksperchild=maxtasksperchild)
+
+	try:
+		pending = order
+		while len(pending) > 0:
+			indexedtasks = [(i, tasks[i]) for i in pending]
+			if pool is None:
+				outputs = map(call, indexedtasks)
+			else:
+				outputs = pool.imap_unordered(call, indexedtasks, chunksize=1)
+
+			pending = [] # The tasks that are leased by other runs
+			for (i, result, failure, status) in outputs:
+				if status == "leased":
+					pending.append(i)
+					continue
+				if failure is None:
+					results[i] = result
+				else:
+					logger.error("Task %s failed after %i attempt(s), putting it into quarantine" % (str(tasks[i]), maxattempts))
+					failure["key"] = taskkey(tasks[i])
+					quarantine.append(failure)
+					if quarantinefilepath is not None:
+						writequarantine(quarantine, quarantinefilepath)
+				progress.update(str(tasks[i]), failure is not None, None if sizes is None else sizes[i])
+
+			if len(pending) > 0:
+				logger.info("%i tasks are leased by other runs, checking them again in %.1f s" % (len(pending), leasepoll))
+				time.sleep(leasepoll)
+
+		if pool is not None:
+			pool.close()
+
+	except BaseException as e: # Including KeyboardInterrupt
+		logger.error("Aborting the run: %s: %s" % (type(e).__name__, str(e)))
+		progress.write(status="aborted")
+		if pool is not None:
+			pool.terminate()
+		raise
+
+	finally:
+		if pool is not None:
+			pool.join()
+
+	progress.log()
+	if quarantinefilepath is not None:
+		writequarantine(quarantine, quarantinefilepath)
+	nfailed = len(quarantine) - nprevious
+	if nfailed > 0:
+		if quarantinefilepath is None:
+			raise RuntimeError("%i out of %i tasks failed: %s" % (nfailed, n, ", ".join([failure["key"] for failure in quarantine[nprevious:]])))
+		logger.error("%i out of %i tasks failed, they are listed in '%s'" % (nfailed, n, quarantinefilepath))
+	return results
+
+
+def writequarantine(quarantine, quarantinefilepath):
+	"""
+	Writes the list of failed tasks (dicts with keys "key", "error", "traceback" and "attempts") into a JSON file,
+	atomically. If the list is empty, an existing file gets removed.
+	"""
+	if len(quarantine) == 0:
+		if os.path.exists(quarantinefilepath):
+			os.remove(quarantinefilepath)
+		return
+	tmpfilepath = quarantinefilepath + ".tmp"
+	with open(tmpfilepath, "w") as f:
+		json.dump(quarantine, f, indent=1)
+	os.replace(tmpfilepath, quarantinefilepath)
+
+
+def readquarantine(quarantinefilepath):
+	"""
+	Returns the list of the keys of the failed tasks listed in a quarantine file (an empty list if the file does not exist).
+	"""
+	if not os.path.exists(quarantinefilepath):
+		return []
+	with open(quarantinefilepath) as f:
+		return [failure["key"] for failure in json.load(f)]
+
+
+class _IndexedCall():
+	"""
+	Wraps fct so that the results of imap_unordered can be attributed to their tasks, and so that exceptions
+	get caught (and the task retried) in the worker process, instead of aborting the pool.
+	If a leasekey is given, the task is done under a lease.
+	This is a class (and not a closure) so that it can be pickled.
+	"""
+
+	def __init__(self, fct, maxattempts=1, leasekey=None, leaseexpiry=3600.0):
+		self.fct = fct
+		self.maxattempts = maxattempts
+		self.leasekey = leasekey
+		self.leaseexpiry = leaseexpiry
+
+	def __call__(self, indexedtask):
+		"""
+		Returns (i, result, failure, status), with status "done" (result is set, or failure if all attempts failed),
+		"skipped" (the output exists, the task was done by another run) or "leased" (another run is doing the task).
+		"""
+		(i, task) = indexedtask
+		if self.leasekey is None:
+			return (i,) + self.attempt(task) + ("done",)
+
+		tasklease = lease.Lease(self.leasekey(task), expiry=self.leaseexpiry)
+		if not tasklease.acquire():
+			return (i, None, None, "leased")
+		try:
+			if os.path.exists(tasklease.filepath): # Checked only now that we hold the lease
+				logger.info("Output %s exists, skipping this task" % (tasklease.filepath))
+				return (i, None, None, "skipped")
+			return (i,) + self.attempt(task) + ("done",)
+		finally:
+			tasklease.release()
+
+	def attempt(self, task):
+		"""
+		Returns (result, None) if the task succeeded, and (None, failure) if all attempts failed.
+		"""
+		for attempt in range(1, self.maxattempts + 1):
+			try:
+				return (self.fct(task), None)
+			except Exception as e:
+				logger.warning("Attempt %i/%i of task %s failed: %s: %s" % (attempt, self.maxattempts, str(task), type(e).__name__, str(e)))
+				failure = {"error":"%s: %s" % (type(e).__name__, str(e)), "traceback":traceback.format_exc(), "attempts":attempt}
+		return (None, failure)
+
+
+class Progress():
+	"""
+	Keeps track of the completed tasks, logs the throughput and ETA, and writes the progress file.
+	run() creates one, unless several runs have to share it.
+	"""
+
+	def __init__(self, ntasks, totalsize=None, progressfilepath=None, logperiod=60.0):
+		"""
+		:param ntasks: the total number of tasks
+		:param totalsize: if known, the sum of the sizes of all tasks, to compute the ETA from the sizes
+		"""
+		self.ntasks = ntasks
+		self.totalsize = None if totalsize is None else float(totalsize)
+		self.progressfilepath = progressfilepath
+		self.logperiod = logperiod
+
+		self.ndone = 0
+		self.nfailed = 0
+		self.donesize = 0.0
+		self.lastdone = None
+		self.starttime = datetime.datetime.now()
+		self.lastlogtime = self.starttime
+		self.write()
+
+	def elapsed(self):
+		return (datetime.datetime.now() - self.starttime).total_seconds()
+
+	def eta(self):
+		"""
+		Estimated remaining time in seconds (None if nothing is done yet), based on the sizes if available.
+		"""
+		elapsed = self.elapsed()
+		if self.totalsize is not None and self.donesize > 0.0:
+			return elapsed * (self.totalsize - self.donesize) / self.donesize
+		elif self.ndone > 0:
+			return elapsed * (self.ntasks - self.ndone) / float(self.ndone)
+		return None
+
+	def update(self, taskstr, failed=False, size=None):
+		"""
+		To be called when a task has completed (or failed).
+		"""
+		self.ndone += 1
+		if failed:
+			self.nfailed += 1
+		if size is not None:
+			self.donesize += size
+		self.lastdone = taskstr
+		self.write()
+		if (datetime.datetime.now() - self.lastlogtime).total_seconds() >= self.logperiod:
+			self.log()
+
+	def log(self):
+		elapsed = self.elapsed()
+		rate = self.ndone / elapsed if elapsed > 0.0 else 0.0
+		eta = self.eta()
+		logger.info("%6.2f%% done (%i/%i, %i failed), %.3f tasks/s, ETA %s" % (100.0*float(self.ndone)/float(max(self.ntasks, 1)), self.ndone, self.ntasks,
+			self.nfailed, rate, "unknown" if eta is None else str(datetime.timedelta(seconds=int(round(eta))))))
+		self.lastlogtime = datetime.datetime.now()
+
+	def write(self, status="running"):
+		"""
+		Rewrites the progress file, atomically, so that readers never see a partial file.
+		The status is "running", or "aborted" if the run got interrupted by an exception.
+		"""
+		if self.progressfilepath is None:
+			return
+		elapsed = self.elapsed()
+		eta = self.eta()
+		progress = {
+			"status":status, "ntasks":self.ntasks, "ndone":self.ndone, "nfailed":self.nfailed, "elapsed":elapsed,
+			"rate":self.ndone / elapsed if elapsed > 0.0 else 0.0, "eta":eta,
+			"starttime":self.starttime.isoformat(), "updated":datetime.datetime.now().isoformat(), "lastdone":self.lastdone
+			}
+		tmpfilepath = self.progressfilepath + ".tmp"
+		with open(tmpfilepath, "w") as f:
+			json.dump(progress, f, indent=1)
+		os.replace(tmpfilepath, self.progressfilepath)
@@ -2,11 +2,15 @@
 Helpers for astropy.table arrays
 """
 
+import os
+import pickle
+import hashlib
 import numpy as np
 import astropy.table
 import datetime
 
 from . import calc
+from . import io
 
 import copy
 
@@ -152,38 +156,14 @@ def group(incats, groupcols=None, removecols=None, checkcommon=True):
                 removecols = [] 
 
         # OK I'm taking here a few simple tests from from groupstats, as they are quite helpful.
-
-        colnames = incats[0].colnames # to check colnames
-        
-        for incat in incats:
-                if incat.colnames != colnames:
-                        raise RuntimeError("Your input catalogs do not have the same columns: \n\n %s \n\n is not \n\n %s"
-                                % (incat.colnames, colnames))
-
-        for groupcol in groupcols:
-                if groupcol not in colnames:
-                        raise RuntimeError("The column '%s' which should be grouped is not present in the catalog. The availble column names are %s" % (groupcol, colnames))
-                if groupcol in removecols:
-                        raise RuntimeError("Cannot both group and remove column '%s' " % groupcol)
-
-
-        # We make a list of the column names that should stay unaffected:
-        fixedcolnames = [colname for colname in colnames if (colname not in groupcols) and (colname not in removecols)]
+        fixedcolnames = _groupfixedcolnames(incats, groupcols, removecols)
         
         if len(fixedcolnames) > 0:
                 # We will take those columns from the first incat (we test below that this choice doesn't matter)
                 fixedcat = incats[0][fixedcolnames] # This makes a copy
         
                 if checkcommon == True:
-                        # We test that the columns of these fixedcolnames are the same for all the different incats
-                        for incat in incats:
-                                if not np.all(incat[fixedcolnames] == fixedcat):
-                                        print(incat.colnames)
-                                        print(fixedcat.colnames)
-                                        print(incat[fixedcolnames].colnames) 
-                                        print(fixedcat)
-                                        raise RuntimeError("Something fishy is going on: some columns are not identical among %s. Add them to groupcols or removecols." % fixedcolnames)
-                        logger.debug("Done with testing the identity of all the common columns")
+                        _groupcheckcommon(incats, fixedcolnames)
                 else:
                         logger.debug("Did not test the identity of all the common columns")
 
@@ -220,14 +200,216 @@ def group(incats, groupcols=None, removecols=None, checkcommon=True):
 
 
 
+
+def _groupfixedcolnames(incats, groupcols, removecols):
+        """
+        Checks the colnames of the incats and the groupcols and removecols given to group(),
+        and returns the list of column names that should stay unaffected.
+        """
+        colnames = incats[0].colnames # to check colnames
+        
+        for incat in incats:
+                if incat.colnames != colnames:
+                        raise RuntimeError("Your input catalogs do not have the same columns: \n\n %s \n\n is not \n\n %s"
+                                % (incat.colnames, colnames))
+
+        for groupcol in groupcols:
+                if groupcol not in colnames:
+                        raise RuntimeError("The column '%s' which should be grouped is not present in the catalog. The availble column names are %s" % (groupcol, colnames))
+                if groupcol in removecols:
+                        raise RuntimeError("Cannot both group and remove column '%s' " % groupcol)
+
+        # We make a list of the column names that should stay unaffected:
+        return [colname for colname in colnames if (colname not in groupcols) and (colname not in removecols)]
+
+
+def _groupcheckcommon(incats, fixedcolnames):
+        """
+        Tests that the columns fixedcolnames are the same for all the different incats.
+        """
+        refchecksums = colchecksums(incats[0], fixedcolnames)
+        for incat in incats[1:]:
+                diffcolnames = _diffchecksums(refchecksums, incat)
+                if len(diffcolnames) > 0:
+                        raise RuntimeError("Something fishy is going on: the columns %s are not identical among the catalogs. Add them to groupcols or removecols." % diffcolnames)
+        logger.debug("Done with testing the identity of all the common columns")
+
+
+def colchecksums(cat, colnames=None):
+        """
+        Returns a dict with a checksum of the content of each column of cat (or of the columns colnames).
+        Two columns with the same checksum have the same dtype, shape, mask, and the same values in the unmasked cells.
+        This allows to test that columns of different catalogs are identical by reading each of them only once,
+        without building any temporary table.
+        """
+        if colnames is None:
+                colnames = cat.colnames
+        checksums = {}
+        for colname in colnames:
+                col = cat[colname]
+                data = np.ma.getdata(col)
+                mask = np.ma.getmaskarray(col)
+                h = hashlib.sha1()
+                h.update(("%s %s" % (data.dtype.str, data.shape)).encode("utf-8"))
+                if np.any(mask):
+                        h.update(np.packbits(mask).tobytes())
+                        data = data[np.logical_not(mask)] # The values of masked cells do not matter
+                if data.dtype.kind == "O":
+                        h.update(pickle.dumps(data.tolist(), -1))
+                else:
+                        h.update(np.ascontiguousarray(data).view(np.uint8))
+                checksums[colname] = h.hexdigest()
+        return checksums
+
+
+def _diffchecksums(refchecksums, cat):
+        """
+        Returns the list of the columns of cat whose checksums differ from the refchecksums (as obtained from colchecksums()).
+        """
+        checksums = colchecksums(cat, list(refchecksums.keys()))
+        return [colname for colname in refchecksums if checksums[colname] != refchecksums[colname]]
+
+
+def groupstream(incatlists, nrows, groupcols=None, removecols=None, checkcommon=True, memmapdir=None):
+        """
+        Streaming version of group(), to group many lists of catalogs (typically the realizations of many simulated catalogs)
+        and stack the results vertically. The output is the same as
+        
+                astropy.table.vstack([group(incats, ...) for incats in incatlists])
+        
+        but the final columns get preallocated, and filled one list of catalogs after the other.
+        So if incatlists is a generator reading the catalogs, the memory used is bounded by one list of catalogs plus the output
+        (or just one list of catalogs, with memmapdir).
+        
+        :param incatlists: iterable yielding lists of catalogs, that would each be given to group().
+                All lists must have the same length, and all catalogs the same columns.
+        :param nrows: the total number of rows of the output (i.e., the sum of the lengths of the catalogs of each list).
+        :param groupcols: as for group(). These columns must be 1D.
+        :param removecols: idem
+        :param checkcommon: idem
+        :param memmapdir: if set, the output columns are memory-mapped .npy files, written into this directory (which must not exist).
+                The directory is a columnar catalog, see tools.io.writecolumns(), that can be read again with tools.io.readpickle().
+        
+        The meta of the output is the meta of the first catalog of the first list, plus meta["ngroup"].
+        """
+        starttime = datetime.datetime.now()
+        
+        if groupcols is None:
+                groupcols = []
+        if removecols is None:
+                removecols = []
+        if memmapdir is not None:
+                if os.path.exists(memmapdir):
+                        raise RuntimeError("The memmapdir %s already exists" % (memmapdir))
+                os.makedirs(memmapdir)
+        
+        outputcat = None
+        nfilled = 0
+        for (listindex, incats) in enumerate(incatlists):
+                
+                fixedcolnames = _groupfixedcolnames(incats, groupcols, removecols)
+                if checkcommon == True and len(fixedcolnames) > 0:
+                        _groupcheckcommon(incats, fixedcolnames)
+                n = len(incats[0])
+                
+                if outputcat is None:
+                        # We preallocate the output based on this first list
+                        outputcat = _groupstreamalloc(incats, nrows, fixedcolnames, groupcols, memmapdir)
+                        ngroup = len(incats)
+                else:
+                        if len(incats) != ngroup:
+                                raise RuntimeError("List %i has %i catalogs instead of %i, they should not be merged" % (listindex, len(incats), ngroup))
+                        if incats[0].colnames != colnames:
+                                raise RuntimeError("The catalogs of list %i do not have the same columns as the first ones" % (listindex))
+                colnames = incats[0].colnames
+                if nfilled + n > nrows:
+                        raise RuntimeError("The catalogs have more than the announced %i rows" % (nrows))
+                
+                rows = slice(nfilled, nfilled + n)
+                for colname in fixedcolnames:
+                        _groupstreamfill(outputcat[colname], rows, incats[0][colname])
+                for groupcol in groupcols:
+                        for (j, incat) in enumerate(incats):
+                                _groupstreamfill(outputcat[groupcol], (rows, j), incat[groupcol])
+                nfilled += n
+                logger.debug("Filled rows %i to %i of %i" % (rows.start, rows.stop, nrows))
+        
+        if outputcat is None:
+                raise RuntimeError("No catalogs to group")
+        if nfilled != nrows:
+                raise RuntimeError("The catalogs have %i rows instead of the announced %i" % (nfilled, nrows))
+        
+        outputcat.meta["ngroup"] = ngroup
+        
+        if memmapdir is not None:
+                io.writecolumnsinfo(outputcat, memmapdir)
+                outputcat = io.readcolumns(memmapdir)
+        
+        endtime = datetime.datetime.now()
+        logger.info("The streamed grouping took %s" % (str(endtime - starttime)))
+        logger.info("Output table: %i rows and %i columns (%i common, %i grouped)" %
+                (len(outputcat), len(outputcat.colnames), len(fixedcolnames), len(groupcols)))
+        
+        return outputcat
+
+
+def _groupstreamalloc(incats, nrows, fixedcolnames, groupcols, memmapdir):
+        """
+        Preallocates the output table of groupstream(), with the columns of the first list of catalogs.
+        """
+        def alloc(i, suffix, shape, dtype):
+                if memmapdir is None:
+                        return np.zeros(shape, dtype=dtype)
+                if np.dtype(dtype).kind == "O":
+                        raise RuntimeError("Object columns cannot be memory-mapped")
+                return np.lib.format.open_memmap(os.path.join(memmapdir, "%i%s.npy" % (i, suffix)), mode="w+", dtype=dtype, shape=shape)
+        
+        cols = []
+        for (i, colname) in enumerate(fixedcolnames):
+                col = incats[0][colname]
+                kwargs = {"name":colname, "unit":col.unit, "format":col.format, "description":col.description, "meta":copy.deepcopy(col.meta), "copy":False}
+                data = alloc(i, "", (nrows,) + col.shape[1:], col.dtype)
+                if isinstance(col, astropy.table.MaskedColumn):
+                        # Given as a masked array, so that astropy does not copy the mask
+                        cols.append(astropy.table.MaskedColumn(data=np.ma.MaskedArray(data, mask=alloc(i, "_mask", data.shape, bool), copy=False), **kwargs))
+                else:
+                        cols.append(astropy.table.Column(data=data, **kwargs))
+        
+        for (i, groupcol) in enumerate(groupcols, len(fixedcolnames)):
+                if incats[0][groupcol].ndim != 1:
+                        raise RuntimeError("Only 1D columns can be grouped in a stream, '%s' is not" % (groupcol))
+                dtype = np.result_type(*[incat[groupcol].dtype for incat in incats])
+                data = alloc(i, "", (nrows, len(incats)), dtype)
+                cols.append(astropy.table.MaskedColumn(data=np.ma.MaskedArray(data, mask=alloc(i, "_mask", data.shape, bool), copy=False), name=groupcol, copy=False))
+        
+        outputcat = astropy.table.Table(cols, meta=copy.deepcopy(incats[0].meta), copy=False)
+        assert all([np.shares_memory(outputcat[col.name], col) for col in cols]) # astropy did not copy the data
+        return outputcat
+
+
+def _groupstreamfill(outputcol, index, col):
+        """
+        Copies the data (and mask) of col into outputcol[index].
+        """
+        if isinstance(outputcol, astropy.table.MaskedColumn):
+                outputcol.data.data[index] = np.ma.getdata(col)
+                outputcol.mask[index] = np.ma.getmaskarray(col)
+        else:
+                outputcol.data[index] = np.ma.getdata(col)
+                if np.ma.is_masked(col):
+                        raise RuntimeError("Column '%s' has masked values, but was not masked in the first catalog" % (outputcol.name))
+
+
         
-def groupstats(incats, groupcols=None, removecols=None, removereas=True, keepfirstrea=True, checkcommon=True):
+def groupstats(incats, groupcols=None, removecols=None, removereas=True, keepfirstrea=True, checkcommon=True, mediansize=None):
         """
         This function computes simple statistics "across" corresponding columns from the list of input catalogs (incats).
         Instead of producing 2D columns (i.e., a 3D table), it puts all the data into extra columns with custom names ("_rea0"...).
         
         :param incats: list of input catalogs (astropy tables, usually masked).
                 They must all have identical order and column names (this will be checked).
+                This can also be an iterator (e.g., a generator reading the catalogs): the catalogs are processed one after
+                the other, and the statistics are accumulated (see calc.Accumulator), so that they do not have to be all in memory.
         :param groupcols: list of column names that should be "grouped", that is the columns whose content differ from incat to incat.
         :param removecols: list of column names that should be discarded in the output catalog
         :param removereas: if True, the individual realization columns in the output table will **not** be kept in the ouput
@@ -236,7 +418,11 @@ def groupstats(incats, groupcols=None, removecols=None, removereas=True, keepfir
         :param keepfirstreas: if True, the values of the first realization ("_0") will be kept.
                 It is usually handy (and not too bulky) to "keep" one single realization in the output catalog.
         :param checkcommon: if True (default), the function tests that **any column which is not in groupcols or removecols is indeed IDENTICAL among the incats**.
-                This can lead to perfomance issues for catalogs with many (say > 1000) columns.
+                This is done by comparing checksums of the columns (see colchecksums()), computed once per incat.
+        :param mediansize: if None (default), the medians are exact, but all the values of the groupcols get kept in memory
+                until the end. If set, the medians are approximated from a sample of at most mediansize values per row
+                (they are still exact if there are not more incats than mediansize), see calc.Accumulator.
+                It has to be at least 1, as the _med columns are always computed.
         
         For each colname in groupcols, the function computes:
         
@@ -263,87 +449,89 @@ def groupstats(incats, groupcols=None, removecols=None, removereas=True, keepfir
                 groupcols = []
         if removecols is None:
                 removecols = [] 
+        if mediansize is not None and mediansize < 1:
+                raise RuntimeError("mediansize must be at least 1, not %i" % (mediansize))
 
-        # First, some checks on the incats:
-        if len(incats) < 2:
-                raise RuntimeError("Statistics can only be computed if more than one incats are given.")
-        
-        colnames = incats[0].colnames # to check colnames
-        
+        # We go through the incats one after the other, checking them and accumulating the statistics.
+        # For each groupcol, we keep a calc.Accumulator, and maybe the columns of the individual realizations.
+        # We do not try to reuse the int from the realization filename to name these realization columns.
+        # Indeed, the user could have deleted some realizations etc, leading to quite a mess.
+        # It's easier to just make a new integer range.
         notmasked = False
+        reacols = dict([(groupcol, []) for groupcol in groupcols])
+        nincats = 0
         for incat in incats:
-                if incat.colnames != colnames:
+                
+                if nincats == 0:
+                        colnames = incat.colnames # to check colnames
+                        for groupcol in groupcols:
+                                if groupcol not in colnames:
+                                        raise RuntimeError("The column '%s' which should be grouped is not present in the catalog. The availble column names are %s" % (groupcol, colnames))
+                                if groupcol in removecols:
+                                        raise RuntimeError("Cannot both group and remove column '%s' " % groupcol)
+                        
+                        # We make a list of the column names that should stay unaffected:
+                        fixedcolnames = [colname for colname in colnames if (colname not in groupcols) and (colname not in removecols)]
+                        if len(fixedcolnames) > 0:
+                                # We will take those columns from the first incat (we test below that this choice doesn't matter)
+                                fixedcat = incat[fixedcolnames] # This makes a copy
+                                if checkcommon == True:
+                                        refchecksums = colchecksums(fixedcat)
+                        
+                        accumulators = dict([(groupcol, calc.Accumulator(len(incat), mediansize=mediansize)) for groupcol in groupcols])
+                
+                elif incat.colnames != colnames:
                         raise RuntimeError("Your input catalogs do not have the same columns: \n\n %s \n\n is not \n\n %s"
                                 % (incat.colnames, colnames))
                 
                 if incat.masked is False:
                         notmasked = True
+                
+                if checkcommon == True and len(fixedcolnames) > 0 and nincats > 0:
+                        # We test that the columns of these fixedcolnames are the same for all the different incats
+                        diffcolnames = _diffchecksums(refchecksums, incat)
+                        if len(diffcolnames) > 0:
+                                raise RuntimeError("groupstat failed: colnames match, but the columns %s are not \
+identical among the list. They are surely missing from groupcols or removecols." % diffcolnames)
+                
+                for groupcol in groupcols:
+                        accumulators[groupcol].add(incat[groupcol])
+                        # Depening on the removereas and keepfirstreas flags, we also keep some columns
+                        # from the individual realizations.
+                        if removereas == False or (keepfirstrea == True and nincats == 0):
+                                reacols[groupcol].append(incat[groupcol])
+                
+                nincats += 1
         
+        if nincats < 2:
+                raise RuntimeError("Statistics can only be computed if more than one incats are given.")
         if notmasked:
                 logger.info("At least one of the input catalogs is not masked (OK but unexpected)")
-
-        for groupcol in groupcols:
-                if groupcol not in colnames:
-                        raise RuntimeError("The column '%s' which should be grouped is not present in the catalog. The availble column names are %s" % (groupcol, colnames))
-                if groupcol in removecols:
-                        raise RuntimeError("Cannot both group and remove column '%s' " % groupcol)
-                        
-        # We make a list of the column names that should stay unaffected:
-        fixedcolnames = [colname for colname in colnames if (colname not in groupcols) and (colname not in removecols)]
-        
         if len(fixedcolnames) > 0:
-                # We will take those columns from the first incat (we test below that this choice doesn't matter)
-                fixedcat = incats[0][fixedcolnames] # This makes a copy
-        
                 if checkcommon == True:
-                        # We test that the columns of these fixedcolnames are the same for all the different incats
-                        for incat in incats:
-                                if not np.all(incat[fixedcolnames] == fixedcat):
-                                        raise RuntimeError("groupstat failed: colnames match, but some columns are not \
-identical among the list. A colname is surely missing from to groupcols or removecols.")
                         logger.debug("Done with testing the identity of all the common columns")
                 else:
                         logger.debug("Did not test the identity of all the common columns")
         
-        # We prepare some "suffixes" to use when mixing columns of the incats.
-        # For this we do not try to reuse the int from the realization filename
-        # Indeed, the user could have deleted some realizations etc, leading to quite a mess.
-        # It's easier to just make a new integer range:
-        incat_names = ["rea%i" % (i) for i in range(len(incats))]
-
         statscatdict = {} # We will add statistics columns (numpy arrays) to this list
         statscatdictnames = [] # Is used to keep a nice ordering
         reascats = [] # We might put single-realization columns here
         
-        # For each groupcol, we now compute some statistics
+        # For each groupcol, we now get the statistics
         for groupcol in groupcols:
                 logger.info("Computing stats for '%s'" % (groupcol))
-                suffixedcolnames = ["%s_%s" % (groupcol, incat_name) for incat_name in incat_names]
-                # So this looks like adamom_flux_1, adamom_flux_2, ...
-                
-                # We build a masked numpy array with the data of these columns
-                array = np.ma.vstack([incat[groupcol] for incat in incats])
-                # first index is incat, second is row
-                
-                # And compute the stats:
-                statscatdict["%s_mean" % (groupcol)] = np.ma.mean(array, axis=0)
-                statscatdict["%s_med" % (groupcol)] = np.ma.median(array, axis=0)
-                statscatdict["%s_std" % (groupcol)] = np.ma.std(array, axis=0)
-                statscatdict["%s_n" % (groupcol)] = np.ma.count(array, axis=0)
+                accumulator = accumulators[groupcol]
+                statscatdict["%s_mean" % (groupcol)] = accumulator.getmean()
+                statscatdict["%s_med" % (groupcol)] = accumulator.getmedian()
+                statscatdict["%s_std" % (groupcol)] = accumulator.getstd()
+                statscatdict["%s_n" % (groupcol)] = accumulator.getn()
                 # We also add those names to a list:
                 statscatdictnames.extend(["%s_mean" % (groupcol), "%s_med" % (groupcol), "%s_std" % (groupcol), "%s_n" % (groupcol)])
                 
-                # Depening on the removereas and keepfirstreas flags, we also keep some columns
-                # from the individual realizations.
-                if removereas == False:
-                        # We keep every column:
-                        reascats.append(astropy.table.Table([incat[groupcol] for incat in incats], names = suffixedcolnames))
-                         
-                else:
-                        # see if we should keep the first:
-                        if keepfirstrea == True:
-                                # keep the first
-                                reascats.append(astropy.table.Table([incat[groupcol] for incat in [incats[0]]], names = [suffixedcolnames[0]]))
+                if len(reacols[groupcol]) > 0:
+                        # So this looks like adamom_flux_rea0, adamom_flux_rea1, ...
+                        suffixedcolnames = ["%s_rea%i" % (groupcol, i) for i in range(len(reacols[groupcol]))]
+                        reascats.append(astropy.table.Table(reacols[groupcol], names = suffixedcolnames))
                         
         assert len(statscatdict) == 4*len(groupcols) # Just a check, as in principle stuff in the dict could be overwritten.
 
@@ -354,7 +542,7 @@ identical among the list. A colname is surely missing from to groupcols or remov
         # Strictly speaking this is where this information belongs, as it relates to the new columns, not to the catalog.
         # See note a few lines below.
         for colname in statscat.colnames:
-                statscat[colname].meta["ngroupstats"] = len(incats)
+                statscat[colname].meta["ngroupstats"] = nincats
         
         # We add individual realization data (if needed) :
         if len(reascats) != 0:
@@ -370,7 +558,7 @@ identical among the list. A colname is surely missing from to groupcols or remov
         
         # Especially when averaging measurements on realizations, it seems ok to write ngroupstats also into the meta of the catalog itself.
         # So we keep doing this.
-        outputcat.meta["ngroupstats"] = len(incats)
+        outputcat.meta["ngroupstats"] = nincats
 
         endtime = datetime.datetime.now()
         logger.info("The groupstats computations took %s" % (str(endtime - starttime)))
@@ -514,6 +702,13 @@ def fastgroupreshape(cat, groupcolnames):
         Oh boy, should have implemented that earlier...
         I guess that it's not even less safe.
         
+        The rows are not sorted: each group gets an integer index (from np.unique on the groupcolnames, one after the other),
+        and a single permutation of the row indices, computed once, is used to gather every column into its 2D shape.
+        As for groupreshape, the groups are ordered according to the values of the groupcolnames, and the rows of a group
+        keep their order.
+        
+        Groups of different sizes are allowed: the 2D columns then have the size of the largest group as second dimension,
+        and are masked columns, with the cells beyond the size of each group masked.
         """
         # Start
         logger.info("Determining groups for {}...".format(groupcolnames))
@@ -522,35 +717,60 @@ def fastgroupreshape(cat, groupcolnames):
         for colname in groupcolnames:
                 if cat[colname].ndim != 1:
                         raise RuntimeError("Only 1D columns are allowed as groupcolnames! '{}' is not.".format(colname))
-        
-        # Use the table group functionality
-        groupcat = cat.group_by(groupcolnames)
-        
-        
-        ngroups = len(groupcat.groups.indices) -1
+                if np.ma.is_masked(cat[colname]):
+                        raise RuntimeError("The groupcolname '{}' has masked values.".format(colname))
+        
+        # We compute the group index of each row, combining the groupcolnames one after the other.
+        # Calling np.unique on the combined index after each step keeps the indices small, and orders the groups
+        # like a sort on the groupcolnames would.
+        groupindex = np.zeros(len(cat), dtype=np.int64)
+        ngroups = 1
+        for colname in groupcolnames:
+                (values, colindex) = np.unique(np.asarray(cat[colname]), return_inverse=True)
+                (uniques, groupindex) = np.unique(groupindex * len(values) + colindex.reshape(-1), return_inverse=True)
+                groupindex = groupindex.reshape(-1)
+                ngroups = len(uniques)
         logger.info("Found {} groups".format(ngroups))
         
-        groupsize = len(groupcat.groups[0])
-        logger.info("Groups seem to have a length of {}".format(groupsize))
+        groupsizes = np.bincount(groupindex, minlength=ngroups)
+        groupsize = np.max(groupsizes)
+        groupstarts = np.cumsum(groupsizes) - groupsizes
+        ragged = np.any(groupsizes != groupsize)
+        if ragged:
+                logger.info("Groups have lengths from {} to {}, padding them with masked cells".format(np.min(groupsizes), groupsize))
+        else:
+                logger.info("Groups have a length of {}".format(groupsize))
+        
+        # The permutation: order lists the rows group by group, and gather tells which row goes into each cell of the 2D columns.
+        order = np.argsort(groupindex, kind="stable")
+        cellindex = groupindex[order] * groupsize + (np.arange(len(cat)) - groupstarts[groupindex[order]])
+        gather = np.repeat(order[groupstarts], groupsize) # Padding cells get the first row of their group
+        gather[cellindex] = order
+        if ragged:
+                padding = np.ones(ngroups * groupsize, dtype=bool)
+                padding[cellindex] = False
+                padding = padding.reshape((ngroups, groupsize))
         
-        if groupsize * ngroups != len(groupcat):
-                raise RuntimeError("Sorry, weird structure!")
-
         logger.info("Aggregating the groups...")
-        # OK using the groupcat.groups.aggregate function works, but is still slow.
-        # aggcat = groupcat.groups.aggregate(lambda x: x.reshape(1,-1))
-        # Instead,  we do the reshaping column by column.
-        # groupcat is sorted according to the groups, we exploit this.
-        # The keepunique at the end is a good check for errors.
         newcat = astropy.table.Table()
-        for colname in groupcat.colnames:
-                #print "reshaping {} ...".format(colname)
-                newcat[colname] = groupcat[colname].reshape((ngroups, groupsize))
-
-        logger.info("Keepuniquing the groupcolnames...")
-        # At least for the groupcolnames, we only want to keep single values:
-        keepunique(newcat, groupcolnames)
-
+        for colname in [colname for colname in cat.colnames if colname not in groupcolnames]:
+                col = cat[colname]
+                shape = (ngroups, groupsize) + col.shape[1:]
+                data = np.ma.getdata(col)[gather].reshape(shape)
+                if ragged or isinstance(col, astropy.table.MaskedColumn):
+                        mask = np.ma.getmaskarray(col)[gather].reshape(shape)
+                        if ragged:
+                                mask[padding] = True
+                        newcat[colname] = astropy.table.MaskedColumn(data=np.ma.MaskedArray(data, mask=mask, copy=False), name=colname, copy=False,
+                                unit=col.unit, format=col.format, description=col.description, meta=copy.deepcopy(col.meta))
+                else:
+                        newcat[colname] = astropy.table.Column(data=data, name=colname, copy=False,
+                                unit=col.unit, format=col.format, description=col.description, meta=copy.deepcopy(col.meta))
+        
+        # For the groupcolnames, we only want to keep single values (these come last, as with keepunique):
+        for colname in groupcolnames:
+                newcat[colname] = cat[colname][order[groupstarts]]
+        
         return newcat
         
         
@@ -563,13 +783,16 @@ def fastgroupreshape(cat, groupcolnames):
 #####
 
 
-def addstats(cat, col, wcol=None, outcolprefix=None):
+def addstats(cat, col, wcol=None, outcolprefix=None, mediansize=None):
         """
         Adds columns containing some statistics of the values in each cell of col.
         So this is for 2D columns. Togheter this the function "group", this replaces the old-style "groupstats".
         
         :param col: name of the (2D) column containing the data for which stats should be computed
         :param wcol: name of the column containing some weights to be used, if desired.
+        :param mediansize: see groupstats. The statistics get accumulated one "realization" (index along the second dimension)
+                after the other, see calc.Accumulator, to avoid large temporary arrays. If None, the exact median gets
+                computed directly from col, which holds all the values anyway, and the accumulator keeps no values.
         
         """
         if outcolprefix == None:
@@ -589,14 +812,22 @@ def addstats(cat, col, wcol=None, outcolprefix=None):
         if wcol is not None:
                 if cat[col].shape != cat[wcol].shape:
                         raise RuntimeError("Data in col and wcol should have the same shape!") 
+        if mediansize is not None and mediansize < 1:
+                raise RuntimeError("mediansize must be at least 1, not {}".format(mediansize))
                 
                 
         logger.info("Adding stats for column {} of shape {}...".format(col, cat[col].shape))
         
-        cat[outcolprefix + "_mean"] = np.ma.mean(cat[col], axis=1)
-        cat[outcolprefix + "_med"] = np.ma.median(cat[col], axis=1)
-        cat[outcolprefix + "_std"] = np.ma.std(cat[col], axis=1)
-        cat[outcolprefix + "_n"] = np.ma.count(cat[col], axis=1)
+        accumulator = calc.Accumulator(len(cat), mediansize=(0 if mediansize is None else mediansize))
+        for i in range(cat[col].shape[1]):
+                accumulator.add(cat[col][:,i])
+        cat[outcolprefix + "_mean"] = accumulator.getmean()
+        if mediansize is None:
+                cat[outcolprefix + "_med"] = np.ma.median(cat[col], axis=1)
+        else:
+                cat[outcolprefix + "_med"] = accumulator.getmedian()
+        cat[outcolprefix + "_std"] = accumulator.getstd()
+        cat[outcolprefix + "_n"] = accumulator.getn()
         if wcol is not None:
                 # We add the weighted mean
                 cat[outcolprefix + "_wmean"] = np.ma.mean(cat[col] * cat[wcol], axis=1) / np.ma.mean(cat[wcol], axis=1)
@@ -212,6 +212,77 @@ class EuclidLike(momentsml.sim.params.Params):
 		out.update(self.draw_constants())
 		
 		return out
+
+
+	def draw_batch(self, ix, iy, nx, ny):
+		"""
+		Vectorized version of draw, called once per catalog
+		"""
+		n = len(ix)
+		
+		# Vectorized truncated Rayleigh for tru_g:
+		tru_g = np.random.rayleigh(0.25, n)
+		redraw = tru_g > 0.7
+		while np.any(redraw):
+			tru_g[redraw] = np.random.rayleigh(0.25, np.sum(redraw))
+			redraw = tru_g > 0.7
+		tru_theta = 2.0 * np.pi * np.random.uniform(0.0, 1.0, n)
+		(tru_g1, tru_g2) = (tru_g * np.cos(2.0 * tru_theta), tru_g * np.sin(2.0 * tru_theta))
+		
+		if self.dist_type == "gems":
+			source_rows = sourcecat[np.random.randint(0, len(sourcecat), n)]
+			tru_rad = np.array(source_rows["tru_rad"])
+			tru_mag = np.array(source_rows["tru_mag"])
+			tru_sersicn_tmp = np.array(source_rows["tru_sersicn"])
+			
+		elif self.dist_type == "unig":
+			tru_rad = np.random.uniform(1.0, 10.0, n)
+			tru_mag = np.random.uniform(20.5, 25.0, n)
+			a, b = (0.3 - 1.0) / 2.5, (6.0 - 1.0) / 2.5
+			tru_sersicn_tmp = scipy.stats.truncnorm(a, b, loc=1.0, scale=2.5).rvs(size=n)
+			
+		elif self.dist_type == "uni":
+			tru_rad = np.random.uniform(1.0, 10.0, n)
+			tru_mag = np.random.uniform(20.5, 25.0, n)
+			tru_sersicn_tmp = np.random.uniform(0.3, 6.0, n)
+
+		elif self.dist_type == "uni05":
+			tru_rad = np.random.uniform(0.5, 10.0, n)
+			tru_mag = np.random.uniform(20.5, 25.0, n)
+			tru_sersicn_tmp = np.random.uniform(0.3, 6.0, n)
+		
+		else:
+			raise RuntimeError("Unknown dist_type")
+		
+		tru_flux =  (exptime / gain) * 10**(-0.4*(tru_mag - zeropoint))
+		
+		# Same discretization of the sersic index as in draw:
+		tru_sersicns = np.linspace(0.3, 6.0, 21)
+		tru_sersicn = tru_sersicns[np.abs(tru_sersicns[np.newaxis,:] - tru_sersicn_tmp[:,np.newaxis]).argmin(axis=1)]
+		
+		out = {
+			"tru_flux":tru_flux,
+			"tru_rad":tru_rad,
+			"tru_g1":tru_g1,
+			"tru_g2":tru_g2,
+			"tru_g":tru_g,
+			"tru_theta":tru_theta,
+			"tru_sersicn":tru_sersicn,
+			"tru_mag":tru_mag,
+		}
+		
+		if self.shear > 0.0 and self.shear < 10.0:
+			out["tru_s1"] = np.random.uniform(-self.shear, self.shear, n)
+			out["tru_s2"] = np.random.uniform(-self.shear, self.shear, n)
+		else:
+			out["tru_s1"] = 0.0
+			out["tru_s2"] = 0.0
+		out["tru_mu"] = 1.0
+		
+		out.update(self.draw_psf())
+		out.update(self.draw_constants())
+		
+		return out
 		
 
 	